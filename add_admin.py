@@ -1,36 +1,30 @@
 # File: add_admin.py
 
-import sqlite3
-import hashlib
-
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+import os
+from database import Database
+from storage import IntegrityError
 
 def add_admin(db_name='students.db'):
-    conn = sqlite3.connect(db_name)
-    c = conn.cursor()
-
-    # Create users table if it doesn't exist
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT, is_admin INTEGER)''')
+    # Database creates the schema on whichever backend db_name points at
+    db = Database(db_name)
 
     # Add admin user
     username = 'admin'
     password = 'admin'
-    hashed_password = hash_password(password)
+    hashed_password = db.hash_password(password)
 
     try:
-        c.execute("INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)", 
-                  (username, hashed_password, 1))
-        conn.commit()
+        with db.backend.transaction() as c:
+            c.execute("INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)", 
+                      (username, hashed_password, 1))
         print(f"Admin user '{username}' added successfully.")
-    except sqlite3.IntegrityError:
+    except IntegrityError:
         print(f"Admin user '{username}' already exists.")
     finally:
-        conn.close()
+        db.close()
 
 if __name__ == "__main__":
-    add_admin()
+    add_admin(os.environ.get('STUDENT_PORTAL_DB', 'students.db'))
     print("You can now log in to the admin account with:")
     print("Username: admin")
     print("Password: admin")
@@ -0,0 +1,173 @@
+# File: attendance_journal.py
+
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+from metrics import metrics, get_logger, log_event
+from periodic import PeriodicWorker
+
+logger = get_logger(__name__)
+
+
+class AttendanceJournal:
+    # Local append-only log of attendance marks for kiosk mode. A mark is acknowledged once its
+    # line is on disk; JournalReconciler replays the log into attendance_events later.
+    # One journal file belongs to one kiosk process.
+    def __init__(self, path='attendance_journal.jsonl', fsync=True):
+        self.path = path
+        self.offset_file = f"{path}.offset"
+        self.conflict_file = f"{path}.conflicts"
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        # Marks acknowledged by this kiosk, so a double submit is refused without asking the database
+        self._seen = set()
+        # (student, course, date) -> session of the student's latest In, None after an Out; lets the
+        # timetable attach an Out without waiting for the In to be replayed. Seeded by load_open_sessions.
+        self._open = {}
+        self._replaying = threading.Lock()
+
+    def record(self, student_id, course_id, attendance_type, time, date=None, method='face', session_id=None, flag=None):
+        date = date or datetime.now().strftime("%Y-%m-%d")
+        key = (student_id, course_id, date, attendance_type, time)
+        # version 2: student and course are students.id and courses.id (version 1 had a user id and course name)
+        entry = {
+            'version': 2,
+            'student_id': student_id,
+            'course_id': course_id,
+            'date': date,
+            'type': attendance_type,
+            'time': time,
+            'method': method,
+            'session_id': session_id,
+            'flag': flag,
+        }
+        with metrics.timer('journal_write'):
+            with self._lock:
+                if key in self._seen:
+                    return False, f"{attendance_type} attendance already recorded at {time}"
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry) + '\n')
+                    f.flush()
+                    if self.fsync:
+                        os.fsync(f.fileno())
+                self._seen.add(key)
+                self._track(entry)
+        metrics.inc('attendance_marks', result='journaled', method=method)
+        return True, "Attendance recorded"
+
+    def _track(self, entry):
+        self._open[(entry['student_id'], entry['course_id'], entry['date'])] = \
+            entry.get('session_id') if entry['type'] == "In" else None
+
+    def open_session(self, student_id, course_id, date):
+        # Session the student is inside according to this kiosk's marks, or None
+        with self._lock:
+            return self._open.get((student_id, course_id, date))
+
+    def forget_sessions(self, session_ids):
+        # Auto-closed sessions: their students were given an Out at the end
+        with self._lock:
+            for key, session_id in self._open.items():
+                if session_id in session_ids:
+                    self._open[key] = None
+
+    def load_open_sessions(self, db, date):
+        # At startup: who is inside which session, from the database, then from marks not yet replayed
+        open_sessions = db.get_open_session_marks(date)
+        entries, _ = self.pending(batch_size=None)
+        with self._lock:
+            self._open = {(student_id, course_id, date): session_id
+                          for (student_id, course_id), session_id in open_sessions.items()}
+            for entry in entries:
+                if entry.get('version', 1) >= 2 and entry['date'] == date:
+                    self._track(entry)
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_file) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, offset):
+        tmp_file = f"{self.offset_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp_file, self.offset_file)
+
+    def pending(self, batch_size=200):
+        # Next batch of unreplayed entries (all of them with batch_size=None) and the byte offset just past them
+        offset = self._read_offset()
+        entries = []
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                while batch_size is None or len(entries) < batch_size:
+                    line = f.readline()
+                    if not line.endswith(b'\n'):
+                        # Nothing left, or a line still being written
+                        break
+                    offset += len(line)
+                    if line.strip():
+                        entries.append(json.loads(line))
+        except FileNotFoundError:
+            pass
+        return entries, offset
+
+    def commit(self, offset):
+        with self._lock:
+            # Fully replayed: start a fresh file rather than let the journal grow forever. The offset is reset
+            # before truncating, so a crash in between only replays entries again (idempotent), never skips
+            # entries appended to the new file.
+            if os.path.exists(self.path) and offset >= os.path.getsize(self.path):
+                self._write_offset(0)
+                open(self.path, 'w').close()
+            else:
+                self._write_offset(offset)
+
+    def record_conflicts(self, conflicts):
+        with open(self.conflict_file, 'a', encoding='utf-8') as f:
+            for entry, reason in conflicts:
+                f.write(json.dumps({**entry, 'reason': reason}) + '\n')
+
+    def reconcile(self, db, batch_size=200):
+        # Replays everything journaled so far; safe to re-run after a crash because replay is idempotent.
+        # One replay at a time: the session closer drains the journal too, before closing sessions.
+        with self._replaying:
+            return self._reconcile(db, batch_size)
+
+    def _reconcile(self, db, batch_size):
+        totals = {'applied': 0, 'duplicate': 0, 'conflict': 0}
+        while True:
+            entries, offset = self.pending(batch_size)
+            if not entries:
+                return totals
+            with metrics.timer('journal_replay'):
+                results = db.replay_attendance(entries)
+            conflicts = [(entry, reason) for entry, (status, reason) in zip(entries, results) if status == 'conflict']
+            if conflicts:
+                self.record_conflicts(conflicts)
+            for status, _ in results:
+                totals[status] += 1
+                metrics.inc('journal_replayed', result=status)
+            self.commit(offset)
+            log_event(logger, logging.INFO, "journal_reconciled", entries=len(entries), conflicts=len(conflicts))
+
+
+class JournalReconciler(PeriodicWorker):
+    # Drains the journal into the database every `interval` seconds. While the database is unavailable
+    # or locked the entries just stay in the journal.
+    error_metric = 'journal_replay_errors'
+    error_event = 'journal_reconcile_failed'
+
+    def __init__(self, journal, db, interval=5.0, batch_size=200):
+        super().__init__(interval)
+        self.journal = journal
+        self.db = db
+        self.batch_size = batch_size
+
+    def step(self):
+        self.journal.reconcile(self.db, self.batch_size)
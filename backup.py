@@ -0,0 +1,193 @@
+# File: backup.py
+
+import argparse
+import glob
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import time
+from datetime import datetime
+
+from face_gallery import FaceGallery
+from maintenance import ARCHIVE_DIR
+
+BACKUP_DIR = 'backups'
+MANIFEST = 'manifest.json'
+DATABASE_MEMBER = 'students.db'
+GALLERY_MEMBER = 'known_faces.pkl'
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_database(source, target, pages=256, sleep=0.005):
+    # Online backup API: copies `pages` pages at a time and releases the read lock in between,
+    # so check-ins keep writing while the copy runs. Pages changed mid-copy are picked up again.
+    if not os.path.exists(source):
+        # sqlite3.connect would create an empty database and we would back that up instead
+        raise FileNotFoundError(f"Database not found: {source}")
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst, pages=pages, sleep=sleep)
+    finally:
+        dst.close()
+        src.close()
+
+
+def copy_gallery(data_file, target):
+    # Loading pins one snapshot (pickle plus its memory-mapped sidecar); saving rewrites it under `target`
+    gallery = FaceGallery.load(data_file)
+    gallery.save(target)
+    return gallery.version
+
+
+def create_backup(db_name='students.db', data_file='known_faces.pkl', output_dir=BACKUP_DIR,
+                  archive_dir=ARCHIVE_DIR, pages=256):
+    if db_name.startswith(('postgres://', 'postgresql://')):
+        raise ValueError("PostgreSQL databases are backed up with pg_dump; only the SQLite file is handled here")
+
+    os.makedirs(output_dir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    archive = os.path.join(output_dir, f"backup-{stamp}.tar.gz")
+    start = time.perf_counter()
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        # Gallery before database: the restored face_changes log then holds every change the gallery has
+        # applied, and anything enrolled in between is replayed on the next sync instead of being skipped
+        gallery_version = copy_gallery(data_file, os.path.join(tmp, GALLERY_MEMBER))
+        copy_database(db_name, os.path.join(tmp, DATABASE_MEMBER), pages)
+        for term_db in sorted(glob.glob(os.path.join(archive_dir, 'attendance_*.db'))):
+            os.makedirs(os.path.join(tmp, 'archive'), exist_ok=True)
+            copy_database(term_db, os.path.join(tmp, 'archive', os.path.basename(term_db)), pages)
+
+        members = sorted(os.path.relpath(path, tmp).replace(os.sep, '/')
+                         for path in glob.glob(os.path.join(tmp, '**', '*'), recursive=True) if os.path.isfile(path))
+        manifest = {
+            'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'source_db': db_name,
+            'gallery_version': gallery_version,
+            'files': {member: {'sha256': file_sha256(os.path.join(tmp, member)),
+                               'bytes': os.path.getsize(os.path.join(tmp, member))} for member in members},
+        }
+
+        with tarfile.open(f"{archive}.tmp", 'w:gz') as tar:
+            body = json.dumps(manifest, indent=2).encode()
+            info = tarfile.TarInfo(MANIFEST)
+            info.size = len(body)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(body))
+            for member in members:
+                tar.add(os.path.join(tmp, member), arcname=member)
+    os.replace(f"{archive}.tmp", archive)
+
+    with open(f"{archive}.sha256", 'w') as f:
+        f.write(f"{file_sha256(archive)}  {os.path.basename(archive)}\n")
+    return archive, round(time.perf_counter() - start, 3)
+
+
+def _extract(archive, target_dir):
+    with tarfile.open(archive, 'r:gz') as tar:
+        tar.extractall(target_dir, filter='data')
+    with open(os.path.join(target_dir, MANIFEST)) as f:
+        return json.load(f)
+
+
+def verify_backup(archive):
+    # Returns (ok, problems): archive checksum, per-file checksums, SQLite integrity and a gallery load
+    problems = []
+    checksum_file = f"{archive}.sha256"
+    if os.path.exists(checksum_file):
+        with open(checksum_file) as f:
+            expected = f.read().split()[0]
+        if file_sha256(archive) != expected:
+            return False, ["archive checksum mismatch"]
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        try:
+            manifest = _extract(archive, tmp)
+        except (tarfile.TarError, OSError, ValueError) as e:
+            return False, [f"unreadable archive: {e}"]
+
+        for member, info in manifest['files'].items():
+            path = os.path.join(tmp, member)
+            if not os.path.exists(path):
+                problems.append(f"{member}: missing")
+            elif file_sha256(path) != info['sha256']:
+                problems.append(f"{member}: checksum mismatch")
+
+        for member in manifest['files']:
+            if member.endswith('.db') and os.path.exists(os.path.join(tmp, member)):
+                conn = sqlite3.connect(os.path.join(tmp, member))
+                result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+                conn.close()
+                if result != 'ok':
+                    problems.append(f"{member}: integrity check failed: {result}")
+
+        try:
+            gallery = FaceGallery.load(os.path.join(tmp, GALLERY_MEMBER))
+            if gallery.version != manifest['gallery_version']:
+                problems.append("known_faces.pkl: gallery version does not match the manifest")
+            del gallery
+        except Exception as e:
+            problems.append(f"known_faces.pkl: cannot be loaded: {e}")
+    return not problems, problems
+
+
+def restore_backup(archive, db_name='students.db', data_file='known_faces.pkl', archive_dir=ARCHIVE_DIR, pages=256):
+    ok, problems = verify_backup(archive)
+    if not ok:
+        return False, "Backup failed verification: " + "; ".join(problems)
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        manifest = _extract(archive, tmp)
+        # Copied back through the backup API as well, so open connections see a consistent database
+        copy_database(os.path.join(tmp, DATABASE_MEMBER), db_name, pages)
+        copy_gallery(os.path.join(tmp, GALLERY_MEMBER), data_file)
+        for member in manifest['files']:
+            if member.startswith('archive/'):
+                os.makedirs(archive_dir, exist_ok=True)
+                copy_database(os.path.join(tmp, member), os.path.join(archive_dir, os.path.basename(member)), pages)
+    return True, f"Restored backup taken at {manifest['created_at']} (gallery version {manifest['gallery_version']})"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Back up, verify and restore the portal database and face gallery.')
+    parser.add_argument('--db', default=os.environ.get('STUDENT_PORTAL_DB', 'students.db'))
+    parser.add_argument('--data-file', default='known_faces.pkl')
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create')
+    create.add_argument('--output-dir', default=BACKUP_DIR)
+    create.add_argument('--pages', type=int, default=256, help='Pages copied per backup step')
+    verify = commands.add_parser('verify')
+    verify.add_argument('archive')
+    restore = commands.add_parser('restore')
+    restore.add_argument('archive')
+    args = parser.parse_args(argv)
+
+    if args.command == 'create':
+        archive, seconds = create_backup(args.db, args.data_file, args.output_dir, args.archive_dir, args.pages)
+        print(f"Wrote {archive} in {seconds}s")
+        return 0
+    if args.command == 'verify':
+        ok, problems = verify_backup(args.archive)
+        print("Backup OK" if ok else "\n".join(problems))
+        return 0 if ok else 1
+    ok, message = restore_backup(args.archive, args.db, args.data_file, args.archive_dir)
+    print(message)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
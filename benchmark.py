@@ -0,0 +1,205 @@
+# File: benchmark.py
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from database import Database
+
+IMAGE_SIZES = [(320, 240), (640, 480), (1280, 720)]
+GALLERY_SIZES = [100, 1000, 10000]
+SEMESTER_DAYS = 90
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'runs': len(samples),
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        'ops_per_sec': len(samples) / sum(samples) if sum(samples) else None,
+    }
+
+
+def time_call(func, runs, *args):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def synthetic_encodings(count, rng):
+    # Real encodings sit roughly on a sphere of radius ~0.5 in 128-d space
+    encodings = rng.normal(size=(count, 128))
+    encodings *= 0.5 / np.linalg.norm(encodings, axis=1, keepdims=True)
+    return list(encodings)
+
+
+def synthetic_frame(width, height, rng):
+    return rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+
+def bench_recognition(results, runs, seed):
+    from face_recognition_module import FaceRecognitionModule
+    from face_gallery import FaceGallery
+
+    rng = np.random.default_rng(seed)
+    module = FaceRecognitionModule(data_file=os.path.join(tempfile.gettempdir(), 'benchmark_faces.pkl'))
+
+    for width, height in IMAGE_SIZES:
+        frame = synthetic_frame(width, height, rng)
+        box = [(height // 4, 3 * width // 4, 3 * height // 4, width // 4)]
+        label = f"{width}x{height}"
+        results[f"recognition.detect[{label}]"] = time_call(module.detect_faces, runs, frame)
+        # Encode against a fixed box so the stage is timed even when nothing is detected
+        results[f"recognition.encode[{label}]"] = time_call(module.encode_faces, runs, frame, box)
+
+    probe = synthetic_encodings(1, rng)
+    for size in GALLERY_SIZES:
+        module.gallery = FaceGallery()
+        for i, encoding in enumerate(synthetic_encodings(size, rng)):
+            module.gallery.add(None, f"student_{i}", encoding)
+        results[f"recognition.match[gallery={size}]"] = time_call(module.match_faces, runs, probe)
+
+
+def generate_database(db_name, semesters=4, courses_per_semester=6, students_per_course=60,
+                      attendance_rate=0.85, seed=0):
+    rng = random.Random(seed)
+    db = Database(db_name)
+    password = db.hash_password('benchmark')
+    today = date.today()
+
+    for semester in range(semesters):
+        semester_start = today - timedelta(days=SEMESTER_DAYS * (semesters - semester))
+        for course_index in range(courses_per_semester):
+            course = f"S{semester + 1}-C{course_index + 1}"
+            db.add_course(course)
+            course_id = db.course_id(course)
+            with db.backend.transaction() as c:
+                for i in range(students_per_course):
+                    _add_generated_student(c, course, course_id, i, password, semester_start, attendance_rate, rng)
+    return db
+
+
+def _add_generated_student(c, course, course_id, i, password, semester_start, attendance_rate, rng):
+    username = f"{course}-student{i}"
+    user_id = c.insert('INSERT INTO users (username, password, is_admin) VALUES (?, ?, 0)', (username, password))
+    student_id = c.insert('''INSERT INTO students (user_id, name, email, course, student_id, register_no, academic_year)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                          (user_id, f"Student {course} {i}", f"{username.lower()}@srmist.edu.in", course,
+                           f"ID{user_id:06d}", f"RA{user_id:010d}", str(semester_start.year)))
+    c.execute('INSERT INTO student_courses (student_id, course_id) VALUES (?, ?)', (student_id, course_id))
+
+    # Events are written the way mark_attendance writes them: keyed by student and course id
+    rows = []
+    for day in range(SEMESTER_DAYS):
+        current = semester_start + timedelta(days=day)
+        if current.weekday() >= 5 or rng.random() > attendance_rate:
+            continue
+        in_time = f"{rng.randint(8, 9):02d}:{rng.randint(0, 59):02d}:00"
+        out_time = f"{rng.randint(15, 16):02d}:{rng.randint(0, 59):02d}:00"
+        rows.append((student_id, course_id, current.strftime("%Y-%m-%d"), "In", in_time))
+        rows.append((student_id, course_id, current.strftime("%Y-%m-%d"), "Out", out_time))
+    c.executemany('''INSERT INTO attendance_events (student_id, course_id, date, event_type, time, method)
+                     VALUES (?, ?, ?, ?, ?, 'face')''', rows)
+
+
+def bench_database(results, runs, seed, scale):
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = generate_database(os.path.join(tmp, 'benchmark.db'), students_per_course=60 * scale, seed=seed)
+        students = db.get_all_students()
+        course_names = db.get_all_courses()
+        # Real (course, day) pairs, so the report query is timed on days that have attendance to return
+        course_days = [(row['course_id'], row['date']) for row in
+                       db.backend.iter_rows('SELECT DISTINCT course_id, date FROM attendance_events')]
+
+        marks = []
+        for student in rng.sample(students, min(runs, len(students))):
+            start = time.perf_counter()
+            course_id = db.course_id(student['course'])
+            db.mark_attendance(student['id'], course_id, "In", "09:00:00")
+            db.mark_attendance(student['id'], course_id, "Out", "15:00:00")
+            marks.append((time.perf_counter() - start) / 2)
+        results['db.mark_attendance'] = summarize(marks)
+
+        terms = ['', 'Student', 'S1-C3', 'student42@', 'nomatch']
+        results['db.search_students'] = time_call(
+            lambda: db.search_students(rng.choice(terms), rng.choice([None] + course_names)), runs)
+        results['db.get_attendance_by_date'] = time_call(
+            lambda: db.get_attendance_by_date(*rng.choice(course_days)), runs)
+        db.close()
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            print(f"{name:45s} {current['p50_ms']:10.3f} ms  (new)")
+            continue
+        change = (current['p50_ms'] - previous['p50_ms']) / previous['p50_ms'] if previous['p50_ms'] else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:45s} {current['p50_ms']:10.3f} ms  {change:+8.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the recognition and attendance hot paths.')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the JSON results')
+    parser.add_argument('--baseline', help='Stored results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='Allowed p50 slowdown before a result counts as a regression (0.10 = 10%%)')
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--scale', type=int, default=1, help='Multiplier for generated students per course')
+    parser.add_argument('--skip-recognition', action='store_true', help='Only run the database benchmarks')
+    args = parser.parse_args(argv)
+
+    results = {}
+    if not args.skip_recognition:
+        bench_recognition(results, args.runs, args.seed)
+    bench_database(results, args.runs, args.seed, args.scale)
+
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'runs': args.runs,
+            'seed': args.seed,
+            'scale': args.scale,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+# File: credentials.py
+
+import argparse
+import base64
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+SCRYPT_DEFAULTS = {'n': 2 ** 14, 'r': 8, 'p': 1}
+PBKDF2_DEFAULTS = {'iterations': 600000}
+SALT_BYTES = 16
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class PasswordHasher:
+    # Stored hashes are self-describing: scrypt$n$r$p$salt$hash or pbkdf2_sha256$iterations$salt$hash.
+    # Plain 64-character hex strings are the old unsalted SHA-256 and are upgraded on the next login.
+    def __init__(self, algorithm='scrypt', **cost):
+        if algorithm not in ('scrypt', 'pbkdf2_sha256'):
+            raise ValueError(f"Unsupported algorithm: {algorithm}")
+        self.algorithm = algorithm
+        defaults = SCRYPT_DEFAULTS if algorithm == 'scrypt' else PBKDF2_DEFAULTS
+        self.cost = {key: int(cost.get(key, value)) for key, value in defaults.items()}
+
+    @classmethod
+    def from_env(cls):
+        # STUDENT_PORTAL_KDF="scrypt:n=32768,r=8,p=1" or "pbkdf2_sha256:iterations=900000"
+        spec = os.environ.get('STUDENT_PORTAL_KDF')
+        if not spec:
+            return cls()
+        algorithm, _, params = spec.partition(':')
+        cost = dict(item.split('=') for item in params.split(',') if item)
+        return cls(algorithm, **cost)
+
+    def spec(self):
+        return f"{self.algorithm}:" + ','.join(f"{key}={value}" for key, value in self.cost.items())
+
+    def _derive(self, algorithm, password, salt, cost):
+        if algorithm == 'scrypt':
+            n, r, p = cost
+            return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + (1 << 20), dklen=32)
+        (iterations,) = cost
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+
+    def hash(self, password):
+        salt = os.urandom(SALT_BYTES)
+        cost = tuple(self.cost.values())
+        digest = self._derive(self.algorithm, password, salt, cost)
+        return '$'.join([self.algorithm, *map(str, cost), _b64(salt), _b64(digest)])
+
+    def verify(self, password, encoded):
+        if '$' not in encoded:
+            legacy = hashlib.sha256(password.encode()).hexdigest()
+            return hmac.compare_digest(legacy, encoded)
+        algorithm, *fields = encoded.split('$')
+        *cost, salt, digest = fields
+        try:
+            derived = self._derive(algorithm, password, _unb64(salt), tuple(map(int, cost)))
+        except (ValueError, TypeError):
+            return False
+        return hmac.compare_digest(derived, _unb64(digest))
+
+    def needs_rehash(self, encoded):
+        return not encoded.startswith(f"{self.algorithm}$") or encoded.split('$')[1:-2] != list(map(str, self.cost.values()))
+
+    def dummy_verify(self):
+        # Unknown usernames cost the same as a wrong password, so logins don't reveal which users exist
+        self._derive(self.algorithm, 'dummy', b'\0' * SALT_BYTES, tuple(self.cost.values()))
+
+
+def calibrate(budget_ms=100.0, algorithm='scrypt', samples=3):
+    # Strongest cost whose median hash time stays within the login latency budget on this machine
+    hasher = PasswordHasher(algorithm, n=2 ** 12, iterations=50000)
+    best = None
+    while True:
+        timings = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            hasher.hash('calibration')
+            timings.append(time.perf_counter() - start)
+        median_ms = sorted(timings)[samples // 2] * 1000
+        if median_ms > budget_ms:
+            return best
+        best = (hasher.spec(), median_ms)
+        key = 'n' if algorithm == 'scrypt' else 'iterations'
+        hasher = PasswordHasher(algorithm, **{**hasher.cost, key: hasher.cost[key] * 2})
+
+
+class VerificationCache:
+    # Remembers recent successful logins as an HMAC of the password under a per-process key, so a student
+    # who logs in again (new tab, refreshed page) during a storm is checked without another KDF run.
+    # An entry is only honoured while the stored hash it was verified against is unchanged.
+    def __init__(self, ttl=300.0, size=4096):
+        self.ttl = ttl
+        self.size = size
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, username, password):
+        return hmac.new(self._key, f"{username}\0{password}".encode(), hashlib.sha256).digest()
+
+    def check(self, username, password, encoded):
+        with self._lock:
+            entry = self._entries.get(username)
+        if entry is None or entry[2] < time.monotonic() or entry[1] != encoded:
+            return False
+        return hmac.compare_digest(entry[0], self._digest(username, password))
+
+    def remember(self, username, password, encoded):
+        with self._lock:
+            self._entries[username] = (self._digest(username, password), encoded, time.monotonic() + self.ttl)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+class SessionSigner:
+    # Signed "user_id.expiry.signature" tokens; checking one on every Streamlit rerun is a single HMAC
+    def __init__(self, secret=None, ttl=8 * 3600):
+        # Without a configured secret, tokens are only valid until the server restarts
+        secret = secret or os.environ.get('STUDENT_PORTAL_SECRET')
+        self._secret = secret.encode() if secret else os.urandom(32)
+        self.ttl = ttl
+
+    def _sign(self, payload):
+        return _b64(hmac.new(self._secret, payload.encode(), hashlib.sha256).digest())
+
+    def issue(self, user_id):
+        payload = f"{user_id}.{int(time.time() + self.ttl)}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, token):
+        # Returns the user id, or None if the token is malformed, forged or expired
+        try:
+            user_id, expiry, signature = token.split('.')
+            if not hmac.compare_digest(signature, self._sign(f"{user_id}.{expiry}")) or int(expiry) < time.time():
+                return None
+            return int(user_id)
+        except (AttributeError, ValueError):
+            return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pick a password hashing cost for a login latency budget.')
+    parser.add_argument('--budget-ms', type=float, default=100.0)
+    parser.add_argument('--algorithm', choices=['scrypt', 'pbkdf2_sha256'], default='scrypt')
+    args = parser.parse_args(argv)
+
+    best = calibrate(args.budget_ms, args.algorithm)
+    if best is None:
+        print(f"Even the lowest cost is slower than {args.budget_ms} ms on this machine.")
+        return 1
+    spec, median_ms = best
+    print(f"{spec} hashes in {median_ms:.1f} ms")
+    print(f"Set STUDENT_PORTAL_KDF={spec}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
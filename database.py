@@ -1,211 +1,580 @@
 # File: database.py
 
-import sqlite3
-import hashlib
-from datetime import datetime
+from datetime import datetime, timedelta
+from time import monotonic
+import numpy as np
+from metrics import metrics
+from storage import IntegrityError, make_backend, make_read_backend
+from credentials import PasswordHasher, VerificationCache
+
+COURSE_CACHE_SECONDS = 60.0
 
 class Database:
-    def __init__(self, db_name='students.db'):
-        self.conn = sqlite3.connect(db_name)
-        self.conn.row_factory = sqlite3.Row
+    def __init__(self, db_name='students.db', backend=None, hasher=None, read_db=None, staleness=None):
+        # db_name is a SQLite path or a postgresql:// DSN; pass backend to share an existing pool.
+        # With read_db or staleness set, report queries go to a separate read-only pool (a replica DSN or
+        # a SQLite snapshot at most `staleness` seconds old) and never queue behind check-in writes.
+        self.db_name = db_name
+        self.backend = backend or make_backend(db_name)
+        self.reports = self.backend
+        self.hasher = hasher or PasswordHasher.from_env()
+        self.login_cache = VerificationCache()
+        # Called with a user id (or None for everyone) whenever a user's role or student record changes
+        self.user_listeners = []
+        # Course name -> id, reloaded on a miss and at most COURSE_CACHE_SECONDS old
+        self._course_ids = {}
+        self._course_ids_loaded = 0.0
         self.create_tables()
+        if read_db or staleness is not None:
+            self.reports = make_read_backend(db_name, read_db, 60.0 if staleness is None else staleness)
 
     def create_tables(self):
-        c = self.conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS users
-                     (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT, is_admin INTEGER)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS students
-                     (id INTEGER PRIMARY KEY, user_id INTEGER, name TEXT, email TEXT, course TEXT,
-                     resume_path TEXT, photo_path TEXT, student_id TEXT, register_no TEXT, academic_year TEXT,
-                     FOREIGN KEY (user_id) REFERENCES users(id))''')
-        c.execute('''CREATE TABLE IF NOT EXISTS pending_registrations
-                     (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT, name TEXT, email TEXT, course TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS courses
-                     (id INTEGER PRIMARY KEY, name TEXT UNIQUE)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS attendance
-                     (id INTEGER PRIMARY KEY, student_id INTEGER, course_id INTEGER, date TEXT, 
-                     in_time TEXT, out_time TEXT,
-                     FOREIGN KEY (student_id) REFERENCES students(id),
-                     FOREIGN KEY (course_id) REFERENCES courses(id))''')
-        self.conn.commit()
+        pk = self.backend.primary_key
+        with self.backend.transaction() as c:
+            c.execute(f'''CREATE TABLE IF NOT EXISTS users
+                         (id {pk}, username TEXT UNIQUE, password TEXT, is_admin INTEGER)''')
+            c.execute(f'''CREATE TABLE IF NOT EXISTS students
+                         (id {pk}, user_id INTEGER, name TEXT, email TEXT, course TEXT,
+                         resume_path TEXT, photo_path TEXT, student_id TEXT, register_no TEXT, academic_year TEXT,
+                         FOREIGN KEY (user_id) REFERENCES users(id))''')
+            c.execute(f'''CREATE TABLE IF NOT EXISTS pending_registrations
+                         (id {pk}, username TEXT UNIQUE, password TEXT, name TEXT, email TEXT, course TEXT)''')
+            c.execute(f'''CREATE TABLE IF NOT EXISTS courses
+                         (id {pk}, name TEXT UNIQUE)''')
+            c.execute(f'''CREATE TABLE IF NOT EXISTS attendance
+                         (id {pk}, student_id INTEGER, course_id INTEGER, date TEXT,
+                         in_time TEXT, out_time TEXT,
+                         FOREIGN KEY (student_id) REFERENCES students(id),
+                         FOREIGN KEY (course_id) REFERENCES courses(id))''')
+            # Append-only log of gallery edits; the id is the gallery version replicas sync up to
+            c.execute(f'''CREATE TABLE IF NOT EXISTS face_changes
+                         (id {pk}, op TEXT, template_id INTEGER, name TEXT, student_id INTEGER,
+                         source TEXT, encoding {self.backend.blob}, created_at TEXT)''')
+            # Profile photos waiting to be encoded into the gallery by the enrolment refresher
+            c.execute(f'''CREATE TABLE IF NOT EXISTS enrolment_queue
+                         (id {pk}, student_id INTEGER, name TEXT, photo_path TEXT, replaced_path TEXT,
+                         status TEXT, created_at TEXT, processed_at TEXT)''')
+            # Every In/Out mark is a pure insert here; days and sessions are derived when read
+            c.execute(f'''CREATE TABLE IF NOT EXISTS attendance_events
+                         (id {pk}, student_id INTEGER, course_id INTEGER, date TEXT, event_type TEXT,
+                         time TEXT, method TEXT, created_at TEXT)''')
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_attendance_events_day
+                         ON attendance_events (course_id, date, student_id)''')
+            c.execute(f'''{self.backend.create_view} attendance_days AS
+                         SELECT student_id, course_id, date,
+                                MIN(CASE WHEN event_type = 'In' THEN time END) AS in_time,
+                                MAX(CASE WHEN event_type = 'Out' THEN time END) AS out_time,
+                                COUNT(*) AS events
+                         FROM attendance_events GROUP BY student_id, course_id, date''')
+            # Which courses each student takes; students.course stays as the student's own (primary) choice
+            c.execute('''CREATE TABLE IF NOT EXISTS student_courses
+                         (student_id INTEGER, course_id INTEGER, PRIMARY KEY (student_id, course_id),
+                         FOREIGN KEY (student_id) REFERENCES students(id),
+                         FOREIGN KEY (course_id) REFERENCES courses(id))''')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_student_courses_course ON student_courses (course_id)')
+            # Timetabled class meetings; closed_at is set once open Ins have been auto-closed at end_time
+            c.execute(f'''CREATE TABLE IF NOT EXISTS course_sessions
+                         (id {pk}, course_id INTEGER, date TEXT, start_time TEXT, end_time TEXT, room TEXT,
+                         closed_at TEXT, FOREIGN KEY (course_id) REFERENCES courses(id))''')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_course_sessions_date ON course_sessions (date, start_time)')
+            c.execute('CREATE TABLE IF NOT EXISTS schema_migrations (name TEXT PRIMARY KEY, applied_at TEXT)')
+            self._backfill_legacy_attendance(c)
+            self._migrate_integer_course_ids(c)
+            self._migrate_session_columns(c)
+
+    def _migration_applied(self, c, name):
+        c.execute('SELECT 1 FROM schema_migrations WHERE name = ?', (name,))
+        return c.fetchone() is not None
+
+    def _record_migration(self, c, name):
+        c.execute('INSERT INTO schema_migrations (name, applied_at) VALUES (?, ?)',
+                  (name, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+    def _backfill_legacy_attendance(self, c):
+        # Copies the old one-row-per-day attendance table into attendance_events, once. Databases that
+        # already went through the integer id migration were backfilled before this was recorded; their
+        # events may since have been archived, so an empty attendance_events says nothing there.
+        if self._migration_applied(c, 'legacy_attendance_backfill'):
+            return
+        if not self._migration_applied(c, 'integer_course_ids'):
+            c.execute('''INSERT INTO attendance_events (student_id, course_id, date, event_type, time, method)
+                         SELECT student_id, course_id, date, 'In', in_time, 'legacy' FROM attendance
+                         WHERE in_time IS NOT NULL AND NOT EXISTS (SELECT 1 FROM attendance_events)
+                         UNION ALL
+                         SELECT student_id, course_id, date, 'Out', out_time, 'legacy' FROM attendance
+                         WHERE out_time IS NOT NULL AND NOT EXISTS (SELECT 1 FROM attendance_events)''')
+        self._record_migration(c, 'legacy_attendance_backfill')
+
+    def _migrate_integer_course_ids(self, c):
+        # Attendance used to be keyed by the student's *user* id and the course *name*; rewrite both to
+        # students.id and courses.id, and turn students.course into student_courses rows. Runs once.
+        if self._migration_applied(c, 'integer_course_ids'):
+            return
+
+        names = set()
+        c.execute('SELECT DISTINCT course FROM students WHERE course IS NOT NULL')
+        names.update(row[0] for row in c.fetchall())
+        for table in ('attendance_events', 'attendance'):
+            c.execute(f'SELECT DISTINCT course_id FROM {table}')
+            names.update(row[0] for row in c.fetchall() if isinstance(row[0], str))
+        c.execute('SELECT name FROM courses')
+        names.difference_update(row[0] for row in c.fetchall())
+        c.executemany('INSERT INTO courses (name) VALUES (?)', [(name,) for name in sorted(names)])
+
+        c.execute('SELECT id, name FROM courses')
+        course_ids = {row['name']: row['id'] for row in c.fetchall()}
+        c.execute('SELECT id, user_id, course FROM students')
+        students = c.fetchall()
+        student_of_user = {row['user_id']: row['id'] for row in students}
+        for row in students:
+            if row['course'] is not None:
+                self._add_membership(c, row['id'], course_ids[row['course']])
+
+        for table in ('attendance_events', 'attendance'):
+            c.execute(f'SELECT id, student_id, course_id FROM {table}')
+            c.executemany(f'UPDATE {table} SET student_id = ?, course_id = ? WHERE id = ?',
+                          [(student_of_user.get(row['student_id'], row['student_id']),
+                            course_ids.get(row['course_id'], row['course_id']), row['id']) for row in c.fetchall()])
+        self._record_migration(c, 'integer_course_ids')
+
+    def _migrate_session_columns(self, c):
+        # Events marked during a timetabled session carry its id and a late/early flag
+        if self._migration_applied(c, 'attendance_session_columns'):
+            return
+        c.execute('ALTER TABLE attendance_events ADD COLUMN session_id INTEGER')
+        c.execute('ALTER TABLE attendance_events ADD COLUMN flag TEXT')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_attendance_events_session ON attendance_events (session_id, student_id)')
+        self._record_migration(c, 'attendance_session_columns')
+
+    def _add_membership(self, c, student_id, course_id):
+        c.execute('''INSERT INTO student_courses (student_id, course_id) SELECT ?, ?
+                     WHERE NOT EXISTS (SELECT 1 FROM student_courses WHERE student_id = ? AND course_id = ?)''',
+                  (student_id, course_id, student_id, course_id))
+
+    def _user_changed(self, user_id=None):
+        for listener in self.user_listeners:
+            listener(user_id)
 
     def hash_password(self, password):
-        return hashlib.sha256(str.encode(password)).hexdigest()
+        return self.hasher.hash(password)
 
     def check_user(self, username, password):
-        c = self.conn.cursor()
-        c.execute('SELECT * FROM users WHERE username=? AND password=?', (username, self.hash_password(password)))
-        return c.fetchone()
+        with metrics.timer('login'):
+            with self.backend.transaction() as c:
+                c.execute('SELECT * FROM users WHERE username=?', (username,))
+                user = c.fetchone()
+            if user is None:
+                self.hasher.dummy_verify()
+                return None
+            if self.login_cache.check(username, password, user['password']):
+                metrics.inc('logins', result='cached')
+                return user
+            if not self.hasher.verify(password, user['password']):
+                metrics.inc('logins', result='rejected')
+                return None
+
+            # Old unsalted hashes and outdated costs are upgraded while the plain password is at hand
+            if self.hasher.needs_rehash(user['password']):
+                with self.backend.transaction() as c:
+                    c.execute('UPDATE users SET password=? WHERE id=?', (self.hash_password(password), user['id']))
+                    c.execute('SELECT * FROM users WHERE id=?', (user['id'],))
+                    user = c.fetchone()
+                metrics.inc('password_rehashes')
+            self.login_cache.remember(username, password, user['password'])
+            metrics.inc('logins', result='verified')
+            return user
 
     def is_admin(self, user_id):
-        c = self.conn.cursor()
-        c.execute('SELECT is_admin FROM users WHERE id=?', (user_id,))
-        result = c.fetchone()
+        with self.backend.transaction() as c:
+            c.execute('SELECT is_admin FROM users WHERE id=?', (user_id,))
+            result = c.fetchone()
         return result['is_admin'] if result else False
 
+    def set_admin(self, user_id, is_admin):
+        with self.backend.transaction() as c:
+            c.execute('UPDATE users SET is_admin=? WHERE id=?', (1 if is_admin else 0, user_id))
+        self._user_changed(user_id)
+
     def get_all_courses(self):
-        c = self.conn.cursor()
-        c.execute('SELECT name FROM courses')
-        return [row['name'] for row in c.fetchall()]
+        with self.backend.transaction() as c:
+            c.execute('SELECT name FROM courses')
+            return [row['name'] for row in c.fetchall()]
+
+    def course_ids(self, refresh=False):
+        if refresh or monotonic() - self._course_ids_loaded > COURSE_CACHE_SECONDS:
+            with self.backend.transaction() as c:
+                c.execute('SELECT id, name FROM courses')
+                self._course_ids = {row['name']: row['id'] for row in c.fetchall()}
+            self._course_ids_loaded = monotonic()
+        return self._course_ids
+
+    def course_id(self, course_name):
+        course_id = self.course_ids().get(course_name)
+        if course_id is None:
+            course_id = self.course_ids(refresh=True).get(course_name)
+        return course_id
     
     def get_all_attendance(self):
-        c = self.conn.cursor()
         query = """
-        SELECT students.name, courses.name AS course, attendance.date, 
-            attendance.in_time, attendance.out_time
-        FROM attendance 
-        INNER JOIN students ON attendance.student_id = students.id
-        INNER JOIN courses ON attendance.course_id = courses.id
-        ORDER BY attendance.date DESC, students.name
+        SELECT students.name, courses.name AS course, attendance_days.date, 
+            attendance_days.in_time, attendance_days.out_time
+        FROM attendance_days 
+        INNER JOIN students ON attendance_days.student_id = students.id
+        INNER JOIN courses ON attendance_days.course_id = courses.id
+        ORDER BY attendance_days.date DESC, students.name
         """
-        c.execute(query)
-        return [dict(row) for row in c.fetchall()]
+        # Full history can be large; stream it instead of materialising the raw rows first
+        return [dict(row) for row in self.reports.iter_rows(query)]
 
     def search_students(self, search_query='', course_filter=None):
-        c = self.conn.cursor()
         query = '''SELECT * FROM students WHERE 
                 (name LIKE ? OR email LIKE ?)'''
         params = [f'%{search_query}%', f'%{search_query}%']
         
         if course_filter:
-            query += ' AND course = ?'
+            query += ''' AND id IN (SELECT student_courses.student_id FROM student_courses
+                         INNER JOIN courses ON courses.id = student_courses.course_id WHERE courses.name = ?)'''
             params.append(course_filter)
         
-        c.execute(query, params)
-        return [dict(row) for row in c.fetchall()]
+        with self.reports.transaction() as c:
+            c.execute(query, params)
+            return [dict(row) for row in c.fetchall()]
 
     def register_student(self, username, password, name, email, course):
         if not email.endswith('@srmist.edu.in'):
             return False, "Please use an email address with the domain srmist.edu.in"
         
-        c = self.conn.cursor()
         try:
-            c.execute('INSERT INTO pending_registrations (username, password, name, email, course) VALUES (?, ?, ?, ?, ?)',
-                      (username, self.hash_password(password), name, email, course))
-            self.conn.commit()
+            with self.backend.transaction() as c:
+                c.execute('INSERT INTO pending_registrations (username, password, name, email, course) VALUES (?, ?, ?, ?, ?)',
+                          (username, self.hash_password(password), name, email, course))
             return True, "Registration submitted successfully! Please wait for admin approval."
-        except sqlite3.IntegrityError:
+        except IntegrityError:
             return False, "Username already exists. Please choose a different username."
 
     def get_pending_registrations(self):
-        c = self.conn.cursor()
-        c.execute('SELECT * FROM pending_registrations')
-        return c.fetchall()
+        with self.backend.transaction() as c:
+            c.execute('SELECT * FROM pending_registrations')
+            return c.fetchall()
 
     def approve_registration(self, registration_id):
-        c = self.conn.cursor()
-        c.execute('SELECT * FROM pending_registrations WHERE id = ?', (registration_id,))
-        registration = c.fetchone()
-        
+        with self.backend.transaction() as c:
+            c.execute('SELECT * FROM pending_registrations WHERE id = ?', (registration_id,))
+            registration = c.fetchone()
+            
+            if registration:
+                user_id = c.insert('INSERT INTO users (username, password, is_admin) VALUES (?, ?, 0)',
+                                   (registration['username'], registration['password']))
+                student_id = c.insert('INSERT INTO students (user_id, name, email, course) VALUES (?, ?, ?, ?)',
+                                      (user_id, registration['name'], registration['email'], registration['course']))
+                c.execute('SELECT id FROM courses WHERE name = ?', (registration['course'],))
+                course = c.fetchone()
+                if course:
+                    self._add_membership(c, student_id, course['id'])
+                c.execute('DELETE FROM pending_registrations WHERE id = ?', (registration_id,))
         if registration:
-            c.execute('INSERT INTO users (username, password, is_admin) VALUES (?, ?, 0)',
-                      (registration['username'], registration['password']))
-            user_id = c.lastrowid
-            c.execute('INSERT INTO students (user_id, name, email, course) VALUES (?, ?, ?, ?)',
-                      (user_id, registration['name'], registration['email'], registration['course']))
-            c.execute('DELETE FROM pending_registrations WHERE id = ?', (registration_id,))
-            self.conn.commit()
+            self._user_changed(user_id)
 
     def add_course(self, course_name):
-        c = self.conn.cursor()
         try:
-            c.execute('INSERT INTO courses (name) VALUES (?)', (course_name,))
-            self.conn.commit()
+            with self.backend.transaction() as c:
+                c.execute('INSERT INTO courses (name) VALUES (?)', (course_name,))
+            self.course_ids(refresh=True)
             return True
-        except sqlite3.IntegrityError:
+        except IntegrityError:
             return False
 
     def delete_course(self, course_name):
-        c = self.conn.cursor()
-        c.execute('DELETE FROM courses WHERE name = ?', (course_name,))
-        self.conn.commit()
+        with self.backend.transaction() as c:
+            c.execute('DELETE FROM student_courses WHERE course_id IN (SELECT id FROM courses WHERE name = ?)',
+                      (course_name,))
+            c.execute('DELETE FROM course_sessions WHERE course_id IN (SELECT id FROM courses WHERE name = ?)',
+                      (course_name,))
+            c.execute('DELETE FROM courses WHERE name = ?', (course_name,))
+        self.course_ids(refresh=True)
+        self._user_changed()
+
+    def enrol_student(self, student_id, course_id):
+        with self.backend.transaction() as c:
+            self._add_membership(c, student_id, course_id)
+            c.execute('SELECT user_id FROM students WHERE id = ?', (student_id,))
+            student = c.fetchone()
+        if student:
+            self._user_changed(student['user_id'])
+
+    def unenrol_student(self, student_id, course_id):
+        with self.backend.transaction() as c:
+            c.execute('DELETE FROM student_courses WHERE student_id = ? AND course_id = ?', (student_id, course_id))
+            c.execute('SELECT user_id FROM students WHERE id = ?', (student_id,))
+            student = c.fetchone()
+        if student:
+            self._user_changed(student['user_id'])
 
     def get_all_students(self):
-        c = self.conn.cursor()
-        c.execute('SELECT * FROM students')
-        return [dict(row) for row in c.fetchall()]
+        with self.backend.transaction() as c:
+            c.execute('SELECT * FROM students')
+            return [dict(row) for row in c.fetchall()]
 
     def get_student(self, user_id):
-        c = self.conn.cursor()
-        c.execute('SELECT * FROM students WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
+        with self.backend.transaction() as c:
+            c.execute('SELECT * FROM students WHERE user_id = ?', (user_id,))
+            result = c.fetchone()
         return dict(result) if result else None
 
-    def update_student(self, user_id, name, email, course, student_id, register_no, academic_year, resume_path, photo_path):
-        c = self.conn.cursor()
-        c.execute('''UPDATE students SET name=?, email=?, course=?, student_id=?, register_no=?, academic_year=?, 
-                    resume_path=?, photo_path=? WHERE user_id=?''', 
-                    (name, email, course, student_id, register_no, academic_year, resume_path, photo_path, user_id))
-        self.conn.commit()
+    def update_student(self, user_id, name, email, course, student_id, register_no, academic_year, resume_path, photo_path,
+                       photo_uploaded=False):
+        # photo_uploaded: a new file was written, possibly over the same path as the old one
+        with self.backend.transaction() as c:
+            c.execute('SELECT id, photo_path, course FROM students WHERE user_id = ?', (user_id,))
+            current = c.fetchone()
+            c.execute('''UPDATE students SET name=?, email=?, course=?, student_id=?, register_no=?, academic_year=?, 
+                        resume_path=?, photo_path=? WHERE user_id=?''', 
+                        (name, email, course, student_id, register_no, academic_year, resume_path, photo_path, user_id))
+            if current and course != current['course']:
+                # The student's own course choice moves their membership; courses added by an admin stay
+                c.execute('''DELETE FROM student_courses WHERE student_id = ? AND course_id IN
+                             (SELECT id FROM courses WHERE name = ?)''', (current['id'], current['course']))
+                c.execute('SELECT id FROM courses WHERE name = ?', (course,))
+                new_course = c.fetchone()
+                if new_course:
+                    self._add_membership(c, current['id'], new_course['id'])
+            if current and photo_path and (photo_uploaded or photo_path != current['photo_path']):
+                self._queue_enrolment(c, current['id'], name, photo_path, current['photo_path'])
+        self._user_changed(user_id)
+
+    def _queue_enrolment(self, c, student_id, name, photo_path, replaced_path):
+        c.execute('''INSERT INTO enrolment_queue (student_id, name, photo_path, replaced_path, status, created_at)
+                     VALUES (?, ?, ?, ?, 'pending', ?)''',
+                  (student_id, name, photo_path, replaced_path, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+    def get_pending_enrolments(self, limit=20):
+        # Only the newest upload per student matters; older pending ones are superseded
+        with self.backend.transaction() as c:
+            c.execute('''UPDATE enrolment_queue SET status = 'superseded'
+                         WHERE status = 'pending' AND id NOT IN
+                         (SELECT MAX(id) FROM enrolment_queue WHERE status = 'pending' GROUP BY student_id)''')
+            c.execute("SELECT * FROM enrolment_queue WHERE status = 'pending' ORDER BY id LIMIT ?", (limit,))
+            return [dict(row) for row in c.fetchall()]
+
+    def finish_enrolment(self, enrolment_id, status):
+        with self.backend.transaction() as c:
+            c.execute('UPDATE enrolment_queue SET status = ?, processed_at = ? WHERE id = ?',
+                      (status, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), enrolment_id))
 
     def delete_student(self, student_id):
-        c = self.conn.cursor()
-        c.execute('DELETE FROM students WHERE id = ?', (student_id,))
-        self.conn.commit()
+        with self.backend.transaction() as c:
+            c.execute('SELECT user_id FROM students WHERE id = ?', (student_id,))
+            student = c.fetchone()
+            c.execute('DELETE FROM student_courses WHERE student_id = ?', (student_id,))
+            c.execute('DELETE FROM students WHERE id = ?', (student_id,))
+        if student:
+            self._user_changed(student['user_id'])
 
     def get_student_courses(self, user_id):
-        c = self.conn.cursor()
-        c.execute('SELECT course FROM students WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
-        return [result['course']] if result else []
-
-    def mark_attendance(self, student_id, course_id, attendance_type, time, is_manual=False):
-        c = self.conn.cursor()
-        today = datetime.now().strftime("%Y-%m-%d")
-        
-        c.execute("SELECT * FROM attendance WHERE student_id = ? AND course_id = ? AND date = ?", 
-                  (student_id, course_id, today))
-        existing_record = c.fetchone()
-        
-        if existing_record:
-            if attendance_type == "In":
-                return False, "Attendance already marked for today"
-            elif attendance_type == "Out":
-                in_time = datetime.strptime(existing_record['in_time'], "%H:%M:%S")
-                out_time = datetime.strptime(time, "%H:%M:%S")
-                if out_time <= in_time:
-                    return False, "Out time cannot be earlier than or equal to In time"
-                c.execute("UPDATE attendance SET out_time = ? WHERE id = ?", (time, existing_record['id']))
-        else:
-            if attendance_type == "In":
-                c.execute("INSERT INTO attendance (student_id, course_id, date, in_time) VALUES (?, ?, ?, ?)",
-                          (student_id, course_id, today, time))
-            else:
-                return False, "Cannot mark Out without marking In first"
-        
-        self.conn.commit()
+        with self.backend.transaction() as c:
+            c.execute('''SELECT courses.id, courses.name FROM students
+                         INNER JOIN student_courses ON student_courses.student_id = students.id
+                         INNER JOIN courses ON courses.id = student_courses.course_id
+                         WHERE students.user_id = ? ORDER BY courses.name''', (user_id,))
+            return [{'id': row['id'], 'name': row['name']} for row in c.fetchall()]
+
+    def mark_attendance(self, student_id, course_id, attendance_type, time, is_manual=False, session_id=None, flag=None):
+        # A pure append: repeated Ins (re-entry) and Outs are all kept and paired up by get_sessions.
+        # session_id/flag come from the timetable when the mark falls inside a scheduled session.
+        method = 'manual' if is_manual else 'face'
+        with metrics.timer('db_write'):
+            with self.backend.transaction() as c:
+                self._append_event(c, student_id, course_id, datetime.now().strftime("%Y-%m-%d"),
+                                   attendance_type, time, method, session_id, flag)
+        metrics.inc('attendance_marks', result='marked', method=method)
         return True, "Attendance marked successfully"
 
+    def _append_event(self, c, student_id, course_id, date, attendance_type, time, method, session_id=None, flag=None):
+        c.execute('''INSERT INTO attendance_events (student_id, course_id, date, event_type, time, method, created_at,
+                     session_id, flag) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                  (student_id, course_id, date, attendance_type, time, method,
+                   datetime.now().strftime("%Y-%m-%d %H:%M:%S"), session_id, flag))
+
+    def replay_attendance(self, entries):
+        # Journaled kiosk marks, applied in one transaction. An event already stored for the same
+        # (student, course, date, type) at the same time is a duplicate; an Out with no In that day a conflict.
+        results = []
+        with metrics.timer('db_write'):
+            with self.backend.transaction() as c:
+                for entry in entries:
+                    results.append(self._replay_mark(c, entry))
+        return results
+
+    def _replay_mark(self, c, entry):
+        if entry.get('version', 1) < 2 and isinstance(entry['course_id'], str):
+            # Journaled before attendance was keyed by ids: the course is a name and the student a user id
+            c.execute('SELECT id FROM students WHERE user_id = ?', (entry['student_id'],))
+            student = c.fetchone()
+            if student is None:
+                return 'conflict', "No student record for the journaled user"
+            entry = {**entry, 'student_id': student['id'], 'course_id': self.course_id(entry['course_id'])}
+        c.execute('''SELECT event_type, time FROM attendance_events
+                     WHERE student_id = ? AND course_id = ? AND date = ?''',
+                  (entry['student_id'], entry['course_id'], entry['date']))
+        events = {(row['event_type'], row['time']) for row in c.fetchall()}
+
+        if (entry['type'], entry['time']) in events:
+            return 'duplicate', None
+        if entry['type'] == "Out" and not any(t == "In" and time < entry['time'] for t, time in events):
+            return 'conflict', "Out without an earlier In"
+        self._append_event(c, entry['student_id'], entry['course_id'], entry['date'], entry['type'],
+                           entry['time'], entry.get('method', 'face'), entry.get('session_id'), entry.get('flag'))
+        return 'applied', None
+
     def get_attendance(self, student_id, course_id):
-        c = self.conn.cursor()
-        c.execute("""SELECT date, in_time, out_time 
-                     FROM attendance 
-                     WHERE student_id = ? AND course_id = ? 
-                     ORDER BY date DESC""", (student_id, course_id))
-        return c.fetchall()
+        with self.backend.transaction() as c:
+            c.execute("""SELECT date, in_time, out_time 
+                         FROM attendance_days 
+                         WHERE student_id = ? AND course_id = ? 
+                         ORDER BY date DESC""", (student_id, course_id))
+            return c.fetchall()
+
+    def get_sessions(self, course_id, date, student_id=None):
+        # Pairs each In with the next Out of the same student/course/day. A second In before an Out
+        # leaves the first session open; a later Out with no In extends the previous session.
+        query = """SELECT student_id, event_type, time FROM attendance_events
+                   WHERE course_id = ? AND date = ?"""
+        params = [course_id, date]
+        if student_id is not None:
+            query += " AND student_id = ?"
+            params.append(student_id)
+        query += " ORDER BY student_id, time, id"
+
+        sessions = {}
+        for event in self.reports.iter_rows(query, params):
+            student_sessions = sessions.setdefault(event['student_id'], [])
+            if event['event_type'] == "In":
+                student_sessions.append([event['time'], None])
+            elif student_sessions:
+                student_sessions[-1][1] = event['time']
+        return {student: [tuple(session) for session in student_sessions]
+                for student, student_sessions in sessions.items()}
+
+    @staticmethod
+    def presence(sessions):
+        # Total time inside across closed sessions, or None if the student never checked out
+        closed = [(datetime.strptime(out_time, "%H:%M:%S") - datetime.strptime(in_time, "%H:%M:%S"))
+                  for in_time, out_time in sessions if out_time]
+        return sum(closed, timedelta()) if closed else None
 
     def get_attendance_by_date(self, course_id, date):
-        c = self.conn.cursor()
-        c.execute("""SELECT students.name, students.course AS department, 
-                     attendance.in_time, attendance.out_time
-                     FROM students 
-                     INNER JOIN attendance ON students.id = attendance.student_id 
-                     WHERE attendance.course_id = ? AND attendance.date = ?""", (course_id, date))
-        records = c.fetchall()
+        with self.reports.transaction() as c:
+            c.execute("""SELECT students.id, students.name, students.course AS department, 
+                         attendance_days.in_time, attendance_days.out_time
+                         FROM students 
+                         INNER JOIN attendance_days ON students.id = attendance_days.student_id 
+                         WHERE attendance_days.course_id = ? AND attendance_days.date = ?""", (course_id, date))
+            records = c.fetchall()
+        sessions = self.get_sessions(course_id, date)
         
         result = []
         for record in records:
-            in_time = datetime.strptime(record['in_time'], "%H:%M:%S") if record['in_time'] else None
-            out_time = datetime.strptime(record['out_time'], "%H:%M:%S") if record['out_time'] else None
-            
-            if in_time and out_time:
-                duration = str(out_time - in_time)
-            else:
-                duration = "N/A"
-            
-            result.append(record + (duration,))
+            duration = self.presence(sessions.get(record['id'], []))
+            result.append(tuple(record)[1:] + (str(duration) if duration is not None else "N/A",))
         
         return result
 
+    def get_course_members(self):
+        # Course id -> [(student id, name)]
+        members = {}
+        with self.backend.transaction() as c:
+            c.execute('''SELECT student_courses.course_id, students.id, students.name FROM student_courses
+                         INNER JOIN students ON students.id = student_courses.student_id''')
+            for row in c.fetchall():
+                members.setdefault(row['course_id'], []).append((row['id'], row['name']))
+        return members
+
+    def add_course_session(self, course_id, date, start_time, end_time, room=None):
+        with self.backend.transaction() as c:
+            return c.insert('''INSERT INTO course_sessions (course_id, date, start_time, end_time, room)
+                               VALUES (?, ?, ?, ?, ?)''', (course_id, date, start_time, end_time, room))
+
+    def delete_course_session(self, session_id):
+        with self.backend.transaction() as c:
+            c.execute('DELETE FROM course_sessions WHERE id = ?', (session_id,))
+
+    def get_course_session(self, session_id):
+        with self.backend.transaction() as c:
+            c.execute('SELECT * FROM course_sessions WHERE id = ?', (session_id,))
+            result = c.fetchone()
+        return dict(result) if result else None
+
+    def get_course_sessions(self, date_from, date_to=None):
+        with self.backend.transaction() as c:
+            c.execute('''SELECT course_sessions.*, courses.name AS course FROM course_sessions
+                         INNER JOIN courses ON courses.id = course_sessions.course_id
+                         WHERE course_sessions.date >= ? AND course_sessions.date <= ?
+                         ORDER BY course_sessions.date, course_sessions.start_time''', (date_from, date_to or date_from))
+            return [dict(row) for row in c.fetchall()]
+
+    def get_open_sessions(self, student_id, session_ids):
+        # Ids among session_ids in which the student's latest event is an In
+        if not session_ids:
+            return set()
+        marks = ','.join('?' * len(session_ids))
+        latest = {}
+        with self.backend.transaction() as c:
+            c.execute(f'''SELECT session_id, event_type FROM attendance_events
+                          WHERE student_id = ? AND session_id IN ({marks}) ORDER BY id''', [student_id, *session_ids])
+            for row in c.fetchall():
+                latest[row['session_id']] = row['event_type']
+        return {session_id for session_id, event_type in latest.items() if event_type == "In"}
+
+    def get_open_session_marks(self, date):
+        # (student id, course id) -> session of the student's latest In on `date`, None if an Out followed
+        query = """SELECT student_id, course_id, session_id, event_type FROM attendance_events
+                   WHERE date = ? AND session_id IS NOT NULL ORDER BY id"""
+        latest = {}
+        for row in self.backend.iter_rows(query, (date,)):
+            latest[(row['student_id'], row['course_id'])] = row['session_id'] if row['event_type'] == "In" else None
+        return latest
+
+    def close_course_sessions(self, date, time):
+        # Every session that ended by `date time` and is still open: students whose latest event in it is an
+        # In get an automatic Out at the session's end, all in one INSERT ... SELECT. Returns (sessions, outs).
+        closed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with metrics.timer('db_write'):
+            with self.backend.transaction() as c:
+                c.execute('''SELECT id FROM course_sessions WHERE closed_at IS NULL
+                             AND (date < ? OR (date = ? AND end_time <= ?))''', (date, date, time))
+                session_ids = [row['id'] for row in c.fetchall()]
+                if not session_ids:
+                    return 0, 0
+                marks = ','.join('?' * len(session_ids))
+                c.execute(f'''INSERT INTO attendance_events (student_id, course_id, date, event_type, time, method,
+                              created_at, session_id, flag)
+                              SELECT e.student_id, e.course_id, s.date, 'Out', s.end_time, 'auto', ?, s.id, 'auto_closed'
+                              FROM attendance_events e INNER JOIN course_sessions s ON s.id = e.session_id
+                              WHERE s.id IN ({marks}) AND e.event_type = 'In'
+                              AND e.id = (SELECT MAX(id) FROM attendance_events
+                                          WHERE session_id = e.session_id AND student_id = e.student_id)''',
+                          [closed_at, *session_ids])
+                outs = c.rowcount
+                c.execute(f'UPDATE course_sessions SET closed_at = ? WHERE id IN ({marks})', [closed_at, *session_ids])
+        metrics.inc('attendance_marks', outs, result='auto_closed', method='auto')
+        return len(session_ids), outs
+
+    def append_face_change(self, op, name=None, encoding=None, student_id=None, source=None, template_id=None):
+        blob = np.asarray(encoding, dtype=np.float64).tobytes() if encoding is not None else None
+        with self.backend.transaction() as c:
+            # Readers tail the log by id (get_face_changes), so a lower id must never commit after a higher one
+            c.serialize_inserts('face_changes')
+            return c.insert('''INSERT INTO face_changes (op, template_id, name, student_id, source, encoding, created_at)
+                               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                            (op, template_id, name, student_id, source, blob,
+                             datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+    def get_face_changes(self, since_version=0, limit=5000):
+        with self.backend.transaction() as c:
+            c.execute('SELECT * FROM face_changes WHERE id > ? ORDER BY id LIMIT ?', (since_version, limit))
+            return [dict(row) for row in c.fetchall()]
+
     def close(self):
-        self.conn.close()
\ No newline at end of file
+        self.backend.close()
+        if self.reports is not self.backend:
+            self.reports.close()
\ No newline at end of file
@@ -0,0 +1,84 @@
+# File: enrolment.py
+
+import logging
+import os
+
+from image_ingest import ingest_image
+from metrics import metrics, get_logger, log_event
+from periodic import PeriodicWorker
+
+logger = get_logger(__name__)
+
+PHOTO_SOURCE_PREFIX = 'photo:'
+
+
+def photo_source(photo_path):
+    return PHOTO_SOURCE_PREFIX + os.path.normpath(photo_path)
+
+
+def enrol_photo(face_module, job):
+    # The new photo is added before the old photo templates are retired, so the student is never unmatched;
+    # if the new photo cannot be used the old templates stay. The caller saves the gallery.
+    gallery = face_module.gallery
+    photo_sources = [s for s in gallery.source_table.strings if s.startswith(PHOTO_SOURCE_PREFIX)]
+    stale = gallery.templates_from(photo_sources, job['student_id'])
+
+    if not os.path.exists(job['photo_path']):
+        return 'missing', 0
+    # Phone photos are large: faces are found on a draft decode, and only a photo with a face is decoded
+    # in full, for the encoder alone
+    screened, = face_module.pipeline.run([job['photo_path']], ('ingest', 'detect'))
+    locations = screened.source_locations()
+    if locations and face_module.add_face(ingest_image(job['photo_path']), job['name'], job['student_id'],
+                                          photo_source(job['photo_path']), locations, save=False):
+        status = 'enrolled'
+    else:
+        status = 'no_face'
+
+    if status != 'enrolled':
+        return status, 0
+    for template_id in stale:
+        face_module.remove_template(template_id, save=False)
+    return status, len(stale)
+
+
+def process_enrolment_queue(face_module, limit=20):
+    # Runs where gallery writes are allowed: the worker pool's writer process, or a standalone script
+    db = face_module.change_log
+    jobs = db.get_pending_enrolments(limit)
+    changed = False
+    for job in jobs:
+        try:
+            with metrics.timer('photo_enrolment'):
+                status, retired = enrol_photo(face_module, job)
+        except Exception as e:
+            status, retired = 'failed', 0
+            log_event(logger, logging.WARNING, "photo_enrolment_failed", student_id=job['student_id'], error=e)
+        # A failure can come after the new template was added
+        changed = changed or status in ('enrolled', 'failed')
+        db.finish_enrolment(job['id'], status)
+        metrics.inc('photo_enrolments', result=status)
+        log_event(logger, logging.INFO, "photo_enrolled", student_id=job['student_id'], status=status, retired=retired)
+    if changed:
+        # One write of the gallery file for the whole batch
+        face_module.save_known_faces()
+    return len(jobs)
+
+
+class EnrolmentRefresher(PeriodicWorker):
+    # Hands the enrolment queue to the worker pool every `interval` seconds
+    error_metric = 'enrolment_refresh_errors'
+    error_event = 'enrolment_refresh_failed'
+
+    def __init__(self, pool, interval=10.0, limit=20):
+        super().__init__(interval)
+        self.pool = pool
+        self.limit = limit
+
+    def step(self):
+        submitted, job = self.pool.submit_enrolment_refresh(self.limit)
+        if not submitted:
+            return
+        status, result = self.pool.wait(job)
+        if status != self.pool.DONE:
+            log_event(logger, logging.WARNING, "enrolment_refresh_failed", status=status, error=result)
@@ -0,0 +1,143 @@
+# File: evaluate_matching.py
+
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+
+import numpy as np
+
+from face_recognition_module import FaceRecognitionModule
+
+FUSIONS = ('min', 'mean', 'centroid')
+IMAGE_PATTERNS = ('*.jpg', '*.jpeg', '*.png')
+
+
+def encode_captures(captures_dir, module):
+    # captures_dir/<student name>/<image>; frames without exactly one face are skipped
+    from image_ingest import ingest_image
+
+    encodings, labels = [], []
+    for label in sorted(os.listdir(captures_dir)):
+        folder = os.path.join(captures_dir, label)
+        if not os.path.isdir(folder):
+            continue
+        for pattern in IMAGE_PATTERNS:
+            for path in sorted(glob.glob(os.path.join(folder, pattern))):
+                rgb_image = ingest_image(path).rgb()
+                face_locations = module.detect_faces(rgb_image)
+                if len(face_locations) != 1:
+                    print(f"Skipping {path}: {len(face_locations)} faces")
+                    continue
+                encodings.append(module.encode_faces(rgb_image, face_locations)[0])
+                labels.append(label)
+    return np.array(encodings), np.array(labels)
+
+
+def split(encodings, labels, enrol_per_identity, impostor_fraction, seed):
+    rng = random.Random(seed)
+    identities = sorted(set(labels))
+    rng.shuffle(identities)
+    impostors = set(identities[:int(len(identities) * impostor_fraction)])
+
+    enrol, genuine, impostor = [], [], []
+    for identity in identities:
+        indexes = [i for i, label in enumerate(labels) if label == identity]
+        rng.shuffle(indexes)
+        if identity in impostors:
+            impostor.extend(indexes)
+        elif len(indexes) > enrol_per_identity:
+            enrol.extend((i, identity) for i in indexes[:enrol_per_identity])
+            genuine.extend(indexes[enrol_per_identity:])
+    return enrol, genuine, impostor
+
+
+def score_probes(module, encodings, labels, probes):
+    # (true label, predicted name, fused distance, threshold) for every probe
+    scored = []
+    for i in probes:
+        position, distance, threshold = module._match(encodings[i])
+        scored.append((labels[i], module.gallery.name_at(position), distance, threshold))
+    return scored
+
+
+def error_rates(genuine, impostor, factors):
+    curve = []
+    for factor in factors:
+        false_rejects = sum(1 for label, name, distance, threshold in genuine
+                            if name != label or distance > threshold * factor)
+        false_accepts = sum(1 for _, _, distance, threshold in impostor if distance <= threshold * factor)
+        curve.append({
+            'factor': round(float(factor), 3),
+            'frr': false_rejects / len(genuine) if genuine else 0.0,
+            'far': false_accepts / len(impostor) if impostor else 0.0,
+        })
+    return curve
+
+
+def equal_error_rate(curve):
+    point = min(curve, key=lambda p: abs(p['far'] - p['frr']))
+    return (point['far'] + point['frr']) / 2, point['factor']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report FAR/FRR curves for face matching from stored captures.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--captures', help='Directory of <student>/<image> captures')
+    source.add_argument('--encodings', help='.npz with "encodings" and "labels" arrays')
+    parser.add_argument('--save-encodings', help='Write encoded captures to this .npz for faster reruns')
+    parser.add_argument('--enrol', type=int, default=3, help='Templates enrolled per identity')
+    parser.add_argument('--impostor-fraction', type=float, default=0.2,
+                        help='Share of identities held out of the gallery and used as impostors')
+    parser.add_argument('--tolerance', type=float, default=0.6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the curves to this JSON file')
+    args = parser.parse_args(argv)
+
+    # Scratch gallery so the live known_faces.pkl is never touched
+    scratch = tempfile.mkdtemp(prefix='evaluate_matching_')
+    module = FaceRecognitionModule(data_file=os.path.join(scratch, 'gallery.pkl'), tolerance=args.tolerance)
+    if args.captures:
+        encodings, labels = encode_captures(args.captures, module)
+        if args.save_encodings:
+            np.savez(args.save_encodings, encodings=encodings, labels=labels)
+    else:
+        data = np.load(args.encodings)
+        encodings, labels = data['encodings'], data['labels']
+
+    enrol, genuine_probes, impostor_probes = split(list(encodings), list(labels), args.enrol,
+                                                   args.impostor_fraction, args.seed)
+    if not enrol:
+        print("Not enough captures per identity to enrol and probe.")
+        return 1
+    for i, identity in enrol:
+        module.gallery.add(None, identity, encodings[i])
+    print(f"{len(set(i for _, i in enrol))} identities enrolled, {len(genuine_probes)} genuine and "
+          f"{len(impostor_probes)} impostor probes")
+
+    factors = np.arange(0.6, 1.41, 0.05)
+    report = {}
+    for fusion in FUSIONS:
+        for adaptive in (False, True):
+            module.fusion, module.adaptive_thresholds = fusion, adaptive
+            curve = error_rates(score_probes(module, encodings, labels, genuine_probes),
+                                score_probes(module, encodings, labels, impostor_probes), factors)
+            key = f"{fusion}/{'adaptive' if adaptive else 'fixed'}"
+            eer, at = equal_error_rate(curve)
+            at_one = next(p for p in curve if abs(p['factor'] - 1.0) < 1e-9)
+            print(f"{key:20s} FAR {at_one['far']:6.2%}  FRR {at_one['frr']:6.2%}  at configured thresholds; "
+                  f"EER {eer:6.2%} at x{at}")
+            report[key] = curve
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote curves to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
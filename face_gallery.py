@@ -0,0 +1,513 @@
+# File: face_gallery.py
+
+import glob
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import metrics
+
+ENCODING_SIZE = 128
+NO_ID = -1
+ROW_BYTES = ENCODING_SIZE * 8
+# Paged galleries always keep at least this many full-precision rows, whatever the budget
+MIN_PAGED_ROWS = 64
+# A sidecar younger than this may belong to a save still in progress elsewhere, or to a snapshot a reader
+# has just opened, so it is never cleaned up
+SIDECAR_GRACE_SECONDS = 300
+
+
+class StringTable:
+    # Interned strings addressed by a small integer, so per-template columns can be plain int32 arrays
+    def __init__(self, strings=()):
+        self.strings = []
+        self._index = {}
+        for string in strings:
+            self.intern(string)
+
+    def intern(self, string):
+        if string is None:
+            return NO_ID
+        index = self._index.get(string)
+        if index is None:
+            index = self._index[string] = len(self.strings)
+            self.strings.append(string)
+        return index
+
+    def lookup(self, index):
+        return None if index == NO_ID else self.strings[index]
+
+    def indexes_of(self, strings):
+        return [self._index[s] for s in strings if s in self._index]
+
+
+class TemplatePager:
+    # Full-precision rows of a sidecar .npy read on demand into a byte-budgeted LRU. Unlike a memory map,
+    # rows that fall out of the LRU are really freed, so the process's resident size stays bounded.
+    def __init__(self, path, budget_bytes):
+        self.path = path
+        self.budget_bytes = budget_bytes
+        header = np.load(path, mmap_mode='r')
+        self.offset = header.offset
+        del header
+        self._file = open(path, 'rb')
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, row):
+        with self._lock:
+            cached = self._cache.get(row)
+            if cached is not None:
+                self._cache.move_to_end(row)
+                metrics.inc('gallery_pages', result='hit')
+                return cached
+            self._file.seek(self.offset + row * ROW_BYTES)
+            encoding = np.frombuffer(self._file.read(ROW_BYTES), dtype=np.float64)
+            self._cache[row] = encoding
+            while len(self._cache) > max(MIN_PAGED_ROWS, self.budget_bytes // ROW_BYTES):
+                self._cache.popitem(last=False)
+        metrics.inc('gallery_pages', result='miss')
+        return encoding
+
+    def resident_bytes(self):
+        return len(self._cache) * ROW_BYTES
+
+    def close(self):
+        self._file.close()
+
+
+class TemplateSpill(TemplatePager):
+    # Rows added since the last snapshot, for a gallery under a memory budget: appended to a private
+    # scratch file and paged back through the same LRU. Recognition workers never save, so without this
+    # every template applied from the change log would stay resident for the life of the process.
+    def __init__(self, budget_bytes):
+        self.path = None
+        self.budget_bytes = budget_bytes
+        self.offset = 0
+        self.rows = 0
+        self._file = tempfile.TemporaryFile()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def append(self, encoding):
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(np.asarray(encoding, dtype=np.float64).tobytes())
+            self.rows += 1
+            return self.rows - 1
+
+
+class FaceGallery:
+    # Compact in-memory face templates. Each template is an int8 code with a per-vector scale
+    # (128 + 8 bytes) plus int columns for ids and interned names; the float64 encodings used
+    # for exact re-ranking live in a memory-mapped sidecar file and are only touched for the
+    # few best coarse candidates. `version` is the last change-log record applied.
+    COLUMNS = ('template_id', 'student_id', 'name_id', 'source_id', 'scale', 'norm')
+
+    def __init__(self, memory_budget=None):
+        # memory_budget (bytes): page full-precision rows through a TemplatePager instead of memory-mapping
+        # the whole sidecar, and spill rows added later to a scratch file; the coarse int8 index stays
+        # resident and the pagers share what is left
+        self.memory_budget = memory_budget
+        self.version = 0
+        self.revision = 0
+        self.name_table = StringTable()
+        self.source_table = StringTable()
+        self._size = 0
+        self._codes = np.empty((16, ENCODING_SIZE), dtype=np.int8)
+        self._columns = {
+            'template_id': np.empty(16, dtype=np.int64),
+            'student_id': np.empty(16, dtype=np.int64),
+            'name_id': np.empty(16, dtype=np.int32),
+            'source_id': np.empty(16, dtype=np.int32),
+            'scale': np.empty(16, dtype=np.float32),
+            'norm': np.empty(16, dtype=np.float32),
+        }
+        self._positions = {}
+        self._next_local_id = -1
+        # Full-precision rows: memory-mapped from the last snapshot, plus anything added since
+        self._full_file = None
+        self._full_rows = {}
+        self._full_map = None
+        self._pending_full = {}
+        # Under a memory budget, rows added since the snapshot live in a spill file instead of _pending_full
+        self._spill = None
+        self._spill_rows = {}
+        self._identities = {}
+        self._identity_thresholds = {}
+        self._identity_revision = None
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, template_id):
+        return template_id in self._positions
+
+    def _column(self, name):
+        return self._columns[name][:self._size]
+
+    @property
+    def codes(self):
+        return self._codes[:self._size]
+
+    @property
+    def template_ids(self):
+        return self._column('template_id').tolist()
+
+    @property
+    def names(self):
+        return [self.name_table.lookup(i) for i in self._column('name_id')]
+
+    @property
+    def student_ids(self):
+        return [None if i == NO_ID else i for i in self._column('student_id').tolist()]
+
+    @property
+    def sources(self):
+        return [self.source_table.lookup(i) for i in self._column('source_id')]
+
+    def name_at(self, position):
+        return self.name_table.lookup(self._columns['name_id'][position])
+
+    def student_id_at(self, position):
+        student_id = int(self._columns['student_id'][position])
+        return None if student_id == NO_ID else student_id
+
+    def coarse_bytes(self):
+        return self._codes.nbytes + sum(column.nbytes for column in self._columns.values())
+
+    def resident_bytes(self):
+        paged = self._full_map.resident_bytes() if isinstance(self._full_map, TemplatePager) else 0
+        spilled = self._spill.resident_bytes() if self._spill is not None else 0
+        return self.coarse_bytes() + paged + spilled + len(self._pending_full) * ROW_BYTES
+
+    def _rebudget(self):
+        # What the coarse index leaves of the budget is shared by the snapshot pager and the spill file;
+        # recomputed whenever the index grows
+        if self.memory_budget is None:
+            return
+        pagers = [p for p in (self._full_map, self._spill) if isinstance(p, TemplatePager)]
+        for pager in pagers:
+            pager.budget_bytes = max(self.memory_budget - self.coarse_bytes(), 0) // len(pagers)
+
+    def _grow(self):
+        capacity = len(self._codes) * 2
+        codes = np.empty((capacity, ENCODING_SIZE), dtype=np.int8)
+        codes[:self._size] = self.codes
+        self._codes = codes
+        for name, column in self._columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            self._columns[name] = grown
+        self._rebudget()
+
+    @staticmethod
+    def quantize(encoding):
+        scale = float(np.abs(encoding).max()) / 127 or 1.0
+        code = np.clip(np.rint(encoding / scale), -127, 127).astype(np.int8)
+        return code, scale
+
+    def add(self, template_id, name, encoding, student_id=None, source=None):
+        if template_id is None:
+            # Templates that never went through the change log (legacy stores, offline use)
+            template_id = self._next_local_id
+            self._next_local_id -= 1
+        if template_id in self._positions:
+            return template_id
+        if self._size == len(self._codes):
+            self._grow()
+
+        position = self._size
+        code, scale = self.quantize(np.asarray(encoding, dtype=np.float64))
+        self._codes[position] = code
+        row = {
+            'template_id': template_id,
+            'student_id': NO_ID if student_id is None else student_id,
+            'name_id': self.name_table.intern(name),
+            'source_id': self.source_table.intern(source),
+            'scale': scale,
+            'norm': float(np.dot(code, code.astype(np.int32))) * scale * scale,
+        }
+        for column, value in row.items():
+            self._columns[column][position] = value
+        if self.memory_budget is None:
+            self._pending_full[template_id] = np.array(encoding, dtype=np.float64)
+        else:
+            if self._spill is None:
+                self._spill = TemplateSpill(0)
+                self._rebudget()
+            self._spill_rows[template_id] = self._spill.append(encoding)
+        self._positions[template_id] = position
+        self._size += 1
+        self.revision += 1
+        return template_id
+
+    def remove(self, template_id):
+        position = self._positions.pop(template_id, None)
+        if position is None:
+            return False
+        # Move the last template into the freed slot so every array stays dense
+        last = self._size - 1
+        if position != last:
+            self._codes[position] = self._codes[last]
+            for column in self._columns.values():
+                column[position] = column[last]
+            self._positions[int(self._columns['template_id'][position])] = position
+        self._pending_full.pop(template_id, None)
+        self._spill_rows.pop(template_id, None)
+        self._full_rows.pop(template_id, None)
+        self._size -= 1
+        self.revision += 1
+        return True
+
+    def full_encoding(self, position):
+        template_id = int(self._columns['template_id'][position])
+        pending = self._pending_full.get(template_id)
+        if pending is not None:
+            return pending
+        spilled = self._spill_rows.get(template_id)
+        if spilled is not None:
+            return self._spill[spilled]
+        return np.asarray(self._full_map[self._full_rows[template_id]])
+
+    def positions_for(self, student_ids, names=()):
+        # Templates enrolled before student ids were recorded are matched on name instead
+        student_column = self._column('student_id')
+        name_ids = self.name_table.indexes_of(names)
+        mask = np.isin(student_column, list(student_ids))
+        if name_ids:
+            mask |= (student_column == NO_ID) & np.isin(self._column('name_id'), name_ids)
+        return np.flatnonzero(mask)
+
+    def templates_from(self, sources, student_id=None):
+        # Template ids enrolled from the given sources (e.g. profile photo paths), optionally for one student
+        source_ids = self.source_table.indexes_of(sources)
+        if not source_ids:
+            return []
+        mask = np.isin(self._column('source_id'), source_ids)
+        if student_id is not None:
+            mask &= self._column('student_id') == student_id
+        return self._column('template_id')[mask].tolist()
+
+    def view(self, positions=None):
+        # A contiguous slice of the coarse index; shards keep one of these per course
+        if positions is None:
+            return np.arange(self._size), self.codes, self._column('scale'), self._column('norm')
+        return positions, self._codes[positions], self._columns['scale'][positions], self._columns['norm'][positions]
+
+    def candidates(self, query, view=None, top_k=8, chunk=4096):
+        # Gallery positions of the top_k templates by coarse int8 distance.
+        # ||q - s*c||^2 = ||q||^2 - 2 s (c . q) + s^2 ||c||^2, scored in cache-sized chunks of codes.
+        positions, codes, scales, norms = view if view is not None else self.view()
+        if len(positions) == 0:
+            return np.empty(0, dtype=np.intp)
+        query32 = np.asarray(query, dtype=np.float32)
+        coarse = np.empty(len(positions), dtype=np.float32)
+        for start in range(0, len(positions), chunk):
+            stop = start + chunk
+            dots = codes[start:stop].astype(np.float32) @ query32
+            coarse[start:stop] = norms[start:stop] - 2 * scales[start:stop] * dots
+        k = min(top_k, len(positions))
+        return positions[np.argpartition(coarse, k - 1)[:k]]
+
+    def search(self, query, view=None, top_k=8):
+        # Returns (position, exact distance) of the single closest template, or (None, None) if empty
+        query = np.asarray(query, dtype=np.float64)
+        best_position, best_distance = None, None
+        for position in self.candidates(query, view, top_k):
+            distance = float(np.linalg.norm(self.full_encoding(position) - query))
+            if best_distance is None or distance < best_distance:
+                best_position, best_distance = int(position), distance
+        return best_position, best_distance
+
+    def identity_of(self, position):
+        # Templates of one student share an identity; legacy templates without a student id group by name
+        student_id = int(self._columns['student_id'][position])
+        if student_id != NO_ID:
+            return 'student', student_id
+        return 'name', int(self._columns['name_id'][position])
+
+    def identities(self):
+        if self._identity_revision != self.revision:
+            groups = {}
+            for position in range(self._size):
+                groups.setdefault(self.identity_of(position), []).append(position)
+            self._identities = groups
+            self._identity_thresholds = {}
+            self._identity_revision = self.revision
+        return self._identities
+
+    def templates_of(self, identity):
+        return np.array([self.full_encoding(p) for p in self.identities()[identity]])
+
+    def identity_threshold(self, identity, default, margin=2.0, bounds=(0.5, 0.65)):
+        # Calibrated from the spread of the identity's own enrolment templates: tight clusters get a
+        # stricter threshold, students whose captures vary more get more room, always within bounds.
+        # The configured tolerance (default) is a ceiling: calibration may only tighten it.
+        # A single template gives no spread to calibrate from, so it keeps the default.
+        self.identities()
+        key = (identity, default, margin, bounds)
+        if key not in self._identity_thresholds:
+            templates = self.templates_of(identity)
+            if len(templates) < 2:
+                threshold = default
+            else:
+                spread = np.linalg.norm(templates[:, None, :] - templates[None, :, :], axis=2)
+                pairwise = spread[np.triu_indices(len(templates), 1)]
+                upper = min(bounds[1], default)
+                threshold = float(np.clip(pairwise.mean() + margin * pairwise.std(), min(bounds[0], upper), upper))
+            self._identity_thresholds[key] = threshold
+        return self._identity_thresholds[key]
+
+    def rank(self, query, view=None, fusion='min', default_threshold=0.6, adaptive=True, top_k=16, limit=None,
+             **calibration):
+        # [(position, fused distance, threshold)] for the identities among the top_k coarse candidates,
+        # best first by distance relative to each identity's own threshold
+        query = np.asarray(query, dtype=np.float64)
+        identities = {self.identity_of(p) for p in self.candidates(query, view, top_k)}
+        ranked = []
+        for identity in identities:
+            templates = self.templates_of(identity)
+            if fusion == 'centroid':
+                distance = float(np.linalg.norm(templates.mean(axis=0) - query))
+            else:
+                distances = np.linalg.norm(templates - query, axis=1)
+                distance = float(distances.mean() if fusion == 'mean' else distances.min())
+            threshold = (self.identity_threshold(identity, default_threshold, **calibration)
+                         if adaptive else default_threshold)
+            ranked.append((self.identities()[identity][0], distance, threshold))
+        ranked.sort(key=lambda match: match[1] / match[2])
+        return ranked[:limit] if limit is not None else ranked
+
+    def match(self, query, view=None, fusion='min', default_threshold=0.6, adaptive=True, top_k=16, **calibration):
+        # Returns (position, fused distance, threshold) for the identity with the best distance relative
+        # to its own threshold, or (None, None, None) for an empty gallery. Callers accept the match
+        # when distance <= threshold.
+        ranked = self.rank(query, view, fusion, default_threshold, adaptive, top_k, 1, **calibration)
+        return ranked[0] if ranked else (None, None, None)
+
+    def apply(self, changes):
+        for change in changes:
+            if change['op'] == 'add':
+                encoding = np.frombuffer(bytes(change['encoding']), dtype=np.float64)
+                self.add(change['id'], change['name'], encoding, change['student_id'], change['source'])
+            elif change['op'] == 'remove':
+                self.remove(change['template_id'])
+            self.version = max(self.version, change['id'])
+        return len(changes)
+
+    def save(self, path):
+        # Full-precision rows go to a new uniquely named sidecar: files other processes still have
+        # memory-mapped are never overwritten (which Windows would refuse anyway).
+        root = os.path.splitext(path)[0]
+        full_file = f"{root}.{uuid.uuid4().hex[:12]}.npy"
+        full = np.lib.format.open_memmap(full_file, mode='w+', dtype=np.float64, shape=(self._size, ENCODING_SIZE))
+        for position in range(self._size):
+            full[position] = self.full_encoding(position)
+        full.flush()
+        del full
+
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({
+                'format': 2,
+                'version': self.version,
+                'size': self._size,
+                'codes': self.codes.copy(),
+                'columns': {name: self._column(name).copy() for name in self.COLUMNS},
+                'names': self.name_table.strings,
+                'sources': self.source_table.strings,
+                'full_file': os.path.basename(full_file),
+            }, f)
+        os.replace(tmp_file, path)
+
+        self._attach_full(full_file, self.template_ids)
+        self._remove_stale_sidecars(path, full_file)
+
+    @staticmethod
+    def _remove_stale_sidecars(path, full_file):
+        # Other writers (replicas, the enrolment script, a restore) may have replaced the snapshot since,
+        # so whatever it references now is kept too, along with anything recent
+        keep = {os.path.basename(full_file)}
+        try:
+            with open(path, 'rb') as f:
+                keep.add(pickle.load(f).get('full_file'))
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+        cutoff = time.time() - SIDECAR_GRACE_SECONDS
+        for stale in glob.glob(f"{os.path.splitext(path)[0]}.*.npy"):
+            try:
+                if os.path.basename(stale) not in keep and os.path.getmtime(stale) < cutoff:
+                    os.remove(stale)
+            except OSError:
+                pass
+
+    def _attach_full(self, full_file, template_ids):
+        if isinstance(self._full_map, TemplatePager):
+            self._full_map.close()
+        self._full_file = full_file
+        if self.memory_budget is None:
+            self._full_map = np.load(full_file, mmap_mode='r')
+        else:
+            self._full_map = TemplatePager(full_file, 0)
+        self._full_rows = {template_id: row for row, template_id in enumerate(template_ids)}
+        self._pending_full = {}
+        if self._spill is not None:
+            self._spill.close()
+        self._spill = None
+        self._spill_rows = {}
+        self._rebudget()
+
+    @classmethod
+    def load(cls, path, attempts=3, memory_budget=None):
+        for attempt in range(attempts):
+            try:
+                return cls._load(path, memory_budget)
+            except FileNotFoundError:
+                # Another process saved and cleaned up the sidecar between our two reads; re-read the snapshot
+                if attempt == attempts - 1:
+                    raise
+
+    @classmethod
+    def _load(cls, path, memory_budget=None):
+        gallery = cls(memory_budget)
+        if not os.path.exists(path):
+            return gallery
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+
+        if data.get('format') != 2:
+            # Older stores hold full encodings inline: 'encodings' and 'names', plus ids from the change log era
+            count = len(data['names'])
+            template_ids = data.get('template_ids', [None] * count)
+            student_ids = data.get('student_ids', [None] * count)
+            sources = data.get('sources', [None] * count)
+            for template_id, name, encoding, student_id, source in zip(template_ids, data['names'], data['encodings'],
+                                                                       student_ids, sources):
+                gallery.add(template_id, name, encoding, student_id, source)
+            gallery.version = data.get('version', 0)
+            return gallery
+
+        size = data['size']
+        gallery.name_table = StringTable(data['names'])
+        gallery.source_table = StringTable(data['sources'])
+        capacity = max(16, size)
+        gallery._codes = np.empty((capacity, ENCODING_SIZE), dtype=np.int8)
+        gallery._codes[:size] = data['codes']
+        for name, values in data['columns'].items():
+            gallery._columns[name] = np.empty(capacity, dtype=values.dtype)
+            gallery._columns[name][:size] = values
+        gallery._size = size
+        template_ids = gallery.template_ids
+        gallery._positions = {template_id: position for position, template_id in enumerate(template_ids)}
+        gallery._next_local_id = min([-1] + [t - 1 for t in template_ids if t < 0])
+        gallery._attach_full(os.path.join(os.path.dirname(path), data['full_file']), template_ids)
+        gallery.version = data['version']
+        gallery.revision = 1
+        return gallery
@@ -0,0 +1,232 @@
+# File: face_pipeline.py
+
+import time
+
+import cv2
+import face_recognition
+
+from image_ingest import ingest_image, as_frame
+from metrics import metrics
+
+STAGES = ('ingest', 'detect', 'quality', 'landmarks', 'encode', 'match', 'annotate')
+RECOGNIZE_STAGES = ('ingest', 'detect', 'quality', 'encode', 'match')
+
+
+class FaceResult:
+    # One detected face. `box` is (top, right, bottom, left) on the decoded frame; `matches` holds the
+    # top-k (name, student id, fused distance, threshold) candidates, best first.
+    __slots__ = ('box', 'landmarks', 'encoding', 'name', 'student_id', 'distance', 'threshold', 'matches')
+
+    def __init__(self, box):
+        self.box = tuple(int(v) for v in box)
+        self.landmarks = None
+        self.encoding = None
+        self.name = None
+        self.student_id = None
+        self.distance = None
+        self.threshold = None
+        self.matches = []
+
+    def to_dict(self):
+        return {
+            'box': list(self.box),
+            'landmarks': self.landmarks,
+            'name': self.name,
+            'student_id': self.student_id,
+            'distance': self.distance,
+            'threshold': self.threshold,
+            'matches': [list(match) for match in self.matches],
+        }
+
+
+class PipelineResult:
+    # Everything one image went through. Stages fill in what they produce and skip what is already there,
+    # so a result can be passed back into the pipeline to run later stages without repeating earlier ones.
+    __slots__ = ('source', 'frame', 'rgb', 'faces', 'rejection', 'timings', 'annotated')
+
+    def __init__(self, source=None, frame=None):
+        self.source = source
+        self.frame = frame
+        self.rgb = None
+        self.faces = None
+        self.rejection = None
+        self.timings = {}
+        self.annotated = None
+
+    @property
+    def locations(self):
+        return [face.box for face in self.faces or []]
+
+    @property
+    def names(self):
+        return [face.name for face in self.faces or [] if face.name is not None]
+
+    def source_locations(self):
+        # Boxes in source-image coordinates when the frame was decoded at reduced size
+        return self.frame.to_source_locations(self.locations) if self.frame is not None else self.locations
+
+    def to_dict(self):
+        return {
+            'source': self.source if isinstance(self.source, str) else None,
+            'faces': [face.to_dict() for face in self.faces or []],
+            'rejection': self.rejection,
+            'timings': {stage: round(seconds * 1000, 3) for stage, seconds in self.timings.items()},
+        }
+
+
+def draw_boxes(pixels, boxes, labels):
+    # Draws in place on the caller's buffer
+    for (top, right, bottom, left), label in zip(boxes, labels):
+        cv2.rectangle(pixels, (left, top), (right, bottom), (0, 255, 0), 2)
+        cv2.rectangle(pixels, (left, bottom - 35), (right, bottom), (0, 255, 0), cv2.FILLED)
+        font = cv2.FONT_HERSHEY_DUPLEX
+        cv2.putText(pixels, label, (left + 6, bottom - 6), font, 0.5, (255, 255, 255), 1)
+    return pixels
+
+
+class FacePipeline:
+    # ingest -> detect -> quality -> landmarks -> encode -> match -> annotate over a batch of images.
+    # Each stage takes and returns the list of PipelineResults, so callers can run any subset, feed in
+    # boxes they already have, or push many images through one stage before the next.
+    def __init__(self, module, top_k=3, number_of_times_to_upsample=1, model='hog'):
+        self.module = module
+        self.top_k = top_k
+        self.upsample = number_of_times_to_upsample
+        self.model = model
+
+    def _timed(self, result, stage, func):
+        start = time.perf_counter()
+        with metrics.timer(stage):
+            value = func()
+        result.timings[stage] = result.timings.get(stage, 0.0) + time.perf_counter() - start
+        return value
+
+    def ingest(self, images, locations=None, detect_only=False):
+        # images: paths/file objects (decoded here), Frames, RGB arrays or PipelineResults.
+        # locations: optional boxes per image, e.g. from an earlier screening pass, so detection is skipped.
+        # detect_only: nothing will be encoded, so JPEGs are draft-decoded at reduced size; boxes are then
+        # on the reduced frame and source_locations() maps them back.
+        results = []
+        for i, image in enumerate(images):
+            if isinstance(image, PipelineResult):
+                results.append(image)
+                continue
+            result = PipelineResult(image)
+            if hasattr(image, 'shape') or hasattr(image, 'pixels'):
+                result.frame = as_frame(image)
+            else:
+                result.frame = self._timed(result, 'decode', lambda: ingest_image(image, detect_only))
+            if locations is not None and locations[i] is not None:
+                result.faces = [FaceResult(box) for box in locations[i]]
+            results.append(result)
+        return results
+
+    def _rgb(self, result):
+        # Converted once per image and shared by every later stage
+        if result.rgb is None:
+            result.rgb = self._timed(result, 'colour_convert', result.frame.rgb)
+        return result.rgb
+
+    def detect(self, results):
+        pending = [r for r in results if r.faces is None and r.rejection is None]
+        if self.model == 'cnn' and len(pending) > 1 and len({r.frame.shape for r in pending}) == 1:
+            # The CNN detector batches same-sized frames on the GPU in one call
+            start = time.perf_counter()
+            with metrics.timer('detect'):
+                batches = face_recognition.batch_face_locations([self._rgb(r) for r in pending], self.upsample)
+            for result, boxes in zip(pending, batches):
+                result.faces = [FaceResult(box) for box in boxes]
+                result.timings['detect'] = (time.perf_counter() - start) / len(pending)
+            return results
+        for result in pending:
+            rgb = self._rgb(result)
+            boxes = self._timed(result, 'detect',
+                                lambda: face_recognition.face_locations(rgb, self.upsample, self.model))
+            result.faces = [FaceResult(box) for box in boxes]
+        return results
+
+    def quality(self, results):
+        for result in results:
+            if result.rejection is None and result.faces is not None:
+                rgb = self._rgb(result)
+                result.rejection = self._timed(result, 'quality_gate',
+                                               lambda: self.module.check_quality(rgb, result.locations,
+                                                                                 result.frame.scale))
+                if result.rejection:
+                    metrics.inc('frames_rejected', reason=result.rejection)
+        return results
+
+    def landmarks(self, results):
+        for result in self._usable(results):
+            faces = [face for face in result.faces if face.landmarks is None]
+            if faces:
+                rgb = self._rgb(result)
+                found = self._timed(result, 'landmarks',
+                                    lambda: face_recognition.face_landmarks(rgb, [face.box for face in faces]))
+                for face, points in zip(faces, found):
+                    face.landmarks = {feature: [list(p) for p in coords] for feature, coords in points.items()}
+        return results
+
+    def encode(self, results):
+        for result in self._usable(results):
+            faces = [face for face in result.faces if face.encoding is None]
+            if faces:
+                rgb = self._rgb(result)
+                encodings = self._timed(result, 'encode',
+                                        lambda: face_recognition.face_encodings(rgb, [face.box for face in faces]))
+                for face, encoding in zip(faces, encodings):
+                    face.encoding = encoding
+        return results
+
+    def match(self, results, shard=None):
+        gallery = self.module.gallery
+        for result in self._usable(results):
+            if not result.faces:
+                metrics.inc('recognitions', result='no_face')
+            for face in result.faces:
+                if face.encoding is None or face.name is not None:
+                    continue
+                if not len(gallery):
+                    face.name = "Unknown"
+                else:
+                    self._timed(result, 'match', lambda: self._match_face(face, shard))
+                metrics.inc('recognitions', result='unknown' if face.name == "Unknown" else 'matched')
+        return results
+
+    def _match_face(self, face, shard):
+        # One ranking serves both the match and the top-k candidates, inside the shard when it matched
+        gallery = self.module.gallery
+        ranked = self.module.rank_positions(face.encoding, shard, max(self.top_k, 1))
+        position, face.distance, face.threshold = ranked[0] if ranked else (None, None, None)
+        if position is not None and face.distance > face.threshold:
+            position = None
+        face.name = gallery.name_at(position) if position is not None else "Unknown"
+        face.student_id = gallery.student_id_at(position) if position is not None else None
+        if self.top_k:
+            face.matches = [(gallery.name_at(p), gallery.student_id_at(p), distance, threshold)
+                            for p, distance, threshold in ranked]
+
+    def annotate(self, results, copy=False):
+        # Labels every face with its name; copy=True leaves the frame itself untouched
+        for result in results:
+            if result.frame is None or result.faces is None:
+                continue
+            pixels = result.frame.pixels.copy() if copy else result.frame.pixels
+            labels = [face.name or "" for face in result.faces]
+            result.annotated = self._timed(result, 'annotate', lambda: draw_boxes(pixels, result.locations, labels))
+        return results
+
+    def _usable(self, results):
+        return [r for r in results if r.faces is not None and r.rejection is None]
+
+    def run(self, images, stages=RECOGNIZE_STAGES, shard=None, locations=None):
+        # Stage-major: every image goes through detection before any is encoded, and so on
+        results = self.ingest(images, locations, detect_only=not {'landmarks', 'encode', 'annotate'} & set(stages))
+        for stage in STAGES[1:]:
+            if stage not in stages:
+                continue
+            if stage == 'match':
+                self.match(results, shard)
+            else:
+                getattr(self, stage)(results)
+        return results
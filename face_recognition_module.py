@@ -2,80 +2,264 @@
 
 import face_recognition
 import cv2
-import numpy as np
-import pickle
-import os
+import time
+import logging
+from metrics import metrics, get_logger, log_event
+from image_ingest import as_frame
+from face_gallery import FaceGallery
+from face_pipeline import FacePipeline, draw_boxes
+
+logger = get_logger(__name__)
+
+DEFAULT_QUALITY_THRESHOLDS = {
+    'max_faces': 1,
+    'min_face_size': 80,       # shorter side of the face box, in pixels
+    'min_brightness': 50.0,    # mean grey level of the face crop
+    'max_brightness': 215.0,
+    'min_sharpness': 40.0,     # variance of the Laplacian over the face crop
+}
+
+QUALITY_MESSAGES = {
+    'no_face': "No face detected in the image. Please try again.",
+    'multiple_faces': "More than one face is in view. Please make sure only you are in the frame.",
+    'face_too_small': "Your face is too far from the camera. Please move closer.",
+    'too_dark': "The image is too dark. Please find better lighting.",
+    'too_bright': "The image is overexposed. Please move away from direct light.",
+    'blurred': "The image is blurred. Please hold still and try again.",
+}
 
 class FaceRecognitionModule:
-    def __init__(self, data_file='known_faces.pkl'):
+    def __init__(self, data_file='known_faces.pkl', tolerance=0.6, quality_thresholds=None, change_log=None,
+                 sync_interval=1.0, shard_refresh_interval=60.0, fusion='min', adaptive_thresholds=True,
+                 threshold_bounds=(0.5, 0.65), threshold_margin=2.0, memory_budget=None):
         self.data_file = data_file
-        self.known_face_encodings = []
-        self.known_face_names = []
+        # Bytes of gallery kept resident; None memory-maps every full-precision template
+        self.memory_budget = memory_budget
+        self.tolerance = tolerance
+        # Several templates per student are fused ('min', 'mean' or 'centroid' distance) and judged
+        # against a threshold calibrated from that student's own templates, within threshold_bounds and
+        # never above tolerance
+        self.fusion = fusion
+        self.adaptive_thresholds = adaptive_thresholds
+        self.threshold_bounds = threshold_bounds
+        self.threshold_margin = threshold_margin
+        self.quality_thresholds = {**DEFAULT_QUALITY_THRESHOLDS, **(quality_thresholds or {})}
+        for key, value in self.quality_thresholds.items():
+            metrics.set_gauge('quality_threshold', value, name=key)
+        # change_log is a Database; enrolments are appended there and every process tails it
+        self.change_log = change_log
+        self.sync_interval = sync_interval
+        self._last_sync = 0.0
+        # Course id -> [(student id, name)]; recognition for a course searches only its members first
+        self.shard_refresh_interval = shard_refresh_interval
+        self.shard_members = {}
+        self._shard_cache = {}
+        self._shard_revision = None
+        self._last_shard_refresh = 0.0
+        self.gallery = FaceGallery(memory_budget)
+        # Staged detect/encode/match; the methods below are thin wrappers over it
+        self.pipeline = FacePipeline(self)
         self.load_known_faces()
+        self.refresh_shards()
+
+    @property
+    def known_face_names(self):
+        return self.gallery.names
 
     def load_known_faces(self):
-        if os.path.exists(self.data_file):
-            with open(self.data_file, 'rb') as f:
-                data = pickle.load(f)
-                self.known_face_encodings = data['encodings']
-                self.known_face_names = data['names']
-            print(f"Loaded {len(self.known_face_names)} known faces")
+        # Snapshot first, then replay whatever the change log has recorded since it was written
+        self.gallery = FaceGallery.load(self.data_file, memory_budget=self.memory_budget)
+        log_event(logger, logging.INFO, "gallery_loaded", faces=len(self.gallery), version=self.gallery.version)
+        self.sync()
 
     def save_known_faces(self):
-        with open(self.data_file, 'wb') as f:
-            pickle.dump({
-                'encodings': self.known_face_encodings,
-                'names': self.known_face_names
-            }, f)
-        print(f"Saved {len(self.known_face_names)} known faces")
-
-    def add_face(self, image, name):
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        face_encodings = face_recognition.face_encodings(rgb_image)
+        self.gallery.save(self.data_file)
+        log_event(logger, logging.INFO, "gallery_saved", faces=len(self.gallery), version=self.gallery.version)
+
+    def sync(self):
+        applied = 0
+        if self.change_log is not None:
+            with metrics.timer('gallery_sync'):
+                applied = self.gallery.apply(self.change_log.get_face_changes(self.gallery.version))
+            if applied:
+                log_event(logger, logging.INFO, "gallery_synced", changes=applied, version=self.gallery.version)
+        self._last_sync = time.monotonic()
+        metrics.set_gauge('gallery_faces', len(self.gallery))
+        metrics.set_gauge('gallery_resident_bytes', self.gallery.resident_bytes())
+        metrics.set_gauge('gallery_version', self.gallery.version)
+        return applied
+
+    def maybe_sync(self):
+        # Called on the hot path; polls the change log at most once per sync_interval
+        now = time.monotonic()
+        if self.change_log is not None and now - self._last_shard_refresh >= self.shard_refresh_interval:
+            self.refresh_shards()
+        if now - self._last_sync >= self.sync_interval:
+            return self.sync()
+        return 0
+
+    def refresh_shards(self, course_members=None):
+        if course_members is None and self.change_log is not None:
+            course_members = self.change_log.get_course_members()
+        self.shard_members = course_members or {}
+        self._shard_cache = {}
+        self._last_shard_refresh = time.monotonic()
+
+    def _shard(self, shard):
+        # Contiguous slice of the gallery's coarse index for one course, rebuilt lazily after the gallery changes
+        if self._shard_revision != self.gallery.revision:
+            self._shard_cache = {}
+            self._shard_revision = self.gallery.revision
+        if shard not in self._shard_cache:
+            members = self.shard_members.get(shard, [])
+            positions = self.gallery.positions_for([m[0] for m in members], [m[1] for m in members])
+            self._shard_cache[shard] = self.gallery.view(positions)
+        return self._shard_cache[shard]
+
+    def add_face(self, image, name, student_id=None, source=None, face_locations=None, save=True):
+        # Pass face_locations (or a PipelineResult as image) from an earlier detection to skip detecting again.
+        # save=False leaves writing the gallery file to the caller, e.g. once after a batch of changes.
+        result, = self.pipeline.run([image], ('ingest', 'detect', 'encode'),
+                                    locations=None if face_locations is None else [face_locations])
+        face_encodings = [face.encoding for face in result.faces if face.encoding is not None]
         if face_encodings:
-            self.known_face_encodings.append(face_encodings[0])
-            self.known_face_names.append(name)
-            self.save_known_faces()
-            print(f"Debug: Face added for {name}")
+            self.add_template(name, face_encodings[0], student_id, source, save)
+            metrics.inc('faces_added', result='added')
+            log_event(logger, logging.DEBUG, "face_added", name=name)
             return True
-        print(f"Debug: Failed to add face for {name}")
+        metrics.inc('faces_added', result='no_face')
+        log_event(logger, logging.DEBUG, "face_add_failed", name=name)
         return False
 
-    def recognize_face(self, image):
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        face_locations = face_recognition.face_locations(rgb_image)
-        print(f"Debug: Face locations detected: {face_locations}")
-        
-        face_encodings = face_recognition.face_encodings(rgb_image, face_locations)
-        print(f"Debug: Number of face encodings: {len(face_encodings)}")
+    def add_template(self, name, encoding, student_id=None, source=None, save=True):
+        if self.change_log is None:
+            template_id = self.gallery.add(None, name, encoding, student_id, source)
+        else:
+            template_id = self.change_log.append_face_change('add', name=name, encoding=encoding,
+                                                             student_id=student_id, source=source)
+            self.sync()
+        if save:
+            self.save_known_faces()
+        return template_id
+
+    def remove_template(self, template_id, save=True):
+        if self.change_log is None:
+            removed = self.gallery.remove(template_id)
+        else:
+            # Caught up first, so a template another process already removed is not logged again
+            self.sync()
+            removed = template_id in self.gallery
+            if removed:
+                self.change_log.append_face_change('remove', template_id=template_id)
+                self.sync()
+        if save:
+            self.save_known_faces()
+        return removed
 
+    def detect_faces(self, rgb_image):
+        with metrics.timer('detect'):
+            face_locations = face_recognition.face_locations(rgb_image)
+        log_event(logger, logging.DEBUG, "faces_detected", locations=face_locations)
+        return face_locations
+
+    def encode_faces(self, rgb_image, face_locations):
+        with metrics.timer('encode'):
+            face_encodings = face_recognition.face_encodings(rgb_image, face_locations)
+        log_event(logger, logging.DEBUG, "faces_encoded", count=len(face_encodings))
+        return face_encodings
+
+    def _match(self, face_encoding, view=None):
+        return self.gallery.match(face_encoding, view, fusion=self.fusion, default_threshold=self.tolerance,
+                                  adaptive=self.adaptive_thresholds, margin=self.threshold_margin,
+                                  bounds=self.threshold_bounds)
+
+    def _rank(self, face_encoding, limit, view=None):
+        return self.gallery.rank(face_encoding, view, fusion=self.fusion, default_threshold=self.tolerance,
+                                 adaptive=self.adaptive_thresholds, limit=limit, margin=self.threshold_margin,
+                                 bounds=self.threshold_bounds)
+
+    def rank_positions(self, face_encoding, shard=None, limit=1):
+        # [(gallery position, fused distance, threshold)] best first, all from one search space: the course
+        # shard when its best candidate is a confident match, else the whole campus
+        if shard is not None:
+            ranked = self._rank(face_encoding, limit, self._shard(shard))
+            hit = bool(ranked) and ranked[0][1] <= ranked[0][2]
+            metrics.inc('shard_searches', result='hit' if hit else 'fallback')
+            if hit:
+                return ranked
+        return self._rank(face_encoding, limit)
+
+    def match_position(self, face_encoding, shard=None):
+        # Returns (gallery position or None, fused distance, threshold)
+        ranked = self.rank_positions(face_encoding, shard)
+        if not ranked:
+            return None, None, None
+        position, distance, threshold = ranked[0]
+        return (position if distance <= threshold else None), distance, threshold
+
+    def match_encoding(self, face_encoding, shard=None):
+        # Returns (name, fused distance, threshold); name is "Unknown" when nothing is within threshold
+        position, distance, threshold = self.match_position(face_encoding, shard)
+        name = self.gallery.name_at(position) if position is not None else "Unknown"
+        log_event(logger, logging.DEBUG, "face_matched", name=name, distance=distance, threshold=threshold)
+        return name, distance, threshold
+
+    def match_faces(self, face_encodings, shard=None):
         face_names = []
-        for face_encoding in face_encodings:
-            if not self.known_face_encodings:
-                print("Debug: No known face encodings to compare against")
-                name = "Unknown"
-            else:
-                matches = face_recognition.compare_faces(self.known_face_encodings, face_encoding)
-                print(f"Debug: Face matches: {matches}")
-                name = "Unknown"
-
-                face_distances = face_recognition.face_distance(self.known_face_encodings, face_encoding)
-                print(f"Debug: Face distances: {face_distances}")
-                best_match_index = np.argmin(face_distances)
-                if matches[best_match_index]:
-                    name = self.known_face_names[best_match_index]
-                    print(f"Debug: Face recognized as {name}")
+        with metrics.timer('match'):
+            for face_encoding in face_encodings:
+                if not len(self.gallery):
+                    log_event(logger, logging.DEBUG, "gallery_empty")
+                    name = "Unknown"
                 else:
-                    print("Debug: Face not recognized")
+                    name, _, _ = self.match_encoding(face_encoding, shard)
+
+                metrics.inc('recognitions', result='unknown' if name == "Unknown" else 'matched')
+                face_names.append(name)
+
+        return face_names
+
+    def check_quality(self, rgb_image, face_locations, scale=1.0):
+        # Cheap checks on the detector output; returns a reason code or None if the frame is usable.
+        # scale: source pixels per frame pixel, so a reduced decode is held to the same minimum face size.
+        limits = self.quality_thresholds
+        if not face_locations:
+            return 'no_face'
+        if len(face_locations) > limits['max_faces']:
+            return 'multiple_faces'
+
+        top, right, bottom, left = max(face_locations, key=lambda box: (box[2] - box[0]) * (box[1] - box[3]))
+        if min(bottom - top, right - left) * scale < limits['min_face_size']:
+            return 'face_too_small'
+
+        crop = cv2.cvtColor(rgb_image[max(top, 0):bottom, max(left, 0):right], cv2.COLOR_RGB2GRAY)
+        brightness = float(crop.mean())
+        if brightness < limits['min_brightness']:
+            return 'too_dark'
+        if brightness > limits['max_brightness']:
+            return 'too_bright'
+        if cv2.Laplacian(crop, cv2.CV_64F).var() < limits['min_sharpness']:
+            return 'blurred'
+        return None
 
-            face_names.append(name)
+    def screen_frame(self, image):
+        # Detect once and gate the frame before the expensive encoding pass. A path or file is draft-decoded
+        # at reduced size; the boxes returned are in source-image coordinates either way.
+        result, = self.pipeline.run([image], ('ingest', 'detect', 'quality'))
+        if result.rejection:
+            log_event(logger, logging.DEBUG, "frame_rejected", reason=result.rejection)
+            return False, result.rejection, result.source_locations()
+        return True, None, result.source_locations()
 
-        return face_locations, face_names
+    def recognize_face(self, image, face_locations=None, shard=None):
+        # Accepts a Frame from ingest_image or an RGB array; only BGR frames pay for a conversion.
+        # Pass face_locations from screen_frame to skip a second detection pass, and the course
+        # id as shard to search that course's students before the whole gallery.
+        # The pipeline's PipelineResult keeps distances, top-k candidates and timings as well.
+        result, = self.pipeline.run([image], ('ingest', 'detect', 'encode', 'match'), shard,
+                                    None if face_locations is None else [face_locations])
+        return result.locations, result.names
 
     def draw_faces(self, image, face_locations, face_names):
-        for (top, right, bottom, left), name in zip(face_locations, face_names):
-            cv2.rectangle(image, (left, top), (right, bottom), (0, 255, 0), 2)
-            cv2.rectangle(image, (left, bottom - 35), (right, bottom), (0, 255, 0), cv2.FILLED)
-            font = cv2.FONT_HERSHEY_DUPLEX
-            cv2.putText(image, name, (left + 6, bottom - 6), font, 0.5, (255, 255, 255), 1)
-        return image
\ No newline at end of file
+        # Draws in place on the caller's buffer
+        return draw_boxes(as_frame(image).pixels, face_locations, face_names)
@@ -0,0 +1,59 @@
+# File: image_ingest.py
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+class Frame:
+    # A decoded image plus the metadata the recognition chain needs to avoid guessing:
+    # the channel order of `pixels` and how much smaller it is than the source image.
+    __slots__ = ('pixels', 'color_space', 'scale')
+
+    def __init__(self, pixels, color_space='RGB', scale=1.0):
+        self.pixels = pixels
+        self.color_space = color_space
+        self.scale = scale
+
+    @property
+    def shape(self):
+        return self.pixels.shape
+
+    def rgb(self):
+        if self.color_space == 'RGB':
+            return self.pixels
+        if self.color_space == 'BGR':
+            return cv2.cvtColor(self.pixels, cv2.COLOR_BGR2RGB)
+        raise ValueError(f"Unsupported colour space: {self.color_space}")
+
+    def to_source_locations(self, face_locations):
+        # Map boxes found on a reduced decode back to source-image coordinates
+        if self.scale == 1.0:
+            return list(face_locations)
+        return [tuple(int(round(v * self.scale)) for v in box) for box in face_locations]
+
+
+def ingest_image(source, detect_only=False, max_side=640):
+    # `source` is anything PIL can open: a path, a file object or Streamlit's UploadedFile
+    image = Image.open(source)
+    width, height = image.size
+    longest = max(width, height)
+    if detect_only and longest > max_side:
+        # JPEG only: let the decoder scale down by 1/2, 1/4 or 1/8 instead of decoding the full frame
+        image.draft('RGB', (width * max_side // longest, height * max_side // longest))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    # One copy out of PIL's buffer into a writable, C-contiguous uint8 array reused by every stage
+    pixels = np.array(image, dtype=np.uint8, order='C')
+    return Frame(pixels, 'RGB', width / pixels.shape[1])
+
+
+def as_frame(image):
+    # Plain arrays handed to the module come from PIL (np.array(Image.open(...))) and are RGB
+    if isinstance(image, Frame):
+        return image
+    pixels = np.ascontiguousarray(image, dtype=np.uint8)
+    if pixels.ndim == 3 and pixels.shape[2] == 4:
+        pixels = np.ascontiguousarray(pixels[:, :, :3])
+    return Frame(pixels, 'RGB')
@@ -0,0 +1,248 @@
+# File: load_test.py
+
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from benchmark import generate_database, synthetic_frame
+from attendance_journal import AttendanceJournal, JournalReconciler
+from database import Database
+from image_ingest import ingest_image, as_frame
+from metrics import metrics
+from timetable import Timetable, SessionCloser
+
+STAGES = ('login', 'recognize', 'mark', 'checkin')
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))] * 1000
+
+
+class LoadStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {stage: [] for stage in STAGES}
+        self.errors = {stage: {} for stage in STAGES}
+        # Completed attempts by result, e.g. recognitions that matched, found no face or were rejected
+        self.outcomes = {stage: {} for stage in STAGES}
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def error(self, stage, reason):
+        with self._lock:
+            self.errors[stage][reason] = self.errors[stage].get(reason, 0) + 1
+
+    def outcome(self, stage, result):
+        with self._lock:
+            self.outcomes[stage][result] = self.outcomes[stage].get(result, 0) + 1
+
+    def report(self, wall_seconds):
+        stages = {}
+        for stage in STAGES:
+            samples = self.samples[stage]
+            failed = sum(self.errors[stage].values())
+            attempts = len(samples) + failed
+            stages[stage] = {
+                'ok': len(samples),
+                'errors': self.errors[stage],
+                'outcomes': self.outcomes[stage],
+                'error_rate': failed / attempts if attempts else 0.0,
+                'p50_ms': percentile(samples, 0.50),
+                'p95_ms': percentile(samples, 0.95),
+                'p99_ms': percentile(samples, 0.99),
+                'per_sec': len(samples) / wall_seconds if wall_seconds else None,
+            }
+        return stages
+
+
+class VirtualStudent:
+    # One student walking up to the door: log in, then mark In by face or by hand, as student_view does.
+    # Marks go through Timetable.record, the same session attach and kiosk journal as the app.
+    def __init__(self, db, timetable, pool, student, password, frame, stats, face):
+        self.db = db
+        self.timetable = timetable
+        self.pool = pool
+        self.student = student
+        self.password = password
+        self.frame = frame
+        self.stats = stats
+        self.face = face
+
+    def _timed(self, stage, func, ok=bool):
+        # Only successful attempts become latency samples; failures are counted once, as errors, by the caller
+        start = time.perf_counter()
+        result = func()
+        if ok(result):
+            self.stats.record(stage, time.perf_counter() - start)
+        return result
+
+    def check_in(self):
+        start = time.perf_counter()
+        try:
+            user = self._timed('login', lambda: self.db.check_user(self.student['username'], self.password))
+            if not user:
+                self.stats.error('login', 'rejected')
+                return
+
+            is_manual = not self.face
+            if self.face:
+                submitted, job = self.pool.submit_recognize(self.frame, shard=self.student['course_id'])
+                if not submitted:
+                    self.stats.error('recognize', 'busy')
+                    return
+                # Every completed round trip is a latency sample, whatever it found
+                status, result = self._timed('recognize', lambda: self.pool.wait(job),
+                                             lambda outcome: outcome[0] == self.pool.DONE)
+                if status != self.pool.DONE:
+                    self.stats.error('recognize', status)
+                    return
+                _, names, rejection = result
+                outcome = rejection or ('no_face' if not names else 'unknown' if names[0] == "Unknown" else 'matched')
+                self.stats.outcome('recognize', outcome)
+                if outcome != 'matched':
+                    # student_view marks nothing for this capture; the student falls back to marking by hand
+                    is_manual = True
+
+            time_of_mark = datetime.now().strftime("%H:%M:%S")
+            success, message, _ = self._timed('mark', lambda: self.timetable.record(
+                self.student['student_id'], self.student['course_id'], "In", time_of_mark, is_manual),
+                lambda outcome: outcome[0])
+            if not success:
+                self.stats.error('mark', message)
+                return
+            self.stats.record('checkin', time.perf_counter() - start)
+        except Exception as e:
+            self.stats.error('checkin', type(e).__name__)
+
+
+def load_frames(faces_dir, count, rng):
+    # Real captures give realistic detector cost; otherwise noise frames the size of a webcam shot
+    if faces_dir:
+        paths = sorted(glob.glob(os.path.join(faces_dir, '*.jpg')) + glob.glob(os.path.join(faces_dir, '*.png')))
+        if paths:
+            return [ingest_image(path) for path in paths]
+    return [as_frame(synthetic_frame(640, 480, rng)) for _ in range(count)]
+
+
+def run_storm(db, timetable, pool, students, password, frames, concurrency, ramp, face_ratio, seed):
+    rng = random.Random(seed)
+    stats = LoadStats()
+    # Every student arrives at a random moment inside the ramp window: a check-in storm before class
+    arrivals = sorted(((rng.uniform(0, ramp), student) for student in students), key=lambda a: a[0])
+    start = time.perf_counter()
+
+    def arrive(arrival, virtual):
+        delay = arrival - (time.perf_counter() - start)
+        if delay > 0:
+            time.sleep(delay)
+        virtual.check_in()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, (arrival, student) in enumerate(arrivals):
+            virtual = VirtualStudent(db, timetable, pool, student, password, frames[i % len(frames)], stats,
+                                     face=rng.random() < face_ratio)
+            executor.submit(arrive, arrival, virtual)
+    return stats, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate a check-in storm against the portal code paths.')
+    parser.add_argument('--students', type=int, default=200, help='Virtual students checking in')
+    parser.add_argument('--concurrency', type=int, default=32, help='Simultaneous sessions (Streamlit script threads)')
+    parser.add_argument('--ramp', type=float, default=10.0, help='Seconds over which students arrive')
+    parser.add_argument('--face-ratio', type=float, default=0.7, help='Share of students using facial recognition')
+    parser.add_argument('--workers', type=int, default=None, help='Recognition worker processes')
+    parser.add_argument('--faces-dir', help='Directory of capture images to send instead of synthetic frames')
+    parser.add_argument('--db', help='Existing database to load; by default a generated one in a temp directory')
+    parser.add_argument('--data-file', help='Face gallery to recognise against; by default an empty one')
+    parser.add_argument('--password', default='benchmark', help='Password shared by the virtual students')
+    parser.add_argument('--kiosk', action='store_true',
+                        help='Acknowledge marks from a kiosk journal, as with STUDENT_PORTAL_KIOSK_JOURNAL')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', help='Write the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    from recognition_worker import RecognitionWorkerPool
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        db_name = args.db or os.path.join(tmp, 'load_test.db')
+        if args.db:
+            db = Database(db_name)
+        else:
+            per_course = max(1, args.students // 6)
+            db = generate_database(db_name, semesters=1, students_per_course=per_course, seed=args.seed)
+
+        with db.backend.transaction() as c:
+            c.execute('''SELECT users.username, students.id AS student_id, student_courses.course_id FROM students
+                         INNER JOIN users ON users.id = students.user_id
+                         INNER JOIN student_courses ON student_courses.student_id = students.id LIMIT ?''',
+                      (args.students,))
+            students = [dict(row) for row in c.fetchall()]
+
+        data_file = args.data_file or os.path.join(tmp, 'load_test_faces.pkl')
+        pool = RecognitionWorkerPool(data_file, db_name, workers=args.workers,
+                                     max_pending=args.concurrency * 2, cache_size=0)
+        frames = load_frames(args.faces_dir, 16, np.random.default_rng(args.seed))
+        # The same background threads as the app: journal replay in kiosk mode, timetable reload and auto-close
+        journal = background = None
+        if args.kiosk:
+            journal = AttendanceJournal(os.path.join(tmp, 'load_test_journal.jsonl'))
+            journal.load_open_sessions(db, datetime.now().strftime("%Y-%m-%d"))
+            background = JournalReconciler(journal, db).start()
+        timetable = Timetable(db, journal=journal)
+        timetable.reload()
+        closer = SessionCloser(timetable).start()
+        try:
+            stats, wall = run_storm(db, timetable, pool, students, args.password, frames, args.concurrency,
+                                    args.ramp, args.face_ratio, args.seed)
+        finally:
+            closer.stop()
+            if background is not None:
+                background.stop()
+                journal.reconcile(db)
+            pool.shutdown()
+            db.close()
+
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'students': len(students),
+            'concurrency': args.concurrency,
+            'ramp_seconds': args.ramp,
+            'face_ratio': args.face_ratio,
+            'workers': pool.workers,
+            'wall_seconds': round(wall, 3),
+        },
+        'stages': stats.report(wall),
+        'server_stages': metrics.stage_summary(),
+    }
+    for stage, row in report['stages'].items():
+        p50, p95, p99 = (f"{row[k]:9.1f}" if row[k] is not None else "      n/a" for k in ('p50_ms', 'p95_ms', 'p99_ms'))
+        print(f"{stage:10s} ok {row['ok']:6d}  err {row['error_rate']:6.1%}  p50 {p50} ms  p95 {p95} ms  "
+              f"p99 {p99} ms  {row['per_sec'] or 0:7.1f}/s")
+        if row['outcomes']:
+            print(f"{'':10s} " + '  '.join(f"{result} {count}" for result, count in sorted(row['outcomes'].items())))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote report to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+# File: maintenance.py
+
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import date
+
+from database import Database
+from metrics import metrics
+
+ARCHIVE_DIR = 'archive'
+TERM_MONTHS = 6
+
+# Rows whose student or course no longer exists
+ORPHAN_QUERIES = {
+    'attendance_events': 'DELETE FROM attendance_events WHERE student_id NOT IN (SELECT id FROM students)',
+    'attendance': 'DELETE FROM attendance WHERE student_id NOT IN (SELECT id FROM students)',
+    'student_courses': '''DELETE FROM student_courses WHERE student_id NOT IN (SELECT id FROM students)
+                          OR course_id NOT IN (SELECT id FROM courses)''',
+    'enrolment_queue': 'DELETE FROM enrolment_queue WHERE student_id NOT IN (SELECT id FROM students)',
+    'course_sessions': 'DELETE FROM course_sessions WHERE course_id NOT IN (SELECT id FROM courses)',
+}
+
+# attendance_events columns in archive order; session_id and flag were added after the first archives
+EVENT_COLUMNS = ('id', 'student_id', 'course_id', 'date', 'event_type', 'time', 'method', 'created_at',
+                 'session_id', 'flag')
+
+
+def term_of(day):
+    # Terms are half years: 2026-1 is January to June, 2026-2 July to December
+    year, month = int(day[:4]), int(day[5:7])
+    return f"{year}-{(month - 1) // TERM_MONTHS + 1}"
+
+
+def term_start(term):
+    year, half = term.split('-')
+    return f"{year}-{(int(half) - 1) * TERM_MONTHS + 1:02d}-01"
+
+
+def archive_path(archive_dir, term):
+    return os.path.join(archive_dir, f"attendance_{term}.db")
+
+
+def database_size(conn):
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return {'bytes': page_size * page_count, 'free_bytes': page_size * free_pages}
+
+
+def clean_orphans(conn):
+    removed = {}
+    for table, query in ORPHAN_QUERIES.items():
+        removed[table] = conn.execute(query).rowcount
+    conn.commit()
+    return removed
+
+
+def archive_terms(conn, archive_dir=ARCHIVE_DIR, keep_terms=2, today=None):
+    # Moves attendance events of every term older than the newest `keep_terms` into
+    # archive/attendance_<term>.db. Each term is copied and deleted in one transaction.
+    today = today or date.today().isoformat()
+    current = term_of(today)
+    year, half = map(int, current.split('-'))
+    index = year * 2 + half - 1 - (keep_terms - 1)
+    cutoff = term_start(f"{index // 2}-{index % 2 + 1}")
+
+    terms = sorted({term_of(row[0]) for row in
+                    conn.execute('SELECT DISTINCT date FROM attendance_events WHERE date < ?', (cutoff,))})
+    archived = {}
+    os.makedirs(archive_dir, exist_ok=True)
+    for term in terms:
+        # ATTACH is not allowed inside a transaction
+        conn.commit()
+        conn.execute('ATTACH DATABASE ? AS term_archive', (archive_path(archive_dir, term),))
+        try:
+            conn.execute('''CREATE TABLE IF NOT EXISTS term_archive.attendance_events
+                            (id INTEGER PRIMARY KEY, student_id INTEGER, course_id INTEGER, date TEXT,
+                            event_type TEXT, time TEXT, method TEXT, created_at TEXT, session_id INTEGER, flag TEXT)''')
+            existing = _columns(conn, 'term_archive')
+            if 'session_id' not in existing:
+                conn.execute('ALTER TABLE term_archive.attendance_events ADD COLUMN session_id INTEGER')
+                conn.execute('ALTER TABLE term_archive.attendance_events ADD COLUMN flag TEXT')
+            start, end = term_start(term), min(_next_term_start(term), cutoff)
+            columns = ', '.join(EVENT_COLUMNS)
+            conn.execute(f'''INSERT OR IGNORE INTO term_archive.attendance_events ({columns})
+                             SELECT {columns} FROM main.attendance_events WHERE date >= ? AND date < ?''', (start, end))
+            archived[term] = conn.execute('DELETE FROM main.attendance_events WHERE date >= ? AND date < ?',
+                                          (start, end)).rowcount
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute('DETACH DATABASE term_archive')
+    return archived
+
+
+def _columns(conn, schema):
+    return {row[1] for row in conn.execute(f'PRAGMA {schema}.table_info(attendance_events)')}
+
+
+def _event_select(conn, schema):
+    # Archives written before a column existed read it as NULL
+    existing = _columns(conn, schema)
+    return 'SELECT ' + ', '.join(column if column in existing else f'NULL AS {column}' for column in EVENT_COLUMNS) + \
+        f' FROM {schema}.attendance_events'
+
+
+def _next_term_start(term):
+    year, half = map(int, term.split('-'))
+    return term_start(f"{year + 1}-1" if half == 2 else f"{year}-2")
+
+
+def open_history(db_name='students.db', archive_dir=ARCHIVE_DIR):
+    # Connection with a TEMP view `attendance_history` over the hot table plus every term archive.
+    # Newer terms are attached directly. When there are more archives than SQLite can attach (10 by
+    # default), the oldest ones are copied into a TEMP table one at a time instead.
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    selects = [_event_select(conn, 'main')]
+    archives = sorted(glob.glob(os.path.join(archive_dir, 'attendance_*.db')))
+    conn.setlimit(sqlite3.SQLITE_LIMIT_ATTACHED, len(archives))
+    slots = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(archives) > slots:
+        # One slot stays free for copying the older archives in
+        older, archives = archives[:len(archives) - slots + 1], archives[len(archives) - slots + 1:]
+        columns = ', '.join(EVENT_COLUMNS)
+        conn.execute(f'CREATE TEMP TABLE older_terms AS SELECT {columns} FROM main.attendance_events WHERE 0')
+        for path in older:
+            conn.execute('ATTACH DATABASE ? AS term_copy', (path,))
+            conn.execute(f'INSERT INTO temp.older_terms {_event_select(conn, "term_copy")}')
+            conn.commit()
+            conn.execute('DETACH DATABASE term_copy')
+        selects.append(f'SELECT {columns} FROM temp.older_terms')
+    for i, path in enumerate(archives):
+        conn.execute('ATTACH DATABASE ? AS ?', (path, f"term_{i}"))
+        selects.append(_event_select(conn, f"term_{i}"))
+    conn.execute(f"CREATE TEMP VIEW attendance_history AS {' UNION ALL '.join(selects)}")
+    return conn
+
+
+def optimize(conn):
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA optimize')
+    conn.commit()
+
+
+def incremental_vacuum(conn, pages=0):
+    # Incremental vacuum needs auto_vacuum=INCREMENTAL, which only takes effect after one full VACUUM
+    converted = False
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        converted = True
+    conn.execute(f'PRAGMA incremental_vacuum({int(pages)})' if pages else 'PRAGMA incremental_vacuum')
+    conn.commit()
+    return converted
+
+
+def run_maintenance(db, archive_dir=ARCHIVE_DIR, keep_terms=2, vacuum_pages=0, archive=True):
+    # Returns a report with per-step timings and the database size before and after
+    if db.backend.name != 'sqlite':
+        return _run_postgres_maintenance(db)
+
+    report = {'steps': {}}
+    with db.backend.connection() as conn:
+        conn.commit()
+        report['size_before'] = database_size(conn)
+        steps = [('orphans', lambda: clean_orphans(conn))]
+        if archive:
+            steps.append(('archive', lambda: archive_terms(conn, archive_dir, keep_terms)))
+        steps.append(('optimize', lambda: optimize(conn)))
+        steps.append(('incremental_vacuum', lambda: incremental_vacuum(conn, vacuum_pages)))
+        for step, run in steps:
+            start = time.perf_counter()
+            with metrics.timer(f"maintenance_{step}"):
+                result = run()
+            report['steps'][step] = {'seconds': round(time.perf_counter() - start, 4), 'result': result}
+        report['size_after'] = database_size(conn)
+    return report
+
+
+def _run_postgres_maintenance(db):
+    # The server's autovacuum reclaims space; refresh planner statistics and clear orphans
+    report = {'steps': {}}
+    with db.backend.transaction() as c:
+        start = time.perf_counter()
+        removed = {}
+        for table, query in ORPHAN_QUERIES.items():
+            c.execute(query)
+            removed[table] = c.rowcount
+        report['steps']['orphans'] = {'seconds': round(time.perf_counter() - start, 4), 'result': removed}
+        start = time.perf_counter()
+        c.execute('ANALYZE')
+        report['steps']['optimize'] = {'seconds': round(time.perf_counter() - start, 4), 'result': None}
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain the attendance database.')
+    parser.add_argument('--db', default=os.environ.get('STUDENT_PORTAL_DB', 'students.db'))
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    parser.add_argument('--keep-terms', type=int, default=2, help='Terms kept in the main database')
+    parser.add_argument('--no-archive', action='store_true')
+    parser.add_argument('--vacuum-pages', type=int, default=0, help='Free pages to reclaim (0 = all)')
+    args = parser.parse_args(argv)
+
+    db = Database(args.db)
+    report = run_maintenance(db, args.archive_dir, args.keep_terms, args.vacuum_pages, not args.no_archive)
+    db.close()
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
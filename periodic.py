@@ -0,0 +1,38 @@
+# File: periodic.py
+
+import logging
+import threading
+
+from metrics import metrics, get_logger, log_event
+
+
+class PeriodicWorker:
+    # Background thread that calls step() every `interval` seconds until stopped. A step that raises is
+    # counted under error_metric, logged as error_event on the subclass's module logger, and simply
+    # retried on the next pass.
+    error_metric = 'periodic_errors'
+    error_event = 'periodic_step_failed'
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def step(self):
+        raise NotImplementedError
+
+    def _run(self):
+        logger = get_logger(type(self).__module__)
+        while not self._stop.wait(self.interval):
+            try:
+                self.step()
+            except Exception as e:
+                metrics.inc(self.error_metric)
+                log_event(logger, logging.WARNING, self.error_event, error=e)
@@ -0,0 +1,255 @@
+# File: process_video.py
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+
+from database import Database
+from image_ingest import Frame
+from metrics import metrics
+from recognition_worker import _init_worker, _run_pipeline
+from timetable import Timetable
+
+VIDEO_STAGES = ('ingest', 'detect', 'encode', 'match')
+
+
+def scene_change(previous, current):
+    # Mean absolute difference of small greyscale thumbnails, 0-255
+    return float(np.mean(cv2.absdiff(previous, current)))
+
+
+def iter_frames(path, min_interval=1.0, max_interval=8.0, change_threshold=6.0, max_side=960):
+    # Yields (seconds into the video, Frame) without holding more than one decoded frame. The gap between
+    # samples doubles while the scene is still and drops back to min_interval as soon as it changes.
+    # Frames in between are only grabbed (demuxed), never converted.
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Cannot open video: {path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    interval, next_at, index, thumbnail = min_interval, 0.0, 0, None
+    try:
+        while capture.grab():
+            seconds = index / fps
+            index += 1
+            if seconds < next_at:
+                continue
+            ok, pixels = capture.retrieve()
+            if not ok:
+                break
+            height, width = pixels.shape[:2]
+            scale = max(height, width) / max_side
+            if scale > 1:
+                pixels = cv2.resize(pixels, (int(width / scale), int(height / scale)), interpolation=cv2.INTER_AREA)
+            current = cv2.cvtColor(cv2.resize(pixels, (64, 36)), cv2.COLOR_BGR2GRAY)
+            if thumbnail is not None and scene_change(thumbnail, current) < change_threshold:
+                interval = min(interval * 2, max_interval)
+            else:
+                interval = min_interval
+            thumbnail = current
+            next_at = seconds + interval
+            yield seconds, Frame(np.ascontiguousarray(pixels), 'BGR', max(scale, 1.0))
+    finally:
+        capture.release()
+
+
+def batched(frames, size):
+    batch = []
+    for item in frames:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class IdentityVotes:
+    # Sightings of each student across sampled frames. A student counts as present with at least
+    # min_votes confident sightings; the first and last sightings become the In and Out.
+    def __init__(self, min_votes=3, min_margin=0.05):
+        self.min_votes = min_votes
+        self.min_margin = min_margin
+        self.sightings = {}
+        self.unknown = 0
+
+    def add(self, seconds, result):
+        for face in result.faces or []:
+            if face.student_id is None or face.distance is None:
+                self.unknown += 1
+                continue
+            # Margin: how far inside its own threshold the match is, 0 at the threshold
+            margin = 1 - face.distance / face.threshold
+            if margin < self.min_margin:
+                self.unknown += 1
+                continue
+            entry = self.sightings.setdefault(face.student_id, {'name': face.name, 'votes': 0, 'margins': [],
+                                                                'first': seconds, 'last': seconds})
+            entry['votes'] += 1
+            entry['margins'].append(margin)
+            entry['first'] = min(entry['first'], seconds)
+            entry['last'] = max(entry['last'], seconds)
+
+    def present(self):
+        return {student_id: entry for student_id, entry in self.sightings.items() if entry['votes'] >= self.min_votes}
+
+
+def recognise_video(executor, path, votes, shard, batch_size, max_in_flight, offset, sampling):
+    # Streams frames to the pool, keeping at most max_in_flight batches outstanding
+    stats = {'sampled': 0, 'faces': 0}
+    in_flight = deque()
+
+    def collect(done_only):
+        while in_flight and (not done_only or in_flight[0][1].done()):
+            times, future = in_flight.popleft()
+            results, worker_metrics, _ = future.result()
+            metrics.merge(worker_metrics)
+            for seconds, result in zip(times, results):
+                stats['faces'] += len(result.faces or [])
+                votes.add(offset + seconds, result)
+
+    for batch in batched(iter_frames(path, **sampling), batch_size):
+        stats['sampled'] += len(batch)
+        in_flight.append(([seconds for seconds, _ in batch],
+                          executor.submit(_run_pipeline, [frame for _, frame in batch], VIDEO_STAGES, shard)))
+        collect(done_only=True)
+        if len(in_flight) >= max_in_flight:
+            wait([in_flight[0][1]], return_when=FIRST_COMPLETED)
+            collect(done_only=True)
+    collect(done_only=False)
+    return stats
+
+
+def attendance_entries(present, course_id, day, start, session=None, timetable=None):
+    entries = []
+    for student_id, entry in sorted(present.items()):
+        for attendance_type, seconds in (("In", entry['first']), ("Out", entry['last'])):
+            time_text = (start + timedelta(seconds=int(seconds))).strftime("%H:%M:%S")
+            entries.append({
+                'student_id': student_id,
+                'course_id': course_id,
+                'date': day,
+                'type': attendance_type,
+                'time': time_text,
+                'method': 'video',
+                'session_id': session['id'] if session else None,
+                'flag': timetable.flag(session, attendance_type, time_text) if session else None,
+            })
+    return entries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Mark attendance offline from recorded classroom video.')
+    parser.add_argument('videos', nargs='+', help='Video files of one class meeting, in recording order')
+    parser.add_argument('--db', default=os.environ.get('STUDENT_PORTAL_DB', 'students.db'))
+    parser.add_argument('--data-file', default='known_faces.pkl')
+    parser.add_argument('--session-id', type=int, help='Timetabled session the recording belongs to')
+    parser.add_argument('--course', help='Course name, when there is no timetabled session')
+    parser.add_argument('--date', help='YYYY-MM-DD of the recording (default: from the session, else today)')
+    parser.add_argument('--start', help='HH:MM[:SS] wall-clock time at the start of the first video')
+    parser.add_argument('--workers', type=int, default=None, help='Recognition processes')
+    parser.add_argument('--memory-budget-mb', type=float, help='Gallery memory per recognition process')
+    parser.add_argument('--batch-size', type=int, default=8, help='Frames per worker task')
+    parser.add_argument('--min-interval', type=float, default=1.0, help='Seconds between samples while the scene changes')
+    parser.add_argument('--max-interval', type=float, default=8.0, help='Longest gap between samples of a still scene')
+    parser.add_argument('--min-votes', type=int, default=3, help='Confident sightings needed to count a student')
+    parser.add_argument('--min-margin', type=float, default=0.05, help='Minimum relative distance inside threshold')
+    parser.add_argument('--dry-run', action='store_true', help='Report without writing attendance')
+    parser.add_argument('--output', help='Write the summary report to this JSON file')
+    args = parser.parse_args(argv)
+
+    db = Database(args.db)
+    timetable = Timetable(db)
+    session = None
+    if args.session_id is not None:
+        session = db.get_course_session(args.session_id)
+        if session is None:
+            print(f"Unknown session: {args.session_id}")
+            return 1
+        course_id = session['course_id']
+    else:
+        course_id = db.course_id(args.course) if args.course else None
+        if course_id is None:
+            print("Give --session-id, or --course with the name of an existing course.")
+            return 1
+    day = args.date or (session['date'] if session else datetime.now().strftime("%Y-%m-%d"))
+    start_text = args.start or (session['start_time'] if session else None)
+    if start_text is None:
+        print("Give --start: the wall-clock time at which the recording begins.")
+        return 1
+    start = datetime.strptime(f"{day} {start_text if start_text.count(':') == 2 else start_text + ':00'}",
+                              "%Y-%m-%d %H:%M:%S")
+
+    workers = args.workers or os.cpu_count() or 1
+    budget = int(args.memory_budget_mb * 2 ** 20) if args.memory_budget_mb else None
+    votes = IdentityVotes(args.min_votes, args.min_margin)
+    sampling = {'min_interval': args.min_interval, 'max_interval': args.max_interval}
+    videos, offset = [], 0.0
+    began = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(args.data_file, args.db, budget)) as executor:
+        for path in args.videos:
+            capture = cv2.VideoCapture(path)
+            duration = capture.get(cv2.CAP_PROP_FRAME_COUNT) / (capture.get(cv2.CAP_PROP_FPS) or 25.0)
+            capture.release()
+            video_start = time.perf_counter()
+            stats = recognise_video(executor, path, votes, course_id, args.batch_size, workers * 2, offset, sampling)
+            videos.append({'path': path, 'duration_seconds': round(duration, 1), **stats,
+                           'seconds': round(time.perf_counter() - video_start, 3)})
+            # Later files continue the same recording
+            offset += duration
+
+    present = votes.present()
+    members = {student_id for student_id, _ in db.get_course_members().get(course_id, [])}
+    enrolled = {student_id: entry for student_id, entry in present.items() if student_id in members}
+    entries = attendance_entries(enrolled, course_id, day, start, session, timetable)
+    results = [] if args.dry_run else db.replay_attendance(entries)
+    db.close()
+
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'course_id': course_id,
+            'session_id': session['id'] if session else None,
+            'date': day,
+            'workers': workers,
+            'dry_run': args.dry_run,
+            'wall_seconds': round(time.perf_counter() - began, 3),
+        },
+        'videos': videos,
+        'unknown_faces': votes.unknown,
+        'students': {
+            str(student_id): {
+                'name': entry['name'],
+                'votes': entry['votes'],
+                'mean_margin': round(float(np.mean(entry['margins'])), 3),
+                'first_seen': (start + timedelta(seconds=int(entry['first']))).strftime("%H:%M:%S"),
+                'last_seen': (start + timedelta(seconds=int(entry['last']))).strftime("%H:%M:%S"),
+                'status': ('below_votes' if student_id not in present else
+                           'not_in_course' if student_id not in members else 'present'),
+            } for student_id, entry in sorted(votes.sightings.items())
+        },
+        'writes': {status: sum(1 for s, _ in results if s == status) for status in ('applied', 'duplicate', 'conflict')},
+        'server_stages': metrics.stage_summary(),
+    }
+
+    for video in videos:
+        print(f"{video['path']}: {video['sampled']} frames sampled, {video['faces']} faces, {video['seconds']}s")
+    for student_id, row in report['students'].items():
+        print(f"{row['name']:30s} votes {row['votes']:4d}  {row['first_seen']}-{row['last_seen']}  {row['status']}")
+    print(f"{len(enrolled)} students present; writes: {report['writes']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote report to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+# File: recognition_worker.py
+
+import hashlib
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from face_recognition_module import FaceRecognitionModule
+from face_pipeline import RECOGNIZE_STAGES
+from database import Database
+from enrolment import process_enrolment_queue
+from image_ingest import as_frame
+from metrics import metrics
+
+# Per-process state, set up by _init_worker in every pool process
+_module = None
+
+
+def _init_worker(data_file, db_name, memory_budget=None):
+    global _module
+    # Each worker tails the shared face change log, so enrolments from any process show up here
+    _module = FaceRecognitionModule(data_file, change_log=Database(db_name), memory_budget=memory_budget)
+
+
+def _run_recognize(image, quality_gate, shard):
+    _module.maybe_sync()
+    # One pipeline pass: the frame is converted and detected once, and gated before anything is encoded
+    stages = RECOGNIZE_STAGES if quality_gate else tuple(s for s in RECOGNIZE_STAGES if s != 'quality')
+    result, = _module.pipeline.run([image], stages, shard)
+    # Metrics recorded in this process travel back with the result
+    return (result.locations, result.names, result.rejection), metrics.drain(), _module.gallery.version
+
+
+def _run_pipeline(images, stages, shard):
+    _module.maybe_sync()
+    results = _module.pipeline.run(images, stages, shard)
+    for result in results:
+        # Pixels stay in the worker unless an annotated image was asked for
+        result.rgb = None
+        if not isinstance(result.source, str):
+            # The submitted array or Frame itself; only a path is worth sending back
+            result.source = None
+        if result.annotated is None:
+            result.frame = None
+    return results, metrics.drain(), _module.gallery.version
+
+
+def _run_add_face(image, name, student_id, source):
+    _module.sync()
+    added = _module.add_face(image, name, student_id, source)
+    return added, metrics.drain(), _module.gallery.version
+
+
+def _run_enrolment_queue(limit):
+    _module.sync()
+    processed = process_enrolment_queue(_module, limit)
+    return processed, metrics.drain(), _module.gallery.version
+
+
+class RecognitionWorkerPool:
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    TIMEOUT = 'timeout'
+    UNKNOWN = 'unknown'
+
+    def __init__(self, data_file='known_faces.pkl', db_name='students.db', workers=None, max_pending=32,
+                 timeout=10.0, cache_size=128, quality_gate=True, memory_budget=None):
+        self.data_file = data_file
+        self.db_name = db_name
+        self.quality_gate = quality_gate
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                             initargs=(data_file, db_name, memory_budget))
+        # add_face rewrites the snapshot file, so enrolments go through a single writer process.
+        # memory_budget caps each recognition worker's gallery; the writer keeps the full memory map.
+        self._writer = ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(data_file, db_name))
+        self._gallery_version = None
+        self._jobs = {}
+        self._cache = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def set_gallery_version(self, version):
+        with self._lock:
+            self._observe_gallery_version(version)
+
+    def _observe_gallery_version(self, version):
+        # Cached results are only valid for the gallery they were matched against
+        if self._gallery_version is None or version > self._gallery_version:
+            self._cache.clear()
+            self._gallery_version = version
+
+    def _cache_key(self, image, shard):
+        pixels = as_frame(image).pixels
+        digest = hashlib.sha1(pixels.data)
+        digest.update(repr((pixels.shape, str(pixels.dtype), shard)).encode())
+        return digest.hexdigest()
+
+    def _prune_abandoned(self):
+        # Jobs nobody polled (the caller went away) would otherwise stay in _jobs for good. Twice the
+        # timeout leaves a caller that is still waiting time to collect a result that just finished.
+        cutoff = time.monotonic() - 2 * self.timeout
+        for job_id in [job_id for job_id, job in self._jobs.items() if job['submitted'] < cutoff]:
+            self._jobs.pop(job_id)['future'].cancel()
+            metrics.inc('worker_jobs', outcome='abandoned')
+
+    def _pending_count(self):
+        return sum(1 for job in self._jobs.values() if not job['future'].done())
+
+    def _register(self, future, cache_key=None):
+        self._prune_abandoned()
+        job_id = next(self._ids)
+        self._jobs[job_id] = {'future': future, 'submitted': time.monotonic(), 'cache_key': cache_key}
+        return job_id
+
+    def submit_recognize(self, image, shard=None):
+        cache_key = self._cache_key(image, shard)
+        with self._lock:
+            if cache_key in self._cache:
+                self._cache.move_to_end(cache_key)
+                future = Future()
+                future.set_result((self._cache[cache_key], None, self._gallery_version))
+                metrics.inc('worker_jobs', kind='recognize', outcome='cache_hit')
+                return True, self._register(future)
+            if self._pending_count() >= self.max_pending:
+                metrics.inc('worker_jobs', kind='recognize', outcome='rejected')
+                return False, "Recognition service is busy. Please try again in a moment."
+            future = self._executor.submit(_run_recognize, image, self.quality_gate, shard)
+            metrics.inc('worker_jobs', kind='recognize', outcome='submitted')
+            return True, self._register(future, cache_key)
+
+    def submit_pipeline(self, images, stages=None, shard=None):
+        # Rich results (boxes, encodings, top-k distances, per-stage timings) for a batch of images
+        with self._lock:
+            if self._pending_count() >= self.max_pending:
+                metrics.inc('worker_jobs', kind='pipeline', outcome='rejected')
+                return False, "Recognition service is busy. Please try again in a moment."
+            future = self._executor.submit(_run_pipeline, list(images), stages or RECOGNIZE_STAGES, shard)
+            metrics.inc('worker_jobs', kind='pipeline', outcome='submitted')
+            return True, self._register(future)
+
+    def submit_add_face(self, image, name, student_id=None, source=None):
+        with self._lock:
+            if self._pending_count() >= self.max_pending:
+                metrics.inc('worker_jobs', kind='add_face', outcome='rejected')
+                return False, "Recognition service is busy. Please try again in a moment."
+            future = self._writer.submit(_run_add_face, image, name, student_id, source)
+            metrics.inc('worker_jobs', kind='add_face', outcome='submitted')
+            return True, self._register(future)
+
+    def submit_enrolment_refresh(self, limit=20):
+        # Uploaded profile photos are encoded by the writer too, between interactive enrolments
+        with self._lock:
+            if self._pending_count() >= self.max_pending:
+                metrics.inc('worker_jobs', kind='enrolment_refresh', outcome='rejected')
+                return False, "Recognition service is busy. Please try again in a moment."
+            future = self._writer.submit(_run_enrolment_queue, limit)
+            metrics.inc('worker_jobs', kind='enrolment_refresh', outcome='submitted')
+            return True, self._register(future)
+
+    def poll(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return self.UNKNOWN, None
+
+            future = job['future']
+            if not future.done():
+                if time.monotonic() - job['submitted'] < self.timeout:
+                    return self.PENDING, None
+                # A running job cannot be interrupted; it is dropped and its result discarded
+                future.cancel()
+                del self._jobs[job_id]
+                metrics.inc('worker_jobs', outcome='timeout')
+                return self.TIMEOUT, None
+
+            del self._jobs[job_id]
+            error = future.exception()
+            if error is not None:
+                metrics.inc('worker_jobs', outcome='failed')
+                return self.FAILED, str(error)
+
+            result, worker_metrics, gallery_version = future.result()
+            if worker_metrics is not None:
+                metrics.merge(worker_metrics)
+            self._observe_gallery_version(gallery_version)
+            metrics.observe('worker_job_seconds', time.monotonic() - job['submitted'])
+            if job['cache_key'] is not None:
+                self._cache[job['cache_key']] = result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return self.DONE, result
+
+    def wait(self, job_id, interval=0.05):
+        while True:
+            status, result = self.poll(job_id)
+            if status != self.PENDING:
+                return status, result
+            time.sleep(interval)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._writer.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,133 @@
+# File: session_store.py
+
+import json
+import sqlite3
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemorySessionBackend:
+    # Per-process dict; fine for a single Streamlit server
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[1] < time.time():
+            return None
+        return entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+
+    def delete(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+class SQLiteSessionBackend:
+    # A small local file shared by every server process on the machine
+    def __init__(self, path='sessions.db'):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS profile_cache
+                            (key TEXT PRIMARY KEY, value TEXT, expires REAL)''')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute('SELECT value, expires FROM profile_cache WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    def set(self, key, value, ttl):
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO profile_cache (key, value, expires) VALUES (?, ?, ?)',
+                         (key, value, time.time() + ttl))
+
+    def delete(self, key=None):
+        with self._connection() as conn:
+            if key is None:
+                conn.execute('DELETE FROM profile_cache')
+            else:
+                conn.execute('DELETE FROM profile_cache WHERE key = ?', (key,))
+
+
+class RedisSessionBackend:
+    # Shared by replicas on different machines; any Redis-protocol server works
+    def __init__(self, url, prefix='student_portal:profile:'):
+        if redis is None:
+            raise RuntimeError("Redis support needs the redis package: pip install redis")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode() if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=max(1, int(ttl)))
+
+    def delete(self, key=None):
+        if key is not None:
+            self.client.delete(self.prefix + key)
+            return
+        for name in self.client.scan_iter(f"{self.prefix}*"):
+            self.client.delete(name)
+
+
+def make_session_backend(url=None):
+    # None: in-process; redis://...: Redis; anything else: path of a SQLite cache file
+    if not url:
+        return MemorySessionBackend()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisSessionBackend(url)
+    return SQLiteSessionBackend(url)
+
+
+class ProfileStore:
+    # Resolved per-user state (role, student row, course list) so a rerun costs one cache lookup
+    # instead of three queries. Database notifies the store whenever that state changes.
+    def __init__(self, db, backend=None, ttl=300.0):
+        self.db = db
+        self.backend = backend or MemorySessionBackend()
+        self.ttl = ttl
+        db.user_listeners.append(self.invalidate)
+
+    def _load(self, user_id):
+        student = self.db.get_student(user_id)
+        return {
+            'user_id': user_id,
+            'is_admin': bool(self.db.is_admin(user_id)),
+            'student': student,
+            'courses': self.db.get_student_courses(user_id),
+        }
+
+    def get(self, user_id):
+        cached = self.backend.get(str(user_id))
+        if cached is not None:
+            return json.loads(cached)
+        profile = self._load(user_id)
+        self.backend.set(str(user_id), json.dumps(profile), self.ttl)
+        return profile
+
+    def invalidate(self, user_id=None):
+        self.backend.delete(None if user_id is None else str(user_id))
@@ -0,0 +1,256 @@
+# File: storage.py
+
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import metrics
+
+try:
+    import psycopg2
+    import psycopg2.extras
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+
+class IntegrityError(Exception):
+    pass
+
+
+class Cursor:
+    # Thin wrapper so Database can write '?' placeholders and get inserted ids on either backend
+    def __init__(self, backend, cursor):
+        self.backend = backend
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        self.cursor.execute(self.backend.translate(sql), params)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self.cursor.executemany(self.backend.translate(sql), seq_of_params)
+        return self
+
+    def insert(self, sql, params=()):
+        return self.backend.insert(self.cursor, self.backend.translate(sql), params)
+
+    def serialize_inserts(self, table):
+        self.backend.serialize_inserts(self.cursor, table)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+
+class SQLiteBackend:
+    name = 'sqlite'
+    primary_key = 'INTEGER PRIMARY KEY'
+    blob = 'BLOB'
+    create_view = 'CREATE VIEW IF NOT EXISTS'
+
+    def __init__(self, path='students.db', pool_size=5, timeout=30.0, read_only=False):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.read_only = read_only
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        if self.read_only:
+            conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def translate(self, sql):
+        return sql
+
+    def insert(self, cursor, sql, params):
+        cursor.execute(sql, params)
+        return cursor.lastrowid
+
+    def serialize_inserts(self, cursor, table):
+        # SQLite already allows one writer at a time, so ids commit in order
+        pass
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.pool_size
+                if can_open:
+                    self._opened += 1
+            conn = self._connect() if can_open else self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            try:
+                yield Cursor(self, conn.cursor())
+                conn.commit()
+            except sqlite3.IntegrityError as e:
+                conn.rollback()
+                raise IntegrityError(str(e)) from e
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def iter_rows(self, sql, params=(), batch_size=500):
+        # SQLite steps the statement lazily, so fetchmany already streams from the file
+        with self.connection() as conn:
+            cursor = conn.execute(sql, params)
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                cursor.close()
+                conn.rollback()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class SQLiteSnapshotBackend(SQLiteBackend):
+    # Read-only pool over a copy of the database refreshed at most every `staleness` seconds. Report
+    # queries then hold locks on the copy only, so they can never make a check-in write wait.
+    # The copy uses the online backup API in small steps, like backup.py.
+    def __init__(self, source, path=None, staleness=60.0, pool_size=5, pages=256):
+        super().__init__(path or f"{source}.snapshot", pool_size, read_only=True)
+        self.source = source
+        self.staleness = staleness
+        self.pages = pages
+        self._refreshed = 0.0
+        self._refreshing = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        if not self._refreshing.acquire(blocking=False):
+            return
+        try:
+            with metrics.timer('snapshot_refresh'):
+                src = sqlite3.connect(self.source, timeout=self.timeout)
+                dst = sqlite3.connect(self.path, timeout=self.timeout)
+                try:
+                    src.backup(dst, pages=self.pages, sleep=0.005)
+                finally:
+                    dst.close()
+                    src.close()
+            self._refreshed = time.monotonic()
+        finally:
+            self._refreshing.release()
+
+    def age(self):
+        return time.monotonic() - self._refreshed
+
+    @contextmanager
+    def connection(self):
+        # A stale snapshot is still served while a background thread copies a fresh one
+        if self.age() > self.staleness and not self._refreshing.locked():
+            threading.Thread(target=self.refresh, daemon=True).start()
+        metrics.set_gauge('snapshot_age_seconds', round(self.age(), 1))
+        with super().connection() as conn:
+            yield conn
+
+
+class PostgresBackend:
+    name = 'postgres'
+    primary_key = 'SERIAL PRIMARY KEY'
+    blob = 'BYTEA'
+    create_view = 'CREATE OR REPLACE VIEW'
+
+    def __init__(self, dsn, min_connections=1, max_connections=10, read_only=False):
+        if psycopg2 is None:
+            raise RuntimeError("PostgreSQL support needs psycopg2: pip install psycopg2-binary")
+        self.dsn = dsn
+        self.read_only = read_only
+        options = {'options': '-c default_transaction_read_only=on'} if read_only else {}
+        self._pool = psycopg2.pool.ThreadedConnectionPool(min_connections, max_connections, dsn,
+                                                          cursor_factory=psycopg2.extras.DictCursor, **options)
+        self._cursor_ids = iter(range(1, 2 ** 62))
+
+    def translate(self, sql):
+        # Database queries use sqlite's qmark style; none of them contain a literal '?' or '%'
+        return sql.replace('?', '%s')
+
+    def insert(self, cursor, sql, params):
+        cursor.execute(f"{sql} RETURNING id", params)
+        return cursor.fetchone()[0]
+
+    def serialize_inserts(self, cursor, table):
+        # SERIAL ids are handed out before commit, so concurrent inserts can become visible out of id order.
+        # Until this transaction ends, other inserts into the table wait; plain reads do not.
+        cursor.execute(f"LOCK TABLE {table} IN EXCLUSIVE MODE")
+
+    @contextmanager
+    def connection(self):
+        conn = self._pool.getconn()
+        try:
+            yield conn
+        finally:
+            self._pool.putconn(conn)
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    yield Cursor(self, cursor)
+                conn.commit()
+            except psycopg2.IntegrityError as e:
+                conn.rollback()
+                raise IntegrityError(str(e)) from e
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def iter_rows(self, sql, params=(), batch_size=500):
+        # A named cursor keeps the result set on the server and ships it in batches
+        with self.connection() as conn:
+            try:
+                with conn.cursor(name=f"stream_{next(self._cursor_ids)}") as cursor:
+                    cursor.itersize = batch_size
+                    cursor.execute(self.translate(sql), params)
+                    yield from cursor
+            finally:
+                conn.rollback()
+
+    def close(self):
+        self._pool.closeall()
+
+
+def make_backend(db_name):
+    if db_name.startswith(('postgres://', 'postgresql://')):
+        return PostgresBackend(db_name)
+    return SQLiteBackend(db_name)
+
+
+def make_read_backend(db_name, read_db=None, staleness=60.0):
+    # Pool for report queries, kept apart from the writer. For PostgreSQL, read_db is the DSN of a
+    # streaming replica (its lag is the staleness); for SQLite, the path of a periodically refreshed snapshot.
+    if db_name.startswith(('postgres://', 'postgresql://')):
+        return PostgresBackend(read_db or db_name, read_only=True)
+    return SQLiteSnapshotBackend(db_name, read_db, staleness)
@@ -1,29 +1,113 @@
 import streamlit as st
 import sqlite3
-import hashlib
 import os
+import hashlib
 import zipfile
 import io
 from werkzeug.utils import secure_filename
 import pandas as pd
-from PIL import Image
-import numpy as np
-from datetime import datetime, date
-from face_recognition_module import FaceRecognitionModule
+from datetime import datetime, date, timedelta
+from face_recognition_module import FaceRecognitionModule, QUALITY_MESSAGES
+from recognition_worker import RecognitionWorkerPool
 from database import Database
+from metrics import metrics, start_metrics_server
+from image_ingest import ingest_image
+from enrolment import EnrolmentRefresher
+from credentials import SessionSigner
+from session_store import ProfileStore, make_session_backend
+from attendance_journal import AttendanceJournal, JournalReconciler
+from timetable import Timetable, SessionCloser, FLAG_NOTES
+
+@st.cache_resource
+def get_database():
+    # A SQLite path or a postgresql:// DSN; the connection pool is shared by every session.
+    # STUDENT_PORTAL_READ_DB (a replica DSN or a snapshot path) and/or STUDENT_PORTAL_REPORT_STALENESS
+    # (seconds) move admin reports off the check-in writer.
+    staleness = os.environ.get('STUDENT_PORTAL_REPORT_STALENESS')
+    return Database(os.environ.get('STUDENT_PORTAL_DB', 'students.db'),
+                    read_db=os.environ.get('STUDENT_PORTAL_READ_DB'),
+                    staleness=float(staleness) if staleness else None)
+
+@st.cache_resource
+def get_face_module():
+    # Loaded once per server process and kept current from the face change log
+    return FaceRecognitionModule(change_log=get_database())
 
 # Initialize database and face recognition module
-db = Database()
-face_module = FaceRecognitionModule()
+db = get_database()
+face_module = get_face_module()
+face_module.maybe_sync()
+
+@st.cache_resource
+def get_worker_pool():
+    # One pool per server process, shared by every session and kept across reruns.
+    # STUDENT_PORTAL_GALLERY_BUDGET_MB caps the gallery memory of each recognition worker.
+    budget = os.environ.get('STUDENT_PORTAL_GALLERY_BUDGET_MB')
+    return RecognitionWorkerPool(face_module.data_file, db.db_name,
+                                 memory_budget=int(float(budget) * 2 ** 20) if budget else None)
+
+@st.cache_resource
+def get_metrics_server():
+    # Prometheus-style /metrics endpoint, only when a port is configured
+    port = os.environ.get('STUDENT_PORTAL_METRICS_PORT')
+    return start_metrics_server(int(port)) if port else None
+
+get_metrics_server()
+
+@st.cache_resource
+def get_enrolment_refresher():
+    # Encodes newly uploaded profile photos in the background so uploads never wait on the encoder
+    return EnrolmentRefresher(get_worker_pool()).start()
+
+get_enrolment_refresher()
+
+@st.cache_resource
+def get_attendance_journal():
+    # Kiosk mode: marks are acknowledged from a local journal and replayed into the database in the background
+    path = os.environ.get('STUDENT_PORTAL_KIOSK_JOURNAL')
+    if not path:
+        return None
+    journal = AttendanceJournal(path)
+    journal.load_open_sessions(db, datetime.now().strftime("%Y-%m-%d"))
+    JournalReconciler(journal, db).start()
+    return journal
+
+# Started with the app so marks left over from before a restart are replayed without waiting for a check-in
+get_attendance_journal()
+
+@st.cache_resource
+def get_timetable():
+    # Today's sessions are indexed in memory; ended sessions are auto-closed in the background
+    timetable = Timetable(db, journal=get_attendance_journal())
+    timetable.reload()
+    SessionCloser(timetable).start()
+    return timetable
+
+get_timetable()
+
+def record_attendance(student_id, course_id, attendance_type, time, is_manual=False):
+    # Returns (success, message, flag); the mark is attached to the course's live session, if any
+    return get_timetable().record(student_id, course_id, attendance_type, time, is_manual)
+
+@st.cache_resource
+def get_session_signer():
+    # Set STUDENT_PORTAL_SECRET so sessions survive a server restart
+    return SessionSigner()
+
+@st.cache_resource
+def get_profile_store():
+    # STUDENT_PORTAL_SESSION_STORE: unset for in-process, a SQLite file path, or a redis:// URL to share across replicas
+    return ProfileStore(db, make_session_backend(os.environ.get('STUDENT_PORTAL_SESSION_STORE')))
 
 # Helper functions
-def hash_password(password):
-    return hashlib.sha256(str.encode(password)).hexdigest()
-
-def save_file(file, folder):
+def save_file(file, folder, owner):
+    # <owner>_<content hash><ext>: two users uploading "photo.jpg" never overwrite each other, and a queued
+    # enrolment always encodes exactly the bytes its student uploaded
     if not os.path.exists(folder):
         os.makedirs(folder)
-    file_path = os.path.join(folder, secure_filename(file.name))
+    digest = hashlib.sha256(file.getbuffer()).hexdigest()[:16]
+    extension = os.path.splitext(secure_filename(file.name))[1].lower()
+    file_path = os.path.join(folder, f"{owner}_{digest}{extension}")
     with open(file_path, 'wb') as f:
         f.write(file.getbuffer())
     return file_path
@@ -38,6 +122,12 @@ def main():
     if 'user' not in st.session_state:
         st.session_state.user = None
 
+    # Each rerun re-checks the signed session token (one HMAC) instead of the password
+    if st.session_state.user is not None:
+        if get_session_signer().verify(st.session_state.get('session_token')) != st.session_state.user['id']:
+            st.session_state.user = None
+            st.info('Your session has expired. Please log in again.')
+
     # Check if user is logged in
     if st.session_state.user is None:
         page = st.sidebar.selectbox('Choose an action', ['Login', 'Register'])
@@ -45,7 +135,7 @@ def main():
             login()
         else:
             register()
-    elif db.is_admin(st.session_state.user['id']):
+    elif get_profile_store().get(st.session_state.user['id'])['is_admin']:
         admin_view()
     else:
         student_view()
@@ -66,7 +156,9 @@ def login():
     if st.button('Login'):
         user = db.check_user(username, password)
         if user:
-            st.session_state.user = user
+            # Only what the pages need; role and student record come from the profile store
+            st.session_state.user = {'id': user['id'], 'username': user['username']}
+            st.session_state.session_token = get_session_signer().issue(user['id'])
             st.rerun()
         else:
             st.error('Invalid username or password')
@@ -98,48 +190,79 @@ def student_view():
         st.rerun()
 
     user_id = st.session_state.user['id']
-    student = db.get_student(user_id)
-
-    if student:
-        # Convert sqlite3.Row to dictionary
-        student = dict(student)
+    profile = get_profile_store().get(user_id)
+    student = profile['student']
 
-        col1, col2 = st.columns([3, 1])
+    # Each section is a fragment: a widget inside one re-executes only that section, so a camera
+    # capture runs recognition alone. A full rerun happens on a details update or a successful mark.
+    profile_section(student)
+    update_details_section(user_id, student)
 
-        with col1:
-            st.write(f"Name: {student.get('name', 'N/A')}")
-            st.write(f"Email: {student.get('email', 'N/A')}")
-            st.write(f"Course: {student.get('course', 'N/A')}")
-            st.write(f"Student ID: {student.get('student_id', 'N/A')}")
-            st.write(f"Register No: {student.get('register_no', 'N/A')}")
-            st.write(f"Academic Year: {student.get('academic_year', 'N/A')}")
-
-        with col2:
-            if student.get('photo_path'):
-                st.image(student['photo_path'], caption='Profile Photo', use_column_width=True)
-            else:
-                st.write("No profile photo available.")
-            
-            if student.get('resume_path'):
-                with open(student['resume_path'], "rb") as file:
-                    st.download_button(
-                        label="Download Your Resume",
-                        data=file,
-                        file_name="your_resume.pdf",
-                        mime="application/pdf"
-                    )
-            else:
-                st.write("No resume file available.")
+    st.subheader('Mark Attendance')
+    if not student:
+        st.info("No student record is linked to this account.")
+        return
+    # Attendance is keyed by the student's record id and the integer course id
+    course_names = {course['id']: course['name'] for course in profile['courses']}
+    live = get_timetable().live_session(set(course_names))
+    if live:
+        # A timetabled session is running for one of the student's courses: no course choice needed
+        course_id = live['course_id']
+        room = f" in {live['room']}" if live['room'] else ""
+        st.info(f"{course_names[course_id]}{room}, {live['start_time'][:5]}-{live['end_time'][:5]}")
+    else:
+        course_id = st.selectbox("Select Course", options=list(course_names), format_func=course_names.get)
+    mark_attendance_section(student['id'], course_id)
+    attendance_history_section(student['id'], course_id)
+
+@st.cache_data(max_entries=256)
+def read_file(path, modified):
+    # `modified` is part of the cache key so a replaced file is read again
+    with open(path, 'rb') as f:
+        return f.read()
+
+@st.fragment
+def profile_section(student):
+    if not student:
+        return
+    col1, col2 = st.columns([3, 1])
+
+    with col1:
+        st.write(f"Name: {student.get('name', 'N/A')}")
+        st.write(f"Email: {student.get('email', 'N/A')}")
+        st.write(f"Course: {student.get('course', 'N/A')}")
+        st.write(f"Student ID: {student.get('student_id', 'N/A')}")
+        st.write(f"Register No: {student.get('register_no', 'N/A')}")
+        st.write(f"Academic Year: {student.get('academic_year', 'N/A')}")
+
+    with col2:
+        if student.get('photo_path'):
+            st.image(student['photo_path'], caption='Profile Photo', use_column_width=True)
+        else:
+            st.write("No profile photo available.")
+        
+        if student.get('resume_path') and os.path.exists(student['resume_path']):
+            st.download_button(
+                label="Download Your Resume",
+                data=read_file(student['resume_path'], os.path.getmtime(student['resume_path'])),
+                file_name="your_resume.pdf",
+                mime="application/pdf"
+            )
+        else:
+            st.write("No resume file available.")
 
+@st.fragment
+def update_details_section(user_id, student):
     st.subheader('Update Your Details')
     
     fields = ['name', 'email', 'course', 'student_id', 'register_no', 'academic_year']
     inputs = {}
+    courses = db.get_all_courses()
 
     for field in fields:
         if field == 'course':
-            inputs[field] = st.selectbox('Course', db.get_all_courses(), 
-                index=db.get_all_courses().index(student.get('course')) if student and student.get('course') in db.get_all_courses() else 0)
+            inputs[field] = st.selectbox('Course', courses, 
+                index=courses.index(student.get('course')) if student and student.get('course') in courses else 0)
         else:
             inputs[field] = st.text_input(field.capitalize(), value=student.get(field, '') if student else '')
 
@@ -148,19 +271,28 @@ def student_view():
     
     if st.button('Update Details'):
         if all(inputs.values()):
-            resume_path = save_file(resume, 'resumes') if resume else (student.get('resume_path') if student else None)
-            photo_path = save_file(photo, 'photos') if photo else (student.get('photo_path') if student else None)
+            resume_path = save_file(resume, 'resumes', user_id) if resume else (student.get('resume_path') if student else None)
+            photo_path = save_file(photo, 'photos', user_id) if photo else (student.get('photo_path') if student else None)
             
             db.update_student(user_id, inputs['name'], inputs['email'], inputs['course'], 
                               inputs['student_id'], inputs['register_no'], inputs['academic_year'],
-                              resume_path, photo_path)
+                              resume_path, photo_path, photo_uploaded=photo is not None)
             st.success('Details updated successfully!')
             st.rerun()
         else:
             st.error('Please fill in all fields')
 
-    st.subheader('Mark Attendance')
-    course_id = st.selectbox("Select Course", options=db.get_student_courses(user_id))
+def attendance_marked(message):
+    # Refresh the whole page (and with it the history table) only once a mark has gone through
+    st.session_state.attendance_notice = message
+    st.rerun()
+
+@st.fragment
+def mark_attendance_section(student_id, course_id):
+    notice = st.session_state.pop('attendance_notice', None)
+    if notice:
+        st.success(notice)
+
     attendance_type = st.radio("Select attendance type:", ("In", "Out"))
     
     mark_method = st.radio("Select marking method:", ("Manual", "Facial Recognition"))
@@ -168,38 +300,61 @@ def student_view():
     if mark_method == "Manual":
         if st.button("Mark Attendance Manually"):
             current_time = datetime.now().strftime("%H:%M:%S")
-            success, message = db.mark_attendance(user_id, course_id, attendance_type, current_time, is_manual=True)
+            success, message, flag = record_attendance(student_id, course_id, attendance_type, current_time,
+                                                       is_manual=True)
             if success:
-                st.success(f"{attendance_type} attendance marked manually at {current_time}")
+                attendance_marked(f"{attendance_type} attendance marked manually at {current_time}{FLAG_NOTES.get(flag, '')}")
             else:
                 st.error(message)
     else:
         st.write("Look at the camera and click 'Mark Attendance' to use facial recognition.")
-        picture = st.camera_input("Take a picture for attendance", key=f"mark_attendance_{user_id}")
-        if picture:
-            image = Image.open(picture)
-            image_array = np.array(image)
-            face_locations, face_names = face_module.recognize_face(image_array)
-            
-            if face_locations and face_names:
+        picture = st.camera_input("Take a picture for attendance", key=f"mark_attendance_{student_id}")
+        # The camera keeps its last picture across reruns; recognise each capture only once
+        if picture and picture.file_id != st.session_state.get('recognized_capture'):
+            with metrics.timer('decode'):
+                frame = ingest_image(picture)
+            pool = get_worker_pool()
+            pool.set_gallery_version(face_module.gallery.version)
+            with st.spinner("Recognizing face..."):
+                submitted, job = pool.submit_recognize(frame, shard=course_id)
+                if submitted:
+                    status, result = pool.wait(job)
+                else:
+                    status, result = RecognitionWorkerPool.FAILED, job
+
+            st.session_state.recognized_capture = picture.file_id
+            face_locations, face_names, rejection = [], [], None
+            if status == RecognitionWorkerPool.TIMEOUT:
+                st.error("Face recognition timed out. Please try again.")
+            elif status != RecognitionWorkerPool.DONE:
+                st.error(f"Face recognition failed: {result}")
+            else:
+                face_locations, face_names, rejection = result
+
+            image_with_faces = face_module.draw_faces(frame, face_locations, face_names)
+            if rejection:
+                st.error(QUALITY_MESSAGES[rejection])
+            elif face_locations and face_names:
                 if face_names[0] != "Unknown":
                     current_time = datetime.now().strftime("%H:%M:%S")
-                    success, message = db.mark_attendance(user_id, course_id, attendance_type, current_time)
+                    success, message, flag = record_attendance(student_id, course_id, attendance_type, current_time)
                     if success:
-                        st.success(f"{attendance_type} attendance marked via facial recognition at {current_time}")
+                        attendance_marked(f"{attendance_type} attendance marked via facial recognition at "
+                                          f"{current_time}{FLAG_NOTES.get(flag, '')}")
                     else:
                         st.error(message)
                 else:
                     st.error(f"Face not recognized. Known faces: {face_module.known_face_names}")
                     st.error("Please try again or contact an administrator.")
-            else:
+            elif status == RecognitionWorkerPool.DONE:
                 st.error("No face detected in the image. Please try again.")
             
-            image_with_faces = face_module.draw_faces(image_array, face_locations, face_names)
             st.image(image_with_faces, channels="RGB")
 
+@st.fragment
+def attendance_history_section(student_id, course_id):
     st.subheader('Your Attendance Records')
-    attendance = db.get_attendance(user_id, course_id)
+    attendance = db.get_attendance(student_id, course_id)
     if attendance:
         df = pd.DataFrame(attendance, columns=["Date", "In Time", "Out Time"])
         st.dataframe(df)
@@ -220,7 +375,8 @@ def admin_view():
     # Use radio buttons for tab selection
     st.session_state.admin_tab = st.sidebar.radio(
         "Select a tab",
-        ["Student List", "Student Details", "Pending Registrations", "Course Management", "Attendance", "Train Faces"]
+        ["Student List", "Student Details", "Pending Registrations", "Course Management", "Timetable", "Attendance",
+         "Train Faces", "Metrics"]
     )
     
     if st.session_state.admin_tab == "Student List":
@@ -231,10 +387,14 @@ def admin_view():
         pending_registrations_tab()
     elif st.session_state.admin_tab == "Course Management":
         course_management_tab()
+    elif st.session_state.admin_tab == "Timetable":
+        timetable_tab()
     elif st.session_state.admin_tab == "Attendance":
         attendance_tab()
     elif st.session_state.admin_tab == "Train Faces":
         train_faces_tab()
+    elif st.session_state.admin_tab == "Metrics":
+        metrics_tab()
 
 def student_list_tab():
     st.subheader('Student List')
@@ -347,11 +507,56 @@ def course_management_tab():
             st.success(f"Course '{course}' deleted successfully.")
             st.rerun()
 
+def timetable_tab():
+    st.subheader('Timetable')
+    timetable = get_timetable()
+
+    course_options = db.course_ids()
+    if not course_options:
+        st.info("Add a course first.")
+        return
+    selected_course = st.selectbox("Course:", options=list(course_options.keys()), key="timetable_course")
+    col1, col2, col3 = st.columns(3)
+    start_time = col1.time_input("Start", key="timetable_start")
+    end_time = col2.time_input("End", key="timetable_end")
+    room = col3.text_input("Room")
+    first_date = st.date_input("Date (first week for a weekly series):", date.today())
+    last_date = st.date_input("Repeat weekly until (same date for a single session):", first_date)
+
+    if st.button("Add Session"):
+        if last_date > first_date:
+            success, message = timetable.add_weekly(course_options[selected_course], first_date.weekday(),
+                                                    start_time.strftime("%H:%M:%S"), end_time.strftime("%H:%M:%S"),
+                                                    first_date.strftime("%Y-%m-%d"), last_date.strftime("%Y-%m-%d"),
+                                                    room or None)
+        else:
+            success, message = timetable.add_session(course_options[selected_course], first_date.strftime("%Y-%m-%d"),
+                                                     start_time.strftime("%H:%M:%S"), end_time.strftime("%H:%M:%S"),
+                                                     room or None)
+        if success:
+            st.success(message)
+        else:
+            st.error(message)
+
+    st.subheader('Upcoming Sessions')
+    sessions = db.get_course_sessions(date.today().strftime("%Y-%m-%d"),
+                                      (date.today() + timedelta(days=14)).strftime("%Y-%m-%d"))
+    for session in sessions:
+        col1, col2 = st.columns([3, 1])
+        room = f" - {session['room']}" if session['room'] else ""
+        closed = " (closed)" if session['closed_at'] else ""
+        col1.write(f"{session['date']} {session['start_time'][:5]}-{session['end_time'][:5]} "
+                   f"{session['course']}{room}{closed}")
+        if col2.button('Delete', key=f"delete_session_{session['id']}"):
+            timetable.delete_session(session['id'])
+            st.rerun()
+    if not sessions:
+        st.info("No sessions scheduled in the next two weeks.")
+
 def attendance_tab():
     st.subheader('View Attendance')
     
-    courses = db.get_all_courses()
-    course_options = {f"{c}": c for c in courses}
+    course_options = db.course_ids()
     selected_course = st.selectbox("Select course:", options=list(course_options.keys()))
     course_id = course_options[selected_course]
     
@@ -378,18 +583,43 @@ def train_faces_tab():
         picture = st.camera_input("Take a picture to train face recognition", key=f"train_face_{student_id}")
         if picture:
             try:
-                image = Image.open(picture)
-                image_array = np.array(image)
-                if face_module.add_face(image_array, student['name']):
+                frame = ingest_image(picture)
+                pool = get_worker_pool()
+                with st.spinner("Encoding face..."):
+                    submitted, job = pool.submit_add_face(frame, student['name'], student['id'])
+                    if submitted:
+                        status, result = pool.wait(job)
+                    else:
+                        status, result = RecognitionWorkerPool.FAILED, job
+
+                if status == RecognitionWorkerPool.DONE and result:
+                    face_module.sync()
                     st.success(f"Face recognition trained for {student['name']}")
                     st.write(f"Current known faces: {face_module.known_face_names}")
-                else:
+                elif status == RecognitionWorkerPool.DONE:
                     st.error("No face detected in the image. Please try again.")
+                elif status == RecognitionWorkerPool.TIMEOUT:
+                    st.error("Face encoding timed out. Please try again.")
+                else:
+                    st.error(f"Face encoding failed: {result}")
             except Exception as e:
                 st.error(f"An error occurred: {str(e)}")
     else:
         st.info("No students found in the database. Add students first.")
 
+def metrics_tab():
+    st.subheader('Metrics')
+    st.write("Per-stage latencies and counters for this server process.")
+
+    stages = metrics.stage_summary()
+    if stages:
+        st.dataframe(pd.DataFrame(stages))
+    else:
+        st.info("No timings recorded yet.")
+
+    with st.expander("Prometheus text format"):
+        st.code(metrics.render_prometheus(), language='text')
+
 if __name__ == '__main__':
     main()
 
@@ -0,0 +1,71 @@
+# File: tests/test_attendance_journal.py
+
+import os
+
+import pytest
+
+from attendance_journal import AttendanceJournal
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return AttendanceJournal(str(tmp_path / 'attendance_journal.jsonl'), fsync=False)
+
+
+def test_duplicate_mark_is_refused(journal):
+    assert journal.record(1, 2, "In", "09:00:00", date='2026-10-01')[0]
+    assert journal.record(1, 2, "In", "09:00:00", date='2026-10-01') == \
+        (False, "In attendance already recorded at 09:00:00")
+    assert len(journal.pending()[0]) == 1
+
+
+def test_commit_advances_then_truncates(journal):
+    for i in range(3):
+        journal.record(1, 2, "In", f"09:0{i}:00", date='2026-10-01')
+    entries, offset = journal.pending(batch_size=2)
+    assert [entry['time'] for entry in entries] == ["09:00:00", "09:01:00"]
+    journal.commit(offset)
+    assert journal._read_offset() == offset
+    entries, offset = journal.pending()
+    assert [entry['time'] for entry in entries] == ["09:02:00"]
+    journal.commit(offset)
+    # Fully replayed: the file starts over and the offset with it
+    assert os.path.getsize(journal.path) == 0 and journal._read_offset() == 0
+    journal.record(1, 2, "Out", "09:50:00", date='2026-10-01')
+    assert [entry['type'] for entry in journal.pending()[0]] == ["Out"]
+
+
+def test_partial_line_is_left_for_later(journal):
+    journal.record(1, 2, "In", "09:00:00", date='2026-10-01')
+    with open(journal.path, 'a') as f:
+        f.write('{"version": 2')
+    entries, offset = journal.pending()
+    assert len(entries) == 1
+    journal.commit(offset)
+    assert os.path.getsize(journal.path) > offset
+
+
+def test_open_sessions_follow_the_latest_mark(journal):
+    journal.record(1, 2, "In", "09:00:00", date='2026-10-01', session_id=7)
+    journal.record(3, 2, "In", "09:01:00", date='2026-10-01', session_id=7)
+    assert journal.open_session(1, 2, '2026-10-01') == 7
+    journal.record(1, 2, "Out", "09:40:00", date='2026-10-01', session_id=7)
+    assert journal.open_session(1, 2, '2026-10-01') is None
+    journal.forget_sessions({7})
+    assert journal.open_session(3, 2, '2026-10-01') is None
+
+
+def test_reconcile_replays_and_reloads_open_sessions(db, student, journal):
+    row = student()
+    course_id = db.course_id('MCA')
+    session_id = db.add_course_session(course_id, '2026-10-01', '09:00:00', '10:00:00')
+    journal.record(row['id'], course_id, "In", "09:00:00", date='2026-10-01', session_id=session_id)
+    journal.record(row['id'], course_id, "Out", "09:30:00", date='2026-10-02')
+    assert journal.reconcile(db) == {'applied': 1, 'duplicate': 0, 'conflict': 1}
+    assert journal.pending() == ([], 0)
+    assert os.path.getsize(journal.conflict_file) > 0
+    assert db.get_sessions(course_id, '2026-10-01') == {row['id']: [("09:00:00", None)]}
+    # A restarted kiosk learns who is inside from the database
+    restarted = AttendanceJournal(journal.path, fsync=False)
+    restarted.load_open_sessions(db, '2026-10-01')
+    assert restarted.open_session(row['id'], course_id, '2026-10-01') == session_id
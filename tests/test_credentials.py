@@ -0,0 +1,40 @@
+# File: tests/test_credentials.py
+
+import hashlib
+
+from credentials import PasswordHasher
+
+
+def test_hash_is_salted_and_verifies():
+    hasher = PasswordHasher('pbkdf2_sha256', iterations=1000)
+    first, second = hasher.hash('secret'), hasher.hash('secret')
+    assert first != second and first.startswith('pbkdf2_sha256$1000$')
+    assert hasher.verify('secret', first) and not hasher.verify('Secret', first)
+    assert not hasher.verify('secret', 'pbkdf2_sha256$many$c2FsdA$x')
+
+
+def test_needs_rehash_on_cost_or_algorithm_change():
+    cheap = PasswordHasher('pbkdf2_sha256', iterations=1000)
+    encoded = cheap.hash('secret')
+    assert not cheap.needs_rehash(encoded)
+    assert PasswordHasher('pbkdf2_sha256', iterations=2000).needs_rehash(encoded)
+    scrypt = PasswordHasher('scrypt', n=2 ** 10, r=8, p=1)
+    assert scrypt.needs_rehash(encoded) and scrypt.verify('secret', encoded)
+    assert not scrypt.needs_rehash(scrypt.hash('secret'))
+
+
+def test_legacy_sha256_verifies_and_needs_rehash():
+    hasher = PasswordHasher('pbkdf2_sha256', iterations=1000)
+    legacy = hashlib.sha256(b'secret').hexdigest()
+    assert hasher.verify('secret', legacy) and not hasher.verify('other', legacy)
+    assert hasher.needs_rehash(legacy)
+
+
+def test_login_upgrades_a_legacy_hash(db, student):
+    row = student()
+    with db.backend.transaction() as c:
+        c.execute('UPDATE users SET password=? WHERE id=?', (hashlib.sha256(b'pw').hexdigest(), row['user_id']))
+    user = db.check_user('asha', 'pw')
+    assert user is not None and user['password'].startswith('pbkdf2_sha256$1000$')
+    assert not db.hasher.needs_rehash(user['password'])
+    assert db.check_user('asha', 'pw')['password'] == user['password']
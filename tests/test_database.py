@@ -0,0 +1,99 @@
+# File: tests/test_database.py
+#
+# The same Database checks against every storage backend (see the db fixture in conftest.py)
+
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from storage import IntegrityError
+
+
+def test_create_tables_is_idempotent(db):
+    db.create_tables()
+    with db.backend.transaction() as c:
+        c.execute('SELECT name FROM schema_migrations ORDER BY name')
+        names = [row['name'] for row in c.fetchall()]
+    assert len(names) == len(set(names))
+
+
+def test_insert_returns_new_ids(db):
+    with db.backend.transaction() as c:
+        first = c.insert('INSERT INTO courses (name) VALUES (?)', ('BCA',))
+        second = c.insert('INSERT INTO courses (name) VALUES (?)', ('BSc',))
+    assert isinstance(first, int) and second != first
+    assert db.course_id('BCA') == first and db.course_id('BSc') == second
+
+
+def test_duplicate_username_is_rejected(db):
+    assert db.register_student('ravi', 'pw', 'Ravi', 'ravi@srmist.edu.in', 'MCA')[0]
+    assert db.register_student('ravi', 'pw', 'Ravi', 'ravi@srmist.edu.in', 'MCA') == \
+        (False, "Username already exists. Please choose a different username.")
+    with pytest.raises(IntegrityError):
+        with db.backend.transaction() as c:
+            c.execute('INSERT INTO users (username, password, is_admin) VALUES (?, ?, 0)', ('root', 'x'))
+            c.execute('INSERT INTO users (username, password, is_admin) VALUES (?, ?, 0)', ('root', 'x'))
+    # The failed transaction was rolled back as a whole
+    assert db.check_user('root', 'x') is None
+
+
+def test_approval_creates_user_student_and_membership(db, student):
+    row = student()
+    assert row['name'] == 'Asha' and row['course'] == 'MCA'
+    assert db.get_pending_registrations() == []
+    assert db.get_course_members()[db.course_id('MCA')] == [(row['id'], 'Asha')]
+    assert db.get_student_courses(row['user_id']) == [{'id': db.course_id('MCA'), 'name': 'MCA'}]
+    assert db.check_user('asha', 'wrong') is None
+
+
+def test_marks_pair_into_sessions(db, student):
+    row = student()
+    course_id = db.course_id('MCA')
+    today = datetime.now().strftime("%Y-%m-%d")
+    for attendance_type, time in (("In", "09:00:00"), ("Out", "09:50:00"), ("In", "10:05:00")):
+        assert db.mark_attendance(row['id'], course_id, attendance_type, time)[0]
+    sessions = db.get_sessions(course_id, today)
+    assert sessions == {row['id']: [("09:00:00", "09:50:00"), ("10:05:00", None)]}
+    assert db.presence(sessions[row['id']]).seconds == 50 * 60
+
+
+def test_replay_reports_duplicates_and_conflicts(db, student):
+    row = student()
+    course_id = db.course_id('MCA')
+    entry = {'version': 2, 'student_id': row['id'], 'course_id': course_id, 'date': '2026-10-01',
+             'type': "In", 'time': "09:00:00", 'method': 'face', 'session_id': None, 'flag': None}
+    out = {**entry, 'type': "Out", 'time': "09:45:00"}
+    early_out = {**entry, 'date': '2026-10-02', 'type': "Out"}
+    assert db.replay_attendance([entry, out, entry, early_out]) == [
+        ('applied', None), ('applied', None), ('duplicate', None), ('conflict', "Out without an earlier In")]
+    assert db.get_sessions(course_id, '2026-10-01') == {row['id']: [("09:00:00", "09:45:00")]}
+
+
+def test_replay_maps_legacy_entries(db, student):
+    row = student()
+    # Version 1 journal entries carried the user id and the course name
+    legacy = {'student_id': row['user_id'], 'course_id': 'MCA', 'date': '2026-10-01', 'type': "In",
+              'time': "09:00:00"}
+    assert db.replay_attendance([legacy]) == [('applied', None)]
+    assert db.get_sessions(db.course_id('MCA'), '2026-10-01') == {row['id']: [("09:00:00", None)]}
+
+
+def test_iter_rows_streams_dict_rows(db):
+    with db.backend.transaction() as c:
+        c.executemany('INSERT INTO courses (name) VALUES (?)', [(f"Course {i:03d}",) for i in range(25)])
+    rows = list(db.backend.iter_rows('SELECT id, name FROM courses WHERE name LIKE ? ORDER BY name',
+                                     ('Course %',), batch_size=7))
+    assert [row['name'] for row in rows] == [f"Course {i:03d}" for i in range(25)]
+    assert set(dict(rows[0])) == {'id', 'name'}
+    assert db.search_students('nobody') == []
+
+
+def test_face_changes_tail_in_id_order(db):
+    added = db.append_face_change('add', name='Asha', encoding=np.arange(128, dtype=np.float64), student_id=1,
+                                  source='photo:a.jpg')
+    removed = db.append_face_change('remove', template_id=added)
+    changes = db.get_face_changes()
+    assert [change['id'] for change in changes] == [added, removed]
+    assert np.array_equal(np.frombuffer(bytes(changes[0]['encoding']), dtype=np.float64), np.arange(128))
+    assert [change['id'] for change in db.get_face_changes(since_version=added)] == [removed]
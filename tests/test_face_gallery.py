@@ -0,0 +1,142 @@
+# File: tests/test_face_gallery.py
+
+import glob
+import os
+import time
+
+import numpy as np
+import pytest
+
+import face_gallery
+from face_gallery import FaceGallery, TemplatePager, ROW_BYTES, MIN_PAGED_ROWS
+
+
+def encodings(count, seed=0, spread=0.3):
+    return np.random.default_rng(seed).normal(0, spread, (count, 128))
+
+
+def gallery_of(vectors, **kwargs):
+    gallery = FaceGallery(**kwargs)
+    for i, vector in enumerate(vectors):
+        gallery.add(i + 1, f"s{i}", vector, i, f"photo:{i}.jpg")
+    return gallery
+
+
+def test_quantize_round_trips_within_one_step():
+    vector = encodings(1)[0]
+    code, scale = FaceGallery.quantize(vector)
+    assert code.dtype == np.int8 and np.abs(code).max() == 127
+    assert np.abs(code * scale - vector).max() <= scale / 2 + 1e-12
+
+
+def test_search_reranks_coarse_candidates_exactly():
+    vectors = encodings(500)
+    gallery = gallery_of(vectors)
+    query = vectors[123] + 0.001
+    position, distance = gallery.search(query)
+    assert gallery.template_ids[position] == 124
+    assert distance == pytest.approx(np.linalg.norm(vectors[123] - query))
+    assert FaceGallery().search(query) == (None, None)
+
+
+def test_remove_moves_the_last_template_into_the_gap():
+    vectors = encodings(5)
+    gallery = gallery_of(vectors)
+    assert gallery.remove(2) and not gallery.remove(2)
+    assert len(gallery) == 4 and 2 not in gallery and 5 in gallery
+    assert gallery.template_ids == [1, 5, 3, 4]
+    assert np.array_equal(gallery.full_encoding(1), vectors[4])
+    assert gallery.name_at(1) == 's4' and gallery.student_id_at(1) == 4
+
+
+def test_fusion_matches_the_identity_not_the_single_template():
+    rng = np.random.default_rng(1)
+    centre = rng.normal(0, 0.3, 128)
+    gallery = FaceGallery()
+    for i in range(3):
+        gallery.add(None, 'asha', centre + rng.normal(0, 0.02, 128), 7)
+    gallery.add(None, 'ravi', rng.normal(0, 0.3, 128), 8)
+    for fusion in ('min', 'mean', 'centroid'):
+        position, distance, threshold = gallery.match(centre, fusion=fusion)
+        assert gallery.student_id_at(position) == 7 and distance <= threshold
+
+
+def test_adaptive_threshold_stays_within_bounds_and_tolerance():
+    rng = np.random.default_rng(2)
+    gallery = FaceGallery()
+    for _ in range(4):
+        gallery.add(None, 'tight', np.full(128, 0.1) + rng.normal(0, 0.001, 128), 1)
+    for _ in range(4):
+        gallery.add(None, 'loose', rng.normal(0, 0.3, 128), 2)
+    gallery.add(None, 'single', rng.normal(0, 0.3, 128), 3)
+    assert gallery.identity_threshold(('student', 1), 0.6) == 0.5
+    assert gallery.identity_threshold(('student', 2), 0.6) == 0.6
+    # A stricter configured tolerance is never loosened, even below the lower bound
+    assert gallery.identity_threshold(('student', 2), 0.45) == 0.45
+    assert gallery.identity_threshold(('student', 3), 0.6) == 0.6
+
+
+def test_save_and_load_round_trip(tmp_path):
+    vectors = encodings(40)
+    gallery = gallery_of(vectors)
+    gallery.remove(10)
+    gallery.version = 17
+    path = str(tmp_path / 'known_faces.pkl')
+    gallery.save(path)
+    loaded = FaceGallery.load(path)
+    assert loaded.version == 17 and loaded.template_ids == gallery.template_ids
+    assert loaded.names == gallery.names and loaded.sources == gallery.sources
+    for position in range(len(loaded)):
+        assert np.array_equal(loaded.full_encoding(position), gallery.full_encoding(position))
+    assert loaded.templates_from(['photo:3.jpg'], 3) == [4]
+
+
+def test_save_keeps_recent_and_referenced_sidecars(tmp_path):
+    path = str(tmp_path / 'known_faces.pkl')
+    gallery = gallery_of(encodings(3))
+    gallery.save(path)
+    first, = glob.glob(str(tmp_path / 'known_faces.*.npy'))
+    gallery.save(path)
+    assert os.path.exists(first)
+    old = time.time() - face_gallery.SIDECAR_GRACE_SECONDS - 1
+    os.utime(first, (old, old))
+    gallery.save(path)
+    assert not os.path.exists(first)
+    assert len(FaceGallery.load(path)) == 3
+
+
+def test_pager_keeps_a_bounded_lru(tmp_path):
+    vectors = encodings(200)
+    path = str(tmp_path / 'rows.npy')
+    np.save(path, vectors)
+    pager = TemplatePager(path, budget_bytes=ROW_BYTES * 10)
+    for row in range(200):
+        assert np.array_equal(pager[row], vectors[row])
+    assert pager.resident_bytes() == MIN_PAGED_ROWS * ROW_BYTES
+    pager.close()
+
+
+def test_memory_budget_spills_rows_added_after_the_snapshot(tmp_path):
+    vectors = encodings(600)
+    path = str(tmp_path / 'known_faces.pkl')
+    gallery_of(vectors[:100]).save(path)
+    budgeted = FaceGallery.load(path, memory_budget=1)
+    for i in range(100, 600):
+        budgeted.add(i + 1, f"s{i}", vectors[i], i)
+    assert not budgeted._pending_full
+    for i in range(0, 600, 13):
+        assert np.array_equal(budgeted.full_encoding(budgeted.template_ids.index(i + 1)), vectors[i])
+    assert budgeted.resident_bytes() <= budgeted.coarse_bytes() + 2 * MIN_PAGED_ROWS * ROW_BYTES
+    position, _ = budgeted.search(vectors[450])
+    assert budgeted.template_ids[position] == 451
+
+
+def test_apply_follows_the_change_log():
+    gallery = FaceGallery()
+    vector = encodings(1)[0]
+    gallery.apply([
+        {'id': 3, 'op': 'add', 'name': 'asha', 'encoding': vector.tobytes(), 'student_id': 1, 'source': None},
+        {'id': 4, 'op': 'remove', 'template_id': 3},
+        {'id': 5, 'op': 'add', 'name': 'ravi', 'encoding': vector.tobytes(), 'student_id': 2, 'source': None},
+    ])
+    assert gallery.version == 5 and gallery.template_ids == [5] and gallery.student_ids == [2]
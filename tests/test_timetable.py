@@ -0,0 +1,56 @@
+# File: tests/test_timetable.py
+
+from datetime import datetime
+
+from attendance_journal import AttendanceJournal
+from timetable import SessionIndex, Timetable, seconds_of
+
+
+def session(session_id, start, end, course_id=1):
+    return {'id': session_id, 'course_id': course_id, 'start_time': start, 'end_time': end}
+
+
+def ids(sessions):
+    return [s['id'] for s in sessions]
+
+
+def test_live_and_started_lookups():
+    index = SessionIndex([session(2, "10:00:00", "11:00:00"), session(1, "09:00:00", "12:00:00"),
+                          session(3, "10:30:00", "10:45:00", course_id=2)])
+    assert ids(index.live(seconds_of("10:35"))) == [3, 2, 1]
+    assert ids(index.live(seconds_of("10:35"), {1})) == [2, 1]
+    assert ids(index.live(seconds_of("11:30"))) == [1]
+    assert ids(index.live(seconds_of("08:50"))) == []
+    assert ids(index.live(seconds_of("08:50"), open_early=15 * 60)) == [1]
+    assert ids(index.started(seconds_of("11:30"), {1})) == [2, 1]
+    assert SessionIndex([]).live(seconds_of("10:00")) == []
+
+
+def test_close_course_sessions_adds_auto_outs(db, student):
+    asha, ravi = student(), student('ravi')
+    course_id = db.course_id('MCA')
+    today = datetime.now().strftime("%Y-%m-%d")
+    session_id = db.add_course_session(course_id, today, '00:00:00', '00:00:01')
+    db.mark_attendance(asha['id'], course_id, "In", "00:00:00", session_id=session_id)
+    db.mark_attendance(ravi['id'], course_id, "In", "00:00:00", session_id=session_id)
+    db.mark_attendance(ravi['id'], course_id, "Out", "00:00:01", session_id=session_id)
+    assert db.close_course_sessions(today, '23:59:59') == (1, 1)
+    # Closing is once per session
+    assert db.close_course_sessions(today, '23:59:59') == (0, 0)
+    assert db.get_sessions(course_id, today) == {asha['id']: [("00:00:00", "00:00:01")],
+                                                 ravi['id']: [("00:00:00", "00:00:01")]}
+
+
+def test_kiosk_out_closes_the_session_from_the_journal(db, student, tmp_path):
+    row = student()
+    course_id = db.course_id('MCA')
+    today = datetime.now().strftime("%Y-%m-%d")
+    first = db.add_course_session(course_id, today, '00:00:00', '00:00:30')
+    db.add_course_session(course_id, today, '01:00:00', '23:59:59')
+    journal = AttendanceJournal(str(tmp_path / 'attendance_journal.jsonl'), fsync=False)
+    timetable = Timetable(db, journal=journal)
+    assert timetable.attach(course_id, "In", "00:00:10") == (first, 'on_time')
+    journal.record(row['id'], course_id, "In", "00:00:10", session_id=first)
+    # The In is only in the journal, yet the Out still closes the session the student is inside
+    assert timetable.attach(course_id, "Out", "01:10:00", row['id']) == (first, 'on_time')
+    assert timetable.attach(course_id, "Out", "01:10:00", 999)[0] != first
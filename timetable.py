@@ -0,0 +1,259 @@
+# File: timetable.py
+
+import argparse
+import logging
+import os
+import sys
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from time import monotonic
+
+from database import Database
+from metrics import metrics, get_logger, log_event
+from periodic import PeriodicWorker
+
+logger = get_logger(__name__)
+
+TIMETABLE_CACHE_SECONDS = 60.0
+# Minutes before the start a session already counts as live, so early arrivals can check in
+OPEN_EARLY_MINUTES = 15
+# An In more than this many minutes after the start is late; an Out this far before the end is early
+LATE_AFTER_MINUTES = 10
+LEAVE_BEFORE_MINUTES = 10
+FLAG_NOTES = {'late': " (late)", 'early': " (left early)"}
+
+
+def seconds_of(time_text):
+    # "HH:MM" or "HH:MM:SS" -> seconds since midnight
+    parts = [int(part) for part in time_text.split(':')]
+    hours, minutes, seconds = (parts + [0])[:3]
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def clock(seconds):
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class SessionIndex:
+    # One day's sessions sorted by start. A lookup bisects the starts and only scans back as far as the
+    # longest session, so finding what is live costs O(log n) plus the few overlapping sessions.
+    def __init__(self, sessions):
+        self.sessions = sorted(sessions, key=lambda s: seconds_of(s['start_time']))
+        self._starts = [seconds_of(s['start_time']) for s in self.sessions]
+        self._ends = [seconds_of(s['end_time']) for s in self.sessions]
+        self._longest = max((end - start for start, end in zip(self._starts, self._ends)), default=0)
+
+    def live(self, at, course_ids=None, open_early=0):
+        # Sessions with start - open_early <= at < end, latest start first
+        lo = bisect_left(self._starts, at - self._longest)
+        hi = bisect_right(self._starts, at + open_early)
+        return [self.sessions[i] for i in range(hi - 1, lo - 1, -1)
+                if at < self._ends[i] and (course_ids is None or self.sessions[i]['course_id'] in course_ids)]
+
+    def started(self, at, course_ids=None):
+        # Sessions that began by `at`, ended or not, latest start first
+        hi = bisect_right(self._starts, at)
+        return [self.sessions[i] for i in range(hi - 1, -1, -1)
+                if course_ids is None or self.sessions[i]['course_id'] in course_ids]
+
+
+class Timetable:
+    # Resolves "which session is live now" from an in-memory index of today's sessions, reloaded when the
+    # day changes, after an edit through this object, or at most TIMETABLE_CACHE_SECONDS after the last load.
+    # While a SessionCloser runs, that periodic reload happens on its thread instead of on a check-in.
+    # With a kiosk journal, who is inside which session comes from the journal, never from the database.
+    def __init__(self, db, open_early=OPEN_EARLY_MINUTES, late_after=LATE_AFTER_MINUTES,
+                 leave_before=LEAVE_BEFORE_MINUTES, journal=None):
+        self.db = db
+        self.journal = journal
+        self.background_reload = False
+        self.open_early = open_early * 60
+        self.late_after = late_after * 60
+        self.leave_before = leave_before * 60
+        self._lock = threading.Lock()
+        self._index = None
+        self._day = None
+        self._loaded = 0.0
+
+    def index(self, day=None):
+        day = day or datetime.now().strftime("%Y-%m-%d")
+        with self._lock:
+            stale = not self.background_reload and monotonic() - self._loaded > TIMETABLE_CACHE_SECONDS
+            if day != self._day or stale:
+                self._index = SessionIndex(self.db.get_course_sessions(day))
+                self._day = day
+                self._loaded = monotonic()
+            return self._index
+
+    def reload(self):
+        # Loads today's sessions without holding up lookups, which keep the old index meanwhile
+        day = datetime.now().strftime("%Y-%m-%d")
+        index = SessionIndex(self.db.get_course_sessions(day))
+        with self._lock:
+            self._index, self._day, self._loaded = index, day, monotonic()
+
+    def refresh(self):
+        with self._lock:
+            self._day = None
+
+    def live_session(self, course_ids=None, now=None):
+        now = now or datetime.now()
+        sessions = self.index(now.strftime("%Y-%m-%d")).live(seconds_of(now.strftime("%H:%M:%S")),
+                                                             course_ids, self.open_early)
+        return sessions[0] if sessions else None
+
+    def flag(self, session, attendance_type, time):
+        at = seconds_of(time)
+        if attendance_type == "In":
+            return 'late' if at > seconds_of(session['start_time']) + self.late_after else 'on_time'
+        return 'early' if at < seconds_of(session['end_time']) - self.leave_before else 'on_time'
+
+    def attach(self, course_id, attendance_type, time, student_id=None):
+        # (session id, flag) for a mark made today at `time`, or (None, None) outside any session of the course.
+        # An In may open the next session a little early; an Out closes the session the student is inside
+        # (their latest event in it is an In), else the one actually running, never one that has not started.
+        now = datetime.combine(datetime.now().date(), datetime.strptime(time, "%H:%M:%S").time())
+        if attendance_type == "In":
+            session = self.live_session({course_id}, now)
+        else:
+            day = now.strftime("%Y-%m-%d")
+            index = self.index(day)
+            at = seconds_of(time)
+            started = index.started(at, {course_id})
+            if not student_id:
+                open_ids = set()
+            elif self.journal is not None:
+                open_ids = {self.journal.open_session(student_id, course_id, day)}
+            else:
+                open_ids = self.db.get_open_sessions(student_id, [s['id'] for s in started])
+            session = next((s for s in started if s['id'] in open_ids), None)
+            if session is None:
+                session = next(iter(index.live(at, {course_id})), None)
+        if session is None:
+            return None, None
+        return session['id'], self.flag(session, attendance_type, time)
+
+    def record(self, student_id, course_id, attendance_type, time, is_manual=False):
+        # A mark made now: attached to the course's live session, if any, then journaled in kiosk mode or
+        # written straight to the database. Returns (success, message, flag).
+        session_id, flag = self.attach(course_id, attendance_type, time, student_id)
+        if self.journal is None:
+            success, message = self.db.mark_attendance(student_id, course_id, attendance_type, time, is_manual,
+                                                       session_id, flag)
+        else:
+            success, message = self.journal.record(student_id, course_id, attendance_type, time,
+                                                   method='manual' if is_manual else 'face',
+                                                   session_id=session_id, flag=flag)
+        return success, message, flag
+
+    def add_session(self, course_id, date, start_time, end_time, room=None):
+        # Times are stored as HH:MM:SS so they compare and pair with event times
+        start_time, end_time = clock(seconds_of(start_time)), clock(seconds_of(end_time))
+        if end_time <= start_time:
+            return False, "A session must end after it starts"
+        self.db.add_course_session(course_id, date, start_time, end_time, room)
+        self.refresh()
+        return True, "Session added"
+
+    def add_weekly(self, course_id, weekday, start_time, end_time, first_date, last_date, room=None):
+        # One session on every `weekday` (0 = Monday) between first_date and last_date inclusive
+        start_time, end_time = clock(seconds_of(start_time)), clock(seconds_of(end_time))
+        if end_time <= start_time:
+            return False, "A session must end after it starts"
+        day = datetime.strptime(first_date, "%Y-%m-%d")
+        day += timedelta(days=(weekday - day.weekday()) % 7)
+        last = datetime.strptime(last_date, "%Y-%m-%d")
+        count = 0
+        while day <= last:
+            self.db.add_course_session(course_id, day.strftime("%Y-%m-%d"), start_time, end_time, room)
+            day += timedelta(days=7)
+            count += 1
+        self.refresh()
+        return True, f"{count} sessions added"
+
+    def delete_session(self, session_id):
+        self.db.delete_course_session(session_id)
+        self.refresh()
+
+    def close_ended(self, now=None):
+        now = now or datetime.now()
+        if self.journal is not None:
+            # Ins still in the journal must reach the database first, or their students get no automatic Out
+            self.journal.reconcile(self.db)
+        with metrics.timer('session_close'):
+            sessions, outs = self.db.close_course_sessions(now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S"))
+        if self.journal is not None:
+            at = seconds_of(now.strftime("%H:%M:%S"))
+            self.journal.forget_sessions({s['id'] for s in self.index(now.strftime("%Y-%m-%d")).sessions
+                                          if seconds_of(s['end_time']) <= at})
+        if sessions:
+            log_event(logger, logging.INFO, "sessions_closed", sessions=sessions, auto_outs=outs)
+        return sessions, outs
+
+
+class SessionCloser(PeriodicWorker):
+    # Reloads the timetable and auto-closes ended sessions every `interval` seconds; closing is
+    # idempotent per session, so a failed pass is just repeated
+    error_metric = 'session_close_errors'
+    error_event = 'session_close_failed'
+
+    def __init__(self, timetable, interval=60.0):
+        super().__init__(interval)
+        self.timetable = timetable
+
+    def start(self):
+        self.timetable.background_reload = True
+        return super().start()
+
+    def step(self):
+        self.timetable.reload()
+        self.timetable.close_ended()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Schedule course sessions and close ended ones.')
+    parser.add_argument('--db', default=os.environ.get('STUDENT_PORTAL_DB', 'students.db'))
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help='Add one session, or a weekly series with --weekly-until')
+    add.add_argument('course')
+    add.add_argument('date', help='YYYY-MM-DD; with --weekly-until, the first week of the series')
+    add.add_argument('start', help='HH:MM')
+    add.add_argument('end', help='HH:MM')
+    add.add_argument('--room')
+    add.add_argument('--weekly-until', help='YYYY-MM-DD of the last week')
+    show = commands.add_parser('show', help='List the sessions of a day')
+    show.add_argument('date', nargs='?', default=datetime.now().strftime("%Y-%m-%d"))
+    commands.add_parser('close', help='Auto-close every session that has ended')
+    args = parser.parse_args(argv)
+
+    db = Database(args.db)
+    timetable = Timetable(db)
+    try:
+        if args.command == 'add':
+            course_id = db.course_id(args.course)
+            if course_id is None:
+                print(f"Unknown course: {args.course}")
+                return 1
+            if args.weekly_until:
+                weekday = datetime.strptime(args.date, "%Y-%m-%d").weekday()
+                success, message = timetable.add_weekly(course_id, weekday, args.start, args.end, args.date,
+                                                        args.weekly_until, args.room)
+            else:
+                success, message = timetable.add_session(course_id, args.date, args.start, args.end, args.room)
+            print(message)
+            return 0 if success else 1
+        if args.command == 'show':
+            for session in db.get_course_sessions(args.date):
+                closed = " (closed)" if session['closed_at'] else ""
+                print(f"{session['start_time']}-{session['end_time']}  {session['course']}  {session['room'] or ''}{closed}")
+            return 0
+        sessions, outs = timetable.close_ended()
+        print(f"Closed {sessions} sessions, {outs} automatic Outs")
+        return 0
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())